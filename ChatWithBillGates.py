@@ -1,8 +1,10 @@
 import os
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 import logging
 import azure.functions as func
-from azure.communication.email import EmailClient
+from azure.communication.email.aio import EmailClient
+from prompt_templates import batch_jobs
+from chat_batch import run_batch, format_digest
 
 app = func.FunctionApp()
 
@@ -13,27 +15,27 @@ async def timer_trigger1(myTimer: func.TimerRequest) -> None:
         if myTimer.past_due:
             logging.info('The timer is past due!')
 
-        client = AzureOpenAI(
+        client = AsyncAzureOpenAI(
         api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
         api_version = "2024-02-01",
         azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
         )
-        #Define the prompt I want to be using that includes a reference to the data contained in the text files.
-        prompt = f'''Bill I need you to explain the following:
-                            Why did you name Microsoft Microsoft and not Megasoft?'''
-
-        response = client.chat.completions.create(
-            model="BrandonAI", # model = "deployment_name".
-            messages=[{"role": "user", "content": prompt}])
-
-
-        # Log the content of the first message in the completion choices
-        promptresponse = (response.choices[0].message.content)
+        #Bill's question lives in prompt_templates.py now. It's still only the one question, the Megasoft one, asked on its own
+        # with no persona system message, same as before.
+        # It's streamed in with a deadline (LLM_DEADLINE_SECONDS) so Bill can't ramble on forever, see chat_batch.py
+        jobs = batch_jobs(["bill_gates"], ["megasoft"], persona_message=False)
+        batch = await run_batch(client, "BrandonAI", jobs) # model = "deployment_name".
+        logging.info(format_digest(batch))
+        result = batch["results"][0]
+        if not result["text"]:
+            raise RuntimeError(result["error"])
+
+        # Log the answer. Only the answer goes in the email, the digest with the timings is just for the log
+        promptresponse = result["text"]
         logging.warning(promptresponse)
 
         #Email the results to me
         emailkey = os.environ.get('EMAIL_KEY')
-        client = EmailClient.from_connection_string(emailkey)
 
         message = {
             "senderAddress": "visitormonitor@brandedkai.net",
@@ -46,8 +48,10 @@ async def timer_trigger1(myTimer: func.TimerRequest) -> None:
             }
         }
 
-        poller = client.begin_send(message)
-        poller.result()
+        # The aio client, so waiting on the send doesn't block the worker's event loop
+        async with EmailClient.from_connection_string(emailkey) as email_client:
+            poller = await email_client.begin_send(message)
+            await poller.result()
 
     except Exception as e:
         # Log any exceptions that occur
@@ -2,6 +2,8 @@ import os
 from openai import AsyncOpenAI
 import logging
 import azure.functions as func
+from prompt_templates import batch_jobs
+from chat_batch import run_batch, format_digest
 
 app = func.FunctionApp()
 
@@ -13,15 +15,20 @@ async def timer_trigger1(myTimer: func.TimerRequest) -> None:
             logging.info('The timer is past due!')
 
 
-        prompt = '''Hello Sam, whats next in the OpenAI adventure?'''
+        # Sam's question lives in prompt_templates.py now. Still just the one question on its own with no persona system message,
+        # asked within the quota. See chat_batch.py
+        jobs = batch_jobs(["sam_altman"], ["whats_next"], persona_message=False)
 
         client = AsyncOpenAI(
          api_key=os.environ['OPENAI_API_KEY'],  # Reference the API key in my function app environment
         )
-        response = await client.chat.completions.create(model="gpt-3.5-turbo",
-                                                          messages=[{"role": "user", "content": prompt}])
-        # Log the content of the first message in the completion choices
-        logging.info(response.choices[0].message.content)
+        batch = await run_batch(client, "gpt-3.5-turbo", jobs)
+        logging.info(format_digest(batch))
+        # Log the answer on its own too, same as before
+        result = batch["results"][0]
+        if not result["text"]:
+            raise RuntimeError(result["error"])
+        logging.info(result["text"])
 
     except Exception as e:
             # Log any exceptions that occur
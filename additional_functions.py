@@ -7,6 +7,9 @@ import logging
 import azure.functions as func
 from azure.core.exceptions import ResourceNotFoundError
 from azure.communication.email import EmailClient
+from snapshot_format import parse_text_snapshot
+from visitor_diff import diff_snapshots
+from prompt_builder import build_prompt, format_report
 
 app = func.FunctionApp()
 
@@ -111,17 +114,18 @@ async def analyse_visits(myTimer: func.TimerRequest) -> None:
         except ResourceNotFoundError:
             logging.error(f"Could not find blob {thisweektxt} in container 'results'")
             return
+        # Work out what changed between yesterday and today so only the changes go in the prompt.
+        visitor_diff = diff_snapshots(*parse_text_snapshot(data_lastweek), *parse_text_snapshot(data_thisweek))
         #Define the prompt I want to be using that includes a reference to the data contained in the text files.
-        prompt = f'''I have two sets of results that display the Public IP address of my visitors and how many times they've visited. 
-                    I want to compare yesterday with today. Please advise me of the following:
+        instructions = f'''I have compared yesterday's list of visitor Public IP addresses and visit counts with today's. 
+                    Below are the totals plus only the visitors that are new, gone or whose visit count changed. Please advise me of the following:
                     1. Any new visitors and how many visits they have
                     2. Any changes in visit counts
                     3. Any other interesting trends that you've noticed.
-                    4. Take today's date {thisweek} and tell me an interesting historical thing that happened on the same date.
-                    Yesterday:
-                    {data_lastweek}
-                    Today:
-                    {data_thisweek}'''
+                    4. Take today's date {thisweek} and tell me an interesting historical thing that happened on the same date.'''
+        # Keep the prompt under PROMPT_TOKEN_BUDGET. If the changes don't fit it falls back to the top movers, then /24 subnets, then just the totals.
+        prompt, prompt_report = build_prompt(instructions, visitor_diff)
+        logging.warning(format_report(prompt_report))
 
         client = AzureOpenAI(
         api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
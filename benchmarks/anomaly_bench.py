@@ -0,0 +1,38 @@
+#Times visitor_anomalies.detect_anomalies on a made up visit index, by default 1M IPs x 52 weekly periods.
+#Most IPs visit a few times a week, a handful get a spike in the last week and some brand new ones turn up with a burst.
+#Run it from the repo root:  python benchmarks/anomaly_bench.py 1000000 52
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from visitor_anomalies import detect_anomalies, format_anomalies
+
+
+def make_index(ip_count: int, period_count: int) -> dict:
+    import numpy as np
+    rng = np.random.default_rng(ip_count)
+    weekly = rng.poisson(rng.uniform(0, 6, size=(ip_count, 1)), size=(ip_count, period_count)).astype('<i4')
+    #The last 1% of IPs are new this week.
+    new = ip_count - ip_count // 100
+    weekly[new:, :-1] = 0
+    weekly[new:, -1] = rng.integers(0, 60, size=ip_count - new)
+    #And 0.1% of the rest spike.
+    spiking = rng.choice(new, size=max(ip_count // 1000, 1), replace=False)
+    weekly[spiking, -1] += rng.integers(10, 200, size=len(spiking)).astype('<i4')
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(ip_count)]
+    periods = [f"2025{week // 4 + 1:02d}{week % 4 * 7 + 1:02d}" for week in range(period_count)]
+    return {"periods": periods, "ips": ips, "counts": np.cumsum(weekly, axis=1, dtype='<i4'), "appends_since_compact": 0}
+
+
+if __name__ == '__main__':
+    ip_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    period_count = int(sys.argv[2]) if len(sys.argv) > 2 else 52
+    index = make_index(ip_count, period_count)
+    timings = []
+    for _ in range(5):
+        started = time.perf_counter()
+        anomalies = detect_anomalies(index)
+        timings.append(time.perf_counter() - started)
+    print(f"{ip_count} IPs x {period_count} periods: best {min(timings) * 1000:.0f} ms, worst {max(timings) * 1000:.0f} ms over {len(timings)} runs")
+    print(format_anomalies(anomalies))
@@ -0,0 +1,58 @@
+#Compares three ways of getting answers for a batch of persona prompts from a pretend deployment with an RPM quota
+#(the FakeOpenAI stand-in, which 429s anything over rpm / 6 requests in 10 seconds like Azure does):
+#   one at a time      what the persona functions used to do, one completion after another (chat_batch with concurrency 1)
+#   all at once        asyncio.gather with no limits, which buys 429s once the batch is bigger than the quota
+#   chat_batch         the semaphore + token bucket runner from chat_batch.py
+#With a roomy quota chat_batch should be about CHAT_BATCH_CONCURRENCY times faster than one at a time, with a tight one
+#it should run at the quota with no 429s while all at once loses whatever didn't fit.
+#Run it from the repo root:  python benchmarks/chat_batch_bench.py [prompts] [latency seconds] [rpm ...]
+import os
+import sys
+import time
+import asyncio
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from standins import FakeOpenAI
+from llm_stream import stream_completion
+from chat_batch import CHAT_BATCH_CONCURRENCY, run_batch, format_digest
+from prompt_templates import register_question, batch_jobs
+
+
+def make_jobs(count: int) -> list:
+    #Enough extra questions that personas x questions comes to at least count prompts.
+    for number in range(count):
+        register_question('*', f"bench_{number}", f"Benchmark question {number}, what do you think about {{date}}?")
+    return batch_jobs(date="20260101")[:count]
+
+
+async def all_at_once(client, jobs):
+    results = await asyncio.gather(*(stream_completion(client, "bench", job["messages"]) for job in jobs), return_exceptions=True)
+    return sum(1 for result in results if not isinstance(result, Exception) and result[0])
+
+
+def report(name: str, answered: int, seconds: float, client) -> None:
+    print(f"  {name:<14} {answered:>4} answered in {seconds:6.2f}s ({answered / seconds:6.1f}/s), {client.rate_limited} x 429")
+
+
+async def bench(jobs: list, latency: float, rpm: int) -> None:
+    print(f"{len(jobs)} prompts, {rpm} RPM quota, {latency}s per answer")
+    for name, concurrency in (("one at a time", 1), ("chat_batch", None)):
+        client = FakeOpenAI(latency, rpm=rpm)
+        started = time.perf_counter()
+        batch = await run_batch(client, "bench", jobs, concurrency=concurrency or CHAT_BATCH_CONCURRENCY, rpm=rpm, tpm=10 ** 9)
+        report(name, sum(1 for result in batch["results"] if result["text"]), time.perf_counter() - started, client)
+        if concurrency is None:
+            print('    ' + format_digest(batch).splitlines()[0])
+    client = FakeOpenAI(latency, rpm=rpm)
+    started = time.perf_counter()
+    answered = await all_at_once(client, jobs)
+    report("all at once", answered, time.perf_counter() - started, client)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    jobs = make_jobs(int(sys.argv[1]) if len(sys.argv) > 1 else 40)
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.25
+    for rpm in [int(arg) for arg in sys.argv[3:]] or [600, 120]:
+        asyncio.run(bench(jobs, latency, rpm))
@@ -0,0 +1,61 @@
+#Measures what blob_compression.py costs and saves on the files it compresses.
+#For each codec and level it compresses a made up .txt snapshot the way the export does (one gzip member / zstd frame per
+#5000 row block), then streams it back through the same decompressor the readers use, and reports the ratio and CPU time.
+#The smoketests JSON is small but written every run, so it gets a line too. .vsnap is shown for comparison since it's never compressed again.
+#Run it from the repo root:  python benchmarks/compression_bench.py 1000 100000 1000000
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from blob_compression import compress_block, decompress_chunks, _get_zstd
+from snapshot_format import encode_snapshot
+from snapshot_format_bench import make_rows, batched, chunked
+
+CODECS = [('none', None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+if _get_zstd() is not None:
+    CODECS += [('zstd', 3), ('zstd', 9), ('zstd', 19)]
+
+
+def text_blocks(rows):
+    #Same text the export writes, see visitor_export.encode_rows
+    first_batch = True
+    for batch in batched(rows):
+        chunk = '\n'.join(str(row) for row in batch)
+        yield (chunk if first_batch else '\n' + chunk).encode('utf-8')
+        first_batch = False
+
+
+def bench_blocks(label: str, blocks: list) -> None:
+    raw = sum(len(block) for block in blocks)
+    for codec, level in CODECS:
+        started = time.process_time()
+        stored = [compress_block(block, codec, level) for block in blocks] if level else blocks
+        compress_seconds = time.process_time() - started
+        data = b''.join(stored)
+        started = time.process_time()
+        restored = sum(len(chunk) for chunk in decompress_chunks(chunked(data), codec if level else None))
+        decompress_seconds = time.process_time() - started
+        assert restored == raw
+        if not level:
+            print(f"{label:<22} {codec:<8} {len(data):>13,} B")
+            continue
+        print(f"{label:<22} {codec} {level:<3} {len(data):>13,} B  {raw / max(len(data), 1):6.2f}x"
+              f"  compress {compress_seconds:7.3f}s ({raw / max(compress_seconds, 1e-9) / 1e6:7.1f} MB/s)"
+              f"  decompress {decompress_seconds:7.3f}s")
+
+
+def bench(count: int) -> None:
+    rows = make_rows(count)
+    bench_blocks(f"{count} rows txt", list(text_blocks(rows)))
+    snapshot = b''.join(encode_snapshot(batched(rows)))
+    print(f"{f'{count} rows vsnap':<22} {'as is':<8} {len(snapshot):>13,} B")
+
+
+if __name__ == '__main__':
+    #One smoketests_{date}_{function}.json worth of timings.
+    spans = ',\n'.join(f'    {{"stage": {number}, "name": "stage_{number}", "started": 1700000000.0, "duration_ms": 12.3,'
+                       f' "bytes": 0, "ok": true, "retry_count": 0, "error": null}}' for number in range(1, 6))
+    bench_blocks("smoketests json", [f'{{"function": "dbqueryandsave", "stages": [\n{spans}\n]}}'.encode('utf-8')])
+    for count in [int(arg) for arg in sys.argv[1:]] or [1000, 100000]:
+        bench(count)
@@ -0,0 +1,155 @@
+#Runs dbqueryandsave and analyse_visits end to end against the local stand-ins in standins.py, no Azure needed.
+#For each table size it seeds a fresh SQLite ResumeVisitors table plus last week's snapshot, runs both functions
+#in their own process and reports wall time, peak RSS and how long was spent in SQL, blob, OpenAI and email.
+#Run it from the repo root:  python benchmarks/e2e_bench.py 1000 100000 1000000 --openai-latency 0.5
+#This needs the packages in requirements.txt installed (azure-functions, azure-core, numpy), but none of the services.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import resource
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.join(BENCH_DIR, '..')
+
+
+def current_rss_mb() -> float:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+def peak_rss_mb() -> float:
+    #ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def user_functions(app) -> dict:
+    #The decorators hand the functions over to the FunctionApp, this gets the plain python functions back out.
+    return {function.get_function_name(): function.get_user_function() for function in app.get_functions()}
+
+
+def run_child(rows: int, openai_latency: float, verbose: bool) -> dict:
+    sys.path.insert(0, REPO_ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    import logging
+    import standins
+    from snapshot_format import SNAPSHOT_EXTENSION, encode_snapshot
+
+    logging.getLogger().setLevel(logging.INFO if verbose else logging.CRITICAL)
+    for setting in ('SQLDB_CONNECTION_STRING', 'AzureWebJobsStorage', 'BLOB_KEY', 'EMAIL_KEY'):
+        os.environ.setdefault(setting, 'standin')
+
+    seed_started = time.perf_counter()
+    visitors = standins.make_visitors(rows)
+    #dbqueryandsave imports pyodbc inside the function, so putting the stand-in in sys.modules is all it takes.
+    sys.modules['pyodbc'] = standins.FakePyodbc(visitors)
+    blobs = {}
+    sync_blob = standins.MemoryBlobService(blobs)
+    async_blob = standins.AsyncMemoryBlobService(blobs)
+    async_blob.containers = sync_blob.containers
+    openai = standins.FakeOpenAI(openai_latency)
+    email = standins.NullEmail()
+
+    #Last week's snapshot: most visitors the same, some with more visits, some not there yet.
+    random.seed(rows + 1)
+    last_week = [(ip, max(count - random.randint(0, 3), 1)) for ip, count in visitors if random.random() > 0.05]
+    lastweek = (datetime.date.today() - datetime.timedelta(days=7)).strftime("%Y%m%d")
+    batches = (last_week[i:i + 5000] for i in range(0, len(last_week), 5000))
+    sync_blob.get_blob_client("results", f"visitors{lastweek}{SNAPSHOT_EXTENSION}").upload_blob(
+        b''.join(encode_snapshot(batches)))
+    del visitors, last_week
+    seed_seconds = time.perf_counter() - seed_started
+
+    import function_app
+    #Swap the real clients for the stand-ins through the same registry the app uses.
+    function_app.clients.register("blob", lambda: sync_blob)
+    function_app.clients.register("blob_aio", lambda: async_blob)
+    function_app.clients.register("openai", lambda: openai)
+    function_app.clients.register("email", lambda: email)
+    functions = user_functions(function_app.app)
+
+    baseline_rss = current_rss_mb()
+    standins.stage_seconds.clear()
+    started = time.perf_counter()
+    functions["dbqueryandsave"](standins.FakeTimer(), standins.FakeContext("dbqueryandsave"))
+    export_seconds = time.perf_counter() - started
+    export_stages = dict(standins.stage_seconds)
+
+    standins.stage_seconds.clear()
+    started = time.perf_counter()
+    asyncio.run(functions["analyse_visits"](standins.FakeTimer()))
+    analyse_seconds = time.perf_counter() - started
+    analyse_stages = dict(standins.stage_seconds)
+
+    #analyse_visits only queues the email, send_outbox is what sends it.
+    standins.stage_seconds.clear()
+    started = time.perf_counter()
+    asyncio.run(functions["send_outbox"](standins.FakeTimer()))
+    outbox_seconds = time.perf_counter() - started
+
+    return {
+        "rows": rows,
+        "seed_seconds": seed_seconds,
+        "dbqueryandsave_seconds": export_seconds,
+        "dbqueryandsave_stages": export_stages,
+        "analyse_visits_seconds": analyse_seconds,
+        "analyse_visits_stages": analyse_stages,
+        "send_outbox_seconds": outbox_seconds,
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "stored_bytes": sum(len(value[0]) for value in blobs.values()),
+        "prompt_chars": openai.prompt_chars,
+        "emails_sent": len(email.sent),
+    }
+
+
+def format_stages(stages: dict) -> str:
+    return ' '.join(f"{stage} {seconds:.3f}s" for stage, seconds in sorted(stages.items()))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the timer functions")
+    parser.add_argument('rows', nargs='*', type=int, default=[1000, 100000, 1000000])
+    parser.add_argument('--openai-latency', type=float, default=0.5, help="seconds the stand-in model takes to answer")
+    parser.add_argument('--verbose', action='store_true', help="show the functions' own logging")
+    parser.add_argument('--json', action='store_true', help="print the raw results as JSON")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_child(args.child, args.openai_latency, args.verbose)))
+        return 0
+
+    results = []
+    for rows in args.rows:
+        #Each size runs in its own process so peak RSS isn't carried over from the previous one.
+        command = [sys.executable, os.path.abspath(__file__), '--child', str(rows), '--openai-latency', str(args.openai_latency)]
+        if args.verbose:
+            command.append('--verbose')
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr, file=sys.stderr)
+            return result.returncode
+        if args.verbose:
+            print(result.stderr, file=sys.stderr)
+        results.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    for r in results:
+        print(f"{r['rows']:>9} rows | peak RSS {r['peak_rss_mb']:7.1f} MB (after seeding {r['baseline_rss_mb']:7.1f} MB)"
+              f" | stored {r['stored_bytes']:,} B | prompt {sum(r['prompt_chars']):,} chars")
+        print(f"{'':>9}      | dbqueryandsave {r['dbqueryandsave_seconds']:7.3f}s  ({format_stages(r['dbqueryandsave_stages'])})")
+        print(f"{'':>9}      | analyse_visits {r['analyse_visits_seconds']:7.3f}s  ({format_stages(r['analyse_visits_stages'])})")
+        print(f"{'':>9}      | send_outbox    {r['send_outbox_seconds']:7.3f}s  ({r['emails_sent']} emails sent)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
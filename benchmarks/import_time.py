@@ -0,0 +1,87 @@
+#Measures what a cold start pays to import function_app.py, using python's own -X importtime.
+#It runs the import a few times in a fresh interpreter, keeps the fastest run, and prints the biggest packages by cumulative time.
+#It also times each of the heavy dependencies on its own so I can see what the lazy imports are saving.
+#Run it from anywhere:  python benchmarks/import_time.py
+#Pass --max-ms to fail (exit code 1) when the import gets slower than that, which is how the deploy workflow uses it.
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+#The dependencies function_app.py only imports on the code path that needs them.
+LAZY_DEPENDENCIES = ["pyodbc", "openai", "azure.storage.blob", "azure.storage.blob.aio",
+                     "azure.communication.email.aio", "tiktoken"]
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def import_times(module: str):
+    """Import module in a fresh interpreter and return [(cumulative us, self us, depth, name)]."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=REPO_ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            times.append((int(cumulative_us), int(self_us), (len(indent) - 1) // 2, name))
+    return times
+
+
+def module_tree(times, module: str):
+    """Cut the import list down to what importing module pulled in. Returns (entries, total us)."""
+    #-X importtime also lists what the interpreter imports at startup (site, encodings...). Children are printed before
+    #their parent, and import a.b.c shows up as separate top level entries for a, a.b and a.b.c,
+    #so the module's own imports are everything from the first of its parent packages up to the module itself.
+    parts = module.split('.')
+    packages = {'.'.join(parts[:i]) for i in range(1, len(parts) + 1)}
+    end = next(i for i, t in enumerate(times) if t[2] == 0 and t[3] == module)
+    first = next(i for i, t in enumerate(times) if t[2] == 0 and t[3] in packages)
+    start = first
+    while start > 0 and times[start - 1][2] > 0:
+        start -= 1
+    tree = times[start:end + 1]
+    return tree, sum(t[0] for t in tree if t[2] == 0)
+
+
+def best_of(module: str, runs: int):
+    #The first run pays for the disk cache being cold, so keep the fastest of a few runs.
+    return min((module_tree(import_times(module), module) for _ in range(runs)), key=lambda tree: tree[1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Import-time breakdown of function_app.py")
+    parser.add_argument('--module', default='function_app')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--max-ms', type=float, default=None, help="fail if the import takes longer than this")
+    args = parser.parse_args()
+
+    times, total_us = best_of(args.module, args.runs)
+    total_ms = total_us / 1000
+    print(f"import {args.module}: {total_ms:.1f} ms over {len(times)} modules (best of {args.runs})")
+    print(f"\nTop {args.top} packages imported directly by the app, by cumulative time:")
+    #Depth 1 is what function_app.py (and the helpers next to it) import themselves.
+    top_level = sorted((t for t in times if t[2] == 1), reverse=True)[:args.top]
+    for cumulative_us, self_us, _, name in top_level:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    print("\nDeferred until first use (cost when they do get imported):")
+    for dependency in LAZY_DEPENDENCIES:
+        try:
+            dependency_ms = best_of(dependency, 1)[1] / 1000
+            print(f"  {dependency_ms:8.1f} ms  {dependency}")
+        except RuntimeError:
+            print(f"  {'-':>8}     {dependency} (not installed)")
+
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"\nimport {args.module} took {total_ms:.1f} ms, over the limit of {args.max_ms} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
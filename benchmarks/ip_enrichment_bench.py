@@ -0,0 +1,87 @@
+#Times ip_enrichment.py on a made up CIDR table: parsing the CSV, writing and memory mapping the prebuilt index,
+#single lookups with and without the LRU, and rolling a week's visitors up by network.
+#The table is /16s with /24s carved out of some of them plus a few IPv6 /32s, roughly the shape of the real ASN data.
+#Run it from the repo root:  python benchmarks/ip_enrichment_bench.py 500000
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ip_enrichment import IPNetworkIndex, aggregate_by_network
+
+
+def write_csv(path: str, network_count: int) -> None:
+    random.seed(network_count)
+    with open(path, 'w', encoding='utf-8') as csv_file:
+        csv_file.write("network,asn,country,as_name\n")
+        written = 0
+        for first in range(1, 224):
+            for second in range(256):
+                if written >= network_count:
+                    return
+                csv_file.write(f"{first}.{second}.0.0/16,{first * 256 + second},AU,NET-{first}-{second}\n")
+                written += 1
+                #Some /16s have a few /24s belonging to someone else.
+                for third in random.sample(range(256), random.choice((0, 0, 3, 20))):
+                    csv_file.write(f"{first}.{second}.{third}.0/24,{100000 + written},NZ,CARVED-{written}\n")
+                    written += 1
+                if second % 16 == 0:
+                    csv_file.write(f"2001:{first:x}{second:02x}::/32,{200000 + written},US,V6-{written}\n")
+                    written += 1
+
+
+def random_ips(count: int):
+    return [f"{random.randint(1, 223)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(0, 255)}"
+            for _ in range(count)]
+
+
+def bench(network_count: int) -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        csv_path = os.path.join(folder, "networks.csv")
+        index_path = os.path.join(folder, "networks.ipidx")
+        write_csv(csv_path, network_count)
+
+        started = time.perf_counter()
+        built = IPNetworkIndex.from_csv(csv_path)
+        build_seconds = time.perf_counter() - started
+        size = built.save(index_path)
+        started = time.perf_counter()
+        index = IPNetworkIndex.load(index_path)
+        load_seconds = time.perf_counter() - started
+        print(f"{network_count} CIDRs -> {len(index)} ranges, {len(index.tables['asns'])} networks | CSV build {build_seconds:.2f}s"
+              f" | prebuilt {size:,} B, mapped in {load_seconds * 1000:.1f} ms")
+
+        ips = random_ips(100000)
+        started = time.perf_counter()
+        for ip in ips:
+            index._lookup(ip)
+        cold = (time.perf_counter() - started) / len(ips)
+        #Regular visitors: the same 10000 IPs over and over, which all fit in the LRU.
+        regulars = ips[:10000] * 10
+        for ip in regulars:
+            index.lookup(ip)
+        started = time.perf_counter()
+        for ip in regulars:
+            index.lookup(ip)
+        hot = (time.perf_counter() - started) / len(regulars)
+        assert all(index.lookup(ip) == built.lookup(ip) for ip in ips[:1000])
+        print(f"  lookup {cold * 1e6:.2f} us uncached, {hot * 1e6:.2f} us from the LRU")
+
+        index.lookup.cache_clear()
+        visits = [random.randint(1, 50) for _ in ips]
+        started = time.perf_counter()
+        aggregate = aggregate_by_network(index, ips, visits)
+        print(f"  {len(ips)} visitors rolled up into {aggregate['networks']} networks in {(time.perf_counter() - started) * 1000:.0f} ms")
+        #Same answer as looking every IP up one at a time.
+        networks = {}
+        for ip, count in zip(ips, visits):
+            network = index.lookup(ip)
+            networks[network["asn"] if network else 0] = networks.get(network["asn"] if network else 0, 0) + count
+        assert [network["visits"] for network in aggregate["top"]] == sorted(networks.values(), reverse=True)[:len(aggregate["top"])]
+
+
+if __name__ == '__main__':
+    for count in [int(arg) for arg in sys.argv[1:]] or [10000, 500000]:
+        bench(count)
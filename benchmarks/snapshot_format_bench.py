@@ -0,0 +1,55 @@
+#Compares the old repr-of-Row .txt snapshots with the .vsnap format from snapshot_format.py.
+#It makes up some visitor rows, writes them out both ways and reports the size and how long each one takes to read back.
+#Run it from the repo root:  python benchmarks/snapshot_format_bench.py 1000 100000 1000000
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapshot_format import encode_snapshot, read_snapshot, parse_text_snapshot
+
+
+def make_rows(count: int):
+    random.seed(count)
+    return [(f"{random.randint(1, 223)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(0, 255)}",
+             random.randint(1, 500)) for _ in range(count)]
+
+
+def batched(rows, size: int = 5000):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def chunked(data: bytes, size: int = 4 * 1024 * 1024):
+    #download_blob().chunks() hands back 4MiB pieces by default so I read the file back the same way.
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def bench(count: int) -> None:
+    rows = make_rows(count)
+
+    started = time.perf_counter()
+    text = '\n'.join(str(row) for row in rows).encode('utf-8')
+    text_write = time.perf_counter() - started
+    started = time.perf_counter()
+    parse_text_snapshot(text.decode('utf-8'))
+    text_read = time.perf_counter() - started
+
+    started = time.perf_counter()
+    snapshot = b''.join(encode_snapshot(batched(rows)))
+    snapshot_write = time.perf_counter() - started
+    started = time.perf_counter()
+    ips, counts = read_snapshot(chunked(snapshot))
+    snapshot_read = time.perf_counter() - started
+    assert len(ips) == len(counts) == count
+
+    print(f"{count:>9} rows | txt {len(text):>12,} B  write {text_write:7.3f}s  read {text_read:7.3f}s"
+          f" | vsnap {len(snapshot):>12,} B  write {snapshot_write:7.3f}s  read {snapshot_read:7.3f}s"
+          f" | {len(text) / max(len(snapshot), 1):5.2f}x smaller, {text_read / max(snapshot_read, 1e-9):6.1f}x faster to read")
+
+
+if __name__ == '__main__':
+    for count in [int(arg) for arg in sys.argv[1:]] or [1000, 100000]:
+        bench(count)
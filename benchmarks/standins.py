@@ -0,0 +1,531 @@
+#Local stand-ins for the services function_app.py talks to, so the functions can be run and timed without any Azure resources.
+#   FakePyodbc        SQLite pretending to be pyodbc, seeded with synthetic ResumeVisitors rows. Dates come back as datetime
+#                     objects like they do from SQL Server. The few bits of T-SQL the aggregate export uses are rewritten
+#                     for SQLite on the way in (see _sqlite), MERGE isn't supported
+#   MemoryBlobService an in-memory blob store with the sync and aio client methods the app uses
+#   FakeOpenAI        an AsyncAzureOpenAI look-alike that waits a configurable latency before answering
+#   NullEmail         an email client that accepts every message and sends nothing
+#Every call into a stand-in adds its time to stage_seconds so the benchmark can say where the time went.
+import re
+import gzip
+import time
+import random
+import sqlite3
+import asyncio
+import datetime
+from collections import defaultdict
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+stage_seconds = defaultdict(float)
+stage_calls = defaultdict(int)
+
+
+class _timed:
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stage_seconds[self.stage] += time.perf_counter() - self.started
+        stage_calls[self.stage] += 1
+
+
+def make_visitors(count: int, seed: int = 0):
+    random.seed(seed)
+    return [(f"{random.randint(1, 223)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{i % 256}",
+             random.randint(1, 500)) for i in range(count)]
+
+
+#SQL
+
+class FakePyodbc:
+    """Drop-in for the pyodbc module, backed by one SQLite database shared by every connection."""
+
+    Error = sqlite3.Error
+
+    def __init__(self, rows):
+        self.pooling = True
+        self._path = f"file:standin{id(self)}?mode=memory&cache=shared"
+        #Keep one connection open so the shared in-memory database lives as long as this object.
+        self._keepalive = sqlite3.connect(self._path, uri=True, check_same_thread=False)
+        self._keepalive.execute("CREATE TABLE ResumeVisitors (IPAddress TEXT PRIMARY KEY, VisitCount INTEGER, "
+                                "LastVisited TEXT)")
+        today = datetime.datetime.now().isoformat()
+        self._keepalive.executemany("INSERT OR REPLACE INTO ResumeVisitors VALUES (?, ?, ?)",
+                                    ((ip, count, today) for ip, count in rows))
+        self._keepalive.commit()
+
+    def connect(self, conn_str=None, **kwargs):
+        with _timed("sql"):
+            return _Connection(sqlite3.connect(self._path, uri=True, check_same_thread=False))
+
+
+class _Connection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return _Cursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def _sqlite(sql: str) -> str:
+    #Just enough T-SQL to SQLite for visitor_summary.py: IF OBJECT_ID(...) IS NULL CREATE TABLE, CAST(... AS DATE) and #temp tables.
+    #UPDATE ... FROM works as it is on SQLite 3.33 and later.
+    sql = re.sub(r"IF OBJECT_ID\(N'\w+', N'U'\) IS NULL CREATE TABLE", "CREATE TABLE IF NOT EXISTS", sql)
+    sql = re.sub(r"CAST\(([\w.]+) AS DATE\)", r"date(\1)", sql)
+    sql = re.sub(r"CREATE TABLE #", "CREATE TEMP TABLE ", sql)
+    return re.sub(r"#(\w+)", r"\1", sql)
+
+
+_DATETIME_TEXT = re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d{1,6})?")
+_DATE_TEXT = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def _value(value):
+    #SQLite hands dates back as the text they were stored as. pyodbc gives datetime and date objects for DATETIME2 and DATE,
+    #and those are what end up in str(row), so the stand-in returns the same.
+    if isinstance(value, str):
+        if _DATETIME_TEXT.fullmatch(value):
+            return datetime.datetime.fromisoformat(value)
+        if _DATE_TEXT.fullmatch(value):
+            return datetime.date.fromisoformat(value)
+    return value
+
+
+def _row(row):
+    return None if row is None else tuple(_value(value) for value in row)
+
+
+def _param(value):
+    #pyodbc sends datetimes as datetimes, SQLite compares them as the ISO text they're stored as.
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value
+
+
+class _Cursor:
+    def __init__(self, cur):
+        self._cur = cur
+        self.fast_executemany = False
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def execute(self, sql, *params):
+        with _timed("sql"):
+            self._cur.execute(_sqlite(sql), [_param(value) for value in params])
+        return self
+
+    def executemany(self, sql, seq):
+        with _timed("sql"):
+            self._cur.executemany(_sqlite(sql), ([_param(value) for value in row] for row in seq))
+        return self
+
+    def fetchone(self):
+        with _timed("sql"):
+            return _row(self._cur.fetchone())
+
+    def fetchmany(self, size):
+        with _timed("sql"):
+            return [_row(row) for row in self._cur.fetchmany(size)]
+
+    def fetchall(self):
+        with _timed("sql"):
+            return [_row(row) for row in self._cur.fetchall()]
+
+
+#Blob storage
+
+class _Properties:
+    def __init__(self, name, data, metadata, content_settings, last_modified):
+        self.name = name
+        self.size = len(data)
+        self.metadata = dict(metadata)
+        self.content_settings = content_settings
+        self.last_modified = last_modified
+        self.etag = f'"{hash((name, data)) & 0xffffffff:08x}"'
+
+
+class _ContentSettings:
+    def __init__(self, content_md5=None, content_encoding=None, content_type=None):
+        self.content_md5 = content_md5
+        self.content_encoding = content_encoding
+        self.content_type = content_type
+
+
+class _Downloader:
+    def __init__(self, data: bytes, properties=None, chunk_size: int = 4 * 1024 * 1024):
+        self._data = data
+        self._chunk_size = chunk_size
+        self.size = len(data)
+        self.properties = properties
+
+    def readall(self):
+        return self._data
+
+    def chunks(self):
+        for start in range(0, len(self._data), self._chunk_size):
+            yield self._data[start:start + self._chunk_size]
+
+
+class _AsyncDownloader(_Downloader):
+    async def readall(self):
+        return self._data
+
+    async def _chunks(self):
+        for chunk in _Downloader.chunks(self):
+            yield chunk
+
+    def chunks(self):
+        return self._chunks()
+
+
+class MemoryBlobService:
+    """Sync BlobServiceClient look-alike. Blobs live in self.blobs keyed by (container, name)."""
+
+    def __init__(self, blobs=None):
+        self.blobs = {} if blobs is None else blobs
+        self.containers = set()
+
+    def get_blob_client(self, container, blob):
+        return MemoryBlob(self, container, blob)
+
+    def get_container_client(self, container):
+        return MemoryContainer(self, container)
+
+    def close(self):
+        pass
+
+
+class MemoryBlob:
+    def __init__(self, service, container, name):
+        self.service = service
+        self.container_name = container
+        self.blob_name = name
+        self._staged = {}
+
+    @property
+    def _key(self):
+        return (self.container_name, self.blob_name)
+
+    def _put(self, data, overwrite, metadata=None, content_settings=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif not isinstance(data, (bytes, bytearray)):
+            data = b''.join(data)
+        if self._key in self.service.blobs and not overwrite:
+            raise ResourceExistsError(f"{self.blob_name} already exists")
+        self.service.blobs[self._key] = (bytes(data), metadata or {}, content_settings or _ContentSettings(),
+                                         datetime.datetime.now(datetime.timezone.utc))
+
+    def upload_blob(self, data, overwrite=False, metadata=None, content_settings=None, **kwargs):
+        with _timed("blob"):
+            self._put(data, overwrite, metadata, content_settings)
+
+    def stage_block(self, block_id, data, **kwargs):
+        with _timed("blob"):
+            self._staged[block_id] = data if isinstance(data, bytes) else bytes(data)
+
+    def commit_block_list(self, block_list, metadata=None, content_settings=None, match_condition=None, **kwargs):
+        with _timed("blob"):
+            block_ids = [getattr(block, "id", block) for block in block_list]
+            self._put(b''.join(self._staged.pop(block_id) for block_id in block_ids),
+                      overwrite=match_condition is None, metadata=metadata, content_settings=content_settings)
+
+    def download_blob(self, offset=None, length=None, **kwargs):
+        with _timed("blob"):
+            if self._key not in self.service.blobs:
+                raise ResourceNotFoundError(f"{self.blob_name} not found")
+            data, metadata, content_settings, last_modified = self.service.blobs[self._key]
+            properties = _Properties(self.blob_name, data, metadata, content_settings, last_modified)
+            #Like the real transport, a gzip Content-Encoding gets undone on the way down unless decompress=False.
+            if kwargs.get("decompress", True) and content_settings.content_encoding == "gzip":
+                data = gzip.decompress(data)
+            if offset is not None:
+                data = data[offset:offset + length if length is not None else None]
+            return _Downloader(data, properties)
+
+    def get_blob_properties(self, **kwargs):
+        with _timed("blob"):
+            if self._key not in self.service.blobs:
+                raise ResourceNotFoundError(f"{self.blob_name} not found")
+            data, metadata, content_settings, last_modified = self.service.blobs[self._key]
+            return _Properties(self.blob_name, data, metadata, content_settings, last_modified)
+
+    def exists(self, **kwargs):
+        return self._key in self.service.blobs
+
+    def delete_blob(self, **kwargs):
+        with _timed("blob"):
+            self.service.blobs.pop(self._key, None)
+
+
+class MemoryContainer:
+    def __init__(self, service, name):
+        self.service = service
+        self.container_name = name
+
+    def create_container(self, **kwargs):
+        if self.container_name in self.service.containers:
+            raise ResourceExistsError(self.container_name)
+        self.service.containers.add(self.container_name)
+
+    def get_blob_client(self, blob):
+        return MemoryBlob(self.service, self.container_name, blob)
+
+    def upload_blob(self, name, data, overwrite=False, **kwargs):
+        MemoryBlob(self.service, self.container_name, name).upload_blob(data, overwrite=overwrite, **kwargs)
+
+    def download_blob(self, name, **kwargs):
+        return MemoryBlob(self.service, self.container_name, name).download_blob(**kwargs)
+
+    def delete_blob(self, name, **kwargs):
+        MemoryBlob(self.service, self.container_name, name).delete_blob()
+
+    def list_blobs(self, name_starts_with=None, **kwargs):
+        for (container, name), (data, metadata, content_settings, last_modified) in list(self.service.blobs.items()):
+            if container == self.container_name and (not name_starts_with or name.startswith(name_starts_with)):
+                yield _Properties(name, data, metadata, content_settings, last_modified)
+
+
+#The aio versions share the same blobs dict so the sync and async sides of the app see the same storage.
+
+class AsyncMemoryBlobService(MemoryBlobService):
+    def get_blob_client(self, container, blob):
+        return AsyncMemoryBlob(self, container, blob)
+
+    def get_container_client(self, container):
+        return AsyncMemoryContainer(self, container)
+
+    async def close(self):
+        pass
+
+
+class AsyncMemoryBlob(MemoryBlob):
+    async def upload_blob(self, data, **kwargs):
+        MemoryBlob.upload_blob(self, data, **kwargs)
+
+    async def stage_block(self, block_id, data, **kwargs):
+        MemoryBlob.stage_block(self, block_id, data, **kwargs)
+
+    async def commit_block_list(self, block_list, **kwargs):
+        MemoryBlob.commit_block_list(self, block_list, **kwargs)
+
+    async def download_blob(self, **kwargs):
+        downloader = MemoryBlob.download_blob(self, **kwargs)
+        return _AsyncDownloader(downloader.readall(), downloader.properties)
+
+    async def get_blob_properties(self, **kwargs):
+        return MemoryBlob.get_blob_properties(self, **kwargs)
+
+    async def exists(self, **kwargs):
+        return MemoryBlob.exists(self)
+
+    async def delete_blob(self, **kwargs):
+        MemoryBlob.delete_blob(self)
+
+
+class AsyncMemoryContainer(MemoryContainer):
+    async def create_container(self, **kwargs):
+        MemoryContainer.create_container(self)
+
+    def get_blob_client(self, blob):
+        return AsyncMemoryBlob(self.service, self.container_name, blob)
+
+    async def upload_blob(self, name, data, overwrite=False, **kwargs):
+        await AsyncMemoryBlob(self.service, self.container_name, name).upload_blob(data, overwrite=overwrite, **kwargs)
+
+    async def download_blob(self, name, **kwargs):
+        return await AsyncMemoryBlob(self.service, self.container_name, name).download_blob(**kwargs)
+
+    async def delete_blob(self, name, **kwargs):
+        await AsyncMemoryBlob(self.service, self.container_name, name).delete_blob()
+
+    async def _list(self, name_starts_with=None):
+        for blob in MemoryContainer.list_blobs(self, name_starts_with):
+            yield blob
+
+    def list_blobs(self, name_starts_with=None, **kwargs):
+        return self._list(name_starts_with)
+
+
+#Azure OpenAI
+
+class _Message:
+    def __init__(self, content):
+        self.content = content
+
+
+class _Choice:
+    def __init__(self, content):
+        self.message = _Message(content)
+
+
+class _Completion:
+    def __init__(self, content):
+        self.choices = [_Choice(content)]
+
+
+class _Delta:
+    def __init__(self, content):
+        self.content = content
+
+
+class _StreamChoice:
+    def __init__(self, content, finish_reason=None):
+        self.delta = _Delta(content)
+        self.finish_reason = finish_reason
+
+
+class _StreamChunk:
+    def __init__(self, choices):
+        self.choices = choices
+
+
+class _Stream:
+    """stream=True answer: latency seconds before the first word, then tokens_per_second words a second."""
+
+    def __init__(self, text, latency, tokens_per_second):
+        self._words = text.split(' ')
+        self._latency = latency
+        self._tokens_per_second = tokens_per_second
+        self.closed = False
+
+    async def _chunks(self):
+        started = time.perf_counter()
+        try:
+            #Like Azure, the first chunk only has the content filter results and no choices.
+            yield _StreamChunk([])
+            await asyncio.sleep(self._latency)
+            for i, word in enumerate(self._words):
+                if self._tokens_per_second and i:
+                    await asyncio.sleep(1 / self._tokens_per_second)
+                yield _StreamChunk([_StreamChoice(word if i == 0 else ' ' + word)])
+            yield _StreamChunk([_StreamChoice(None, "stop")])
+        finally:
+            stage_seconds["openai"] += time.perf_counter() - started
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def close(self):
+        self.closed = True
+
+
+class _Completions:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        prompt_length = sum(len(message["content"]) for message in messages)
+        stage_calls["openai"] += 1
+        self._owner.check_quota()
+        self._owner.prompt_chars.append(prompt_length)
+        answer = f"Stand-in analysis of a {prompt_length} character prompt."
+        if stream:
+            return _Stream(answer, self._owner.latency, self._owner.tokens_per_second)
+        started = time.perf_counter()
+        await asyncio.sleep(self._owner.latency)
+        stage_seconds["openai"] += time.perf_counter() - started
+        return _Completion(answer)
+
+
+class _Chat:
+    def __init__(self, owner):
+        self.completions = _Completions(owner)
+
+
+class _Response:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class FakeRateLimitError(Exception):
+    """Looks like openai.RateLimitError: status_code 429 and a Retry-After header."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Error code: 429 - rate limit exceeded, retry after {retry_after:.1f}s")
+        self.status_code = 429
+        self.response = _Response({"retry-after": f"{retry_after:.3f}"})
+
+
+class FakeOpenAI:
+    """AsyncAzureOpenAI look-alike. Every completion waits latency seconds, then answers.
+
+    Streamed answers then send tokens_per_second words a second (0 for all at once).
+    With rpm set, more than rpm / 6 requests in any 10 seconds get a 429, the way Azure enforces a deployment's quota.
+    """
+
+    def __init__(self, latency: float = 0.5, tokens_per_second: float = 0, rpm: int = None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.rpm = rpm
+        self.prompt_chars = []
+        self.request_times = []
+        self.rate_limited = 0
+        self.chat = _Chat(self)
+
+    def check_quota(self):
+        if not self.rpm:
+            return
+        now = time.monotonic()
+        self.request_times = [sent for sent in self.request_times if now - sent < 10]
+        if len(self.request_times) >= max(self.rpm // 6, 1):
+            self.rate_limited += 1
+            raise FakeRateLimitError(10 - (now - self.request_times[0]))
+        self.request_times.append(now)
+
+    async def close(self):
+        pass
+
+
+#Email
+
+class _Poller:
+    async def result(self):
+        return {"status": "Succeeded"}
+
+
+class NullEmail:
+    """Async EmailClient look-alike that keeps the messages instead of sending them."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def begin_send(self, message, **kwargs):
+        with _timed("email"):
+            self.sent.append(message)
+            return _Poller()
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+#Azure Functions bindings
+
+class FakeTimer:
+    past_due = False
+
+
+class _RetryContext:
+    retry_count = 0
+    max_retry_count = 5
+
+
+class FakeContext:
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.retry_context = _RetryContext()
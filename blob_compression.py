@@ -0,0 +1,171 @@
+import os
+import zlib
+import logging
+
+#This file compresses the text blobs in the results and smoketests containers on the way in and decompresses them on the way out.
+#The blob's Content-Encoding says how it was compressed ('gzip' or 'zstd'). A blob with no Content-Encoding is read as is,
+#so every snapshot and smoketest file written before this still reads fine.
+#
+#Every staged block is compressed on its own into a complete gzip member (or zstd frame). Gluing whole members together is
+#still a valid gzip file, so blocks can be compressed in any order or on any thread (the parallel export) and the result
+#is the same as compressing them one after the other.
+#.vsnap and .vidx files are already zlib compressed inside, so they're stored as they are.
+#To compare the codecs on real looking data run: python benchmarks/compression_bench.py
+
+#'gzip', 'zstd' (needs the zstandard package, falls back to gzip without it) or 'none'.
+BLOB_COMPRESSION = os.getenv('BLOB_COMPRESSION', 'gzip')
+#gzip 1-9 or zstd 1-22. Higher is smaller and slower. On the snapshot text gzip 1 gets ~2.4x at ~60 MB/s,
+#gzip 6 only gets to ~2.8x and takes 8 times longer, so the export sticks with 1.
+BLOB_COMPRESSION_LEVEL = int(os.getenv('BLOB_COMPRESSION_LEVEL', '1'))
+#Files that already have their own compression.
+ALREADY_COMPRESSED = (".vsnap", ".vidx")
+
+_zstd = None
+
+
+def _get_zstd():
+    #zstandard is optional and only imported the first time it's needed.
+    global _zstd
+    if _zstd is None:
+        try:
+            import zstandard
+            _zstd = zstandard
+        except ImportError:
+            _zstd = False
+    return _zstd or None
+
+
+def pick_codec(codec: str = BLOB_COMPRESSION):
+    """The Content-Encoding to write with: 'gzip', 'zstd' or None for no compression."""
+    if not codec or codec == 'none':
+        return None
+    if codec == 'zstd':
+        if _get_zstd() is not None:
+            return 'zstd'
+        logging.warning("BLOB_COMPRESSION is zstd but the zstandard package isn't installed, using gzip")
+    return 'gzip'
+
+
+def codec_for(blobname: str, codec: str = BLOB_COMPRESSION):
+    #Compressing an already compressed file only costs CPU.
+    if blobname.endswith(ALREADY_COMPRESSED):
+        return None
+    return pick_codec(codec)
+
+
+def compress_block(data: bytes, codec: str, level: int = BLOB_COMPRESSION_LEVEL) -> bytes:
+    """data as one complete gzip member or zstd frame."""
+    if codec == 'zstd':
+        return _get_zstd().ZstdCompressor(level=level).compress(data)
+    #wbits 31 is zlib's way of asking for a gzip header and trailer.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _Decompressor:
+    #Turns a stream of compressed chunks back into the original bytes, one chunk at a time.
+    #Handles any number of gzip members or zstd frames one after the other.
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self._new()
+
+    def _new(self):
+        if self.encoding == 'zstd':
+            self._decompressor = _get_zstd().ZstdDecompressor().decompressobj()
+        else:
+            self._decompressor = zlib.decompressobj(31)
+
+    def feed(self, chunk: bytes) -> bytes:
+        out = []
+        while chunk:
+            out.append(self._decompressor.decompress(chunk))
+            #Whatever is left after the end of one member is the start of the next.
+            chunk = self._decompressor.unused_data if self._decompressor.eof else b''
+            if self._decompressor.eof:
+                self._new()
+        return b''.join(out)
+
+
+def _check_encoding(encoding):
+    if encoding not in (None, '', 'identity', 'gzip', 'zstd'):
+        raise ValueError(f"Don't know how to read a blob with Content-Encoding {encoding}")
+    if encoding == 'zstd' and _get_zstd() is None:
+        raise ValueError("This blob is zstd compressed but the zstandard package isn't installed")
+    return encoding if encoding in ('gzip', 'zstd') else None
+
+
+def decompress_chunks(chunks, encoding):
+    encoding = _check_encoding(encoding)
+    if encoding is None:
+        yield from chunks
+        return
+    decompressor = _Decompressor(encoding)
+    for chunk in chunks:
+        data = decompressor.feed(chunk)
+        if data:
+            yield data
+
+
+async def decompress_chunks_async(chunks, encoding):
+    encoding = _check_encoding(encoding)
+    decompressor = _Decompressor(encoding) if encoding else None
+    async for chunk in chunks:
+        data = decompressor.feed(chunk) if decompressor else chunk
+        if data:
+            yield data
+
+
+def content_settings(codec, content_type: str = None):
+    # azure.storage.blob is slow to import, so only when something is actually being written. See benchmarks/import_time.py
+    from azure.storage.blob import ContentSettings
+    return ContentSettings(content_encoding=codec, content_type=content_type)
+
+
+def _encoding_of(downloader):
+    return downloader.properties.content_settings.content_encoding
+
+
+#decompress=False stops the HTTP library quietly un-gzipping the download itself, so what comes back is always
+#the stored bytes and the decompressing happens here (which also covers zstd, which the HTTP libraries don't know).
+
+def download_chunks(blob_client):
+    """The blob's original bytes as a stream of chunks, decompressed if it was stored compressed."""
+    downloader = blob_client.download_blob(decompress=False)
+    return decompress_chunks(downloader.chunks(), _encoding_of(downloader))
+
+
+def download_bytes(blob_client) -> bytes:
+    return b''.join(download_chunks(blob_client))
+
+
+async def open_download_async(blob_client):
+    """Start downloading with the aio client. Returns (async stream of decompressed chunks, bytes stored)."""
+    downloader = await blob_client.download_blob(decompress=False)
+    return decompress_chunks_async(downloader.chunks(), _encoding_of(downloader)), downloader.size
+
+
+async def download_bytes_async(blob_client) -> bytes:
+    chunks, _ = await open_download_async(blob_client)
+    return b''.join([data async for data in chunks])
+
+
+def _prepare(blob_client, data, codec):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    codec = codec_for(blob_client.blob_name, codec)
+    return (compress_block(data, codec) if codec else data), codec
+
+
+def upload_compressed(blob_client, data, overwrite: bool = False, codec: str = BLOB_COMPRESSION,
+                      content_type: str = None) -> int:
+    """upload_blob, compressed with codec unless it's a .vsnap/.vidx. Returns the bytes actually stored."""
+    data, codec = _prepare(blob_client, data, codec)
+    blob_client.upload_blob(data, overwrite=overwrite, content_settings=content_settings(codec, content_type))
+    return len(data)
+
+
+async def upload_compressed_async(blob_client, data, overwrite: bool = False, codec: str = BLOB_COMPRESSION,
+                                  content_type: str = None) -> int:
+    data, codec = _prepare(blob_client, data, codec)
+    await blob_client.upload_blob(data, overwrite=overwrite, content_settings=content_settings(codec, content_type))
+    return len(data)
@@ -0,0 +1,183 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from prompt_builder import count_tokens
+from llm_stream import stream_completion, format_metrics
+
+#This file runs a batch of chat prompts (personas x questions from prompt_templates.py) concurrently on an async OpenAI client,
+#as fast as the deployment's quota allows and no faster.
+#   - a semaphore caps how many requests are in flight at once (CHAT_BATCH_CONCURRENCY)
+#   - two token buckets keep under the requests per minute and tokens per minute limits (CHAT_RPM, CHAT_TPM).
+#     Each request is charged its prompt tokens plus max_tokens up front, and the unused part is handed back once it finishes.
+#   - a 429 pauses every request for as long as the service asks (Retry-After), then that request is retried with
+#     exponential backoff and jitter, up to CHAT_MAX_ATTEMPTS times
+#The results are collected into one digest. To see the throughput against a pretend quota run: python benchmarks/chat_batch_bench.py
+
+#How many requests can be waiting on the model at once.
+CHAT_BATCH_CONCURRENCY = int(os.getenv('CHAT_BATCH_CONCURRENCY', '8'))
+#The deployment's quota, from the Azure OpenAI portal. The defaults are a 10K TPM deployment.
+CHAT_RPM = int(os.getenv('CHAT_RPM', '60'))
+CHAT_TPM = int(os.getenv('CHAT_TPM', '10000'))
+#The most tokens one answer can use. Counted against CHAT_TPM before the request goes out.
+CHAT_MAX_TOKENS = int(os.getenv('CHAT_MAX_TOKENS', '400'))
+#Attempts per prompt, and the first backoff after a 429 or a dropped connection (doubled every attempt).
+CHAT_MAX_ATTEMPTS = int(os.getenv('CHAT_MAX_ATTEMPTS', '5'))
+CHAT_BACKOFF_SECONDS = float(os.getenv('CHAT_BACKOFF_SECONDS', '2'))
+
+
+class TokenBucket:
+    """Holds up to capacity tokens and refills at rate_per_minute. acquire waits until there are enough."""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60
+        #Azure OpenAI checks the quota over windows of about 10 seconds rather than the whole minute,
+        #so by default the bucket only holds 10 seconds' worth. A batch can start with a burst but not a minute's worth at once.
+        self.capacity = capacity if capacity is not None else max(rate_per_minute / 6, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        #How long until amount tokens are available. Asking for more than the capacity waits for a full bucket (and then overdraws it).
+        self._refill()
+        missing = min(amount, self.capacity) - self._tokens
+        return max(missing / self.rate, 0) if self.rate > 0 else 0
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self._tokens -= amount
+
+    def give_back(self, amount: float) -> None:
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+    def drain(self) -> None:
+        self._refill()
+        self._tokens = min(self._tokens, 0)
+
+
+class RateLimiter:
+    """The requests and tokens per minute buckets, plus a shared pause after a 429."""
+
+    def __init__(self, rpm: int = CHAT_RPM, tpm: int = CHAT_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._paused_until = 0.0
+        #Only one request at a time works out whether it can go, so two can't both take the last of the bucket.
+        self._lock = asyncio.Lock()
+        self.waited = 0.0
+
+    async def acquire(self, tokens: int) -> None:
+        async with self._lock:
+            while True:
+                wait = max(self._paused_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    break
+                self.waited += wait
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def settle(self, charged: int, used: int) -> None:
+        #Hand back the tokens a request was charged for but didn't use.
+        if used < charged:
+            self.tokens.give_back(charged - used)
+
+    def pause(self, seconds: float) -> None:
+        #The service said slow down, so nobody goes until it's had its break and the buckets start again from empty.
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.requests.drain()
+        self.tokens.drain()
+
+
+def retry_after(error: Exception):
+    """Seconds the service asked to wait in a 429, or None if it didn't say."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    #429 (quota) and 5xx from the service, or the connection dropping. Matched by status rather than importing openai's classes.
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+async def run_job(client, model: str, job: dict, limiter: RateLimiter, semaphore: asyncio.Semaphore,
+                  max_tokens: int = CHAT_MAX_TOKENS, max_attempts: int = CHAT_MAX_ATTEMPTS) -> dict:
+    """Run one {"persona", "question", "messages"} job. Returns it with text, metrics, attempts and error added."""
+    prompt_tokens = sum(count_tokens(message["content"]) for message in job["messages"])
+    charged = prompt_tokens + max_tokens
+    result = dict(job, text=None, metrics=None, attempts=0, error=None)
+    for attempt in range(1, max_attempts + 1):
+        result["attempts"] = attempt
+        try:
+            #The slot is taken first so tokens are only charged for a request that's about to go out.
+            async with semaphore:
+                await limiter.acquire(charged)
+                text, metrics = await stream_completion(client, model, job["messages"], max_tokens=max_tokens)
+            limiter.settle(charged, prompt_tokens + metrics["tokens"])
+            result.update(text=text, metrics=metrics, error=None)
+            return result
+        except Exception as e:
+            result["error"] = str(e)
+            if not is_retryable(e) or attempt == max_attempts:
+                logging.error(f"{job['persona']}/{job['question']} failed after {attempt} attempts: {e}")
+                return result
+            #Full jitter so the retries don't all land at the same moment again.
+            backoff = random.uniform(0, CHAT_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            asked = retry_after(e)
+            if getattr(e, "status_code", None) == 429:
+                limiter.pause(asked if asked is not None else backoff)
+            logging.warning(f"{job['persona']}/{job['question']} attempt {attempt} failed ({e}), retrying in {max(backoff, asked or 0):.1f}s")
+            await asyncio.sleep(max(backoff, asked or 0))
+    return result
+
+
+async def run_batch(client, model: str, jobs: list, concurrency: int = CHAT_BATCH_CONCURRENCY, rpm: int = CHAT_RPM,
+                    tpm: int = CHAT_TPM, max_tokens: int = CHAT_MAX_TOKENS) -> dict:
+    """Run every job concurrently within the rate limits. Returns {"results": [...] in job order, "seconds", "waited"}."""
+    #The runner does its own 429 handling, so the client's built in retries are turned off where the client allows it.
+    if hasattr(client, "with_options"):
+        client = client.with_options(max_retries=0)
+    limiter = RateLimiter(rpm, tpm)
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+    results = await asyncio.gather(*(run_job(client, model, job, limiter, semaphore, max_tokens) for job in jobs))
+    return {"results": list(results), "seconds": time.monotonic() - started, "waited": limiter.waited}
+
+
+def format_digest(batch: dict) -> str:
+    """Every answer grouped by persona, with a line at the top saying how the batch went."""
+    results = batch["results"]
+    answered = sum(1 for result in results if result["text"])
+    retries = sum(result["attempts"] - 1 for result in results)
+    lines = [f"{answered} of {len(results)} prompts answered in {batch['seconds']:.1f}s "
+             f"({retries} retries, {batch['waited']:.1f}s spent waiting on the rate limit)"]
+    for persona in dict.fromkeys(result["persona"] for result in results):
+        lines.append(f"\n=== {persona} ===")
+        for result in results:
+            if result["persona"] != persona:
+                continue
+            question = result["messages"][-1]["content"].strip()
+            lines.append(f"\nQ ({result['question']}): {question}")
+            if result["text"]:
+                lines.append(f"A: {result['text']}")
+                lines.append(f"   [{format_metrics(result['metrics'])}]")
+            else:
+                lines.append(f"A: no answer ({result['error']})")
+    return '\n'.join(lines)
@@ -0,0 +1,121 @@
+import math
+import time
+import asyncio
+import inspect
+import logging
+import threading
+
+#This file keeps one of each client (Blob, OpenAI, Email) per worker process instead of building new ones every invocation.
+#A client that's reused keeps its HTTP connection pool, so the TLS handshake only happens the first time.
+#Each client is only created the first time something asks for it. Nothing checks a client is still healthy before
+#handing it out. It's only rebuilt after a call on it has already failed with one of the errors it was registered with
+#(connection resets, timeouts and the like): report_error throws it away and the next get builds a fresh one.
+#The SQL side leans on ODBC connection pooling instead, see connect_sql.
+
+
+class ClientPool:
+    def __init__(self):
+        self._factories = {}
+        self._rebuild_on = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def register(self, name: str, factory, rebuild_on=(Exception,)) -> None:
+        """Tell the pool how to build the client called name.
+
+        factory takes no arguments and returns a new client. rebuild_on is the
+        exception types that mean the client is broken and should be rebuilt,
+        or a function returning them, so the SDK that defines them only gets
+        imported once the client is actually in use.
+        """
+        self._factories[name] = factory
+        self._rebuild_on[name] = rebuild_on
+        self.stats.setdefault(name, {"created": 0, "reused": 0, "rebuilt": 0})
+
+    def get(self, name: str):
+        #Locked because dbqueryandsave is sync and can run on more than one thread at a time.
+        with self._lock:
+            client = self._clients.get(name)
+            if client is not None:
+                self.stats[name]["reused"] += 1
+                return client
+            client = self._factories[name]()
+            self._clients[name] = client
+            self.stats[name]["created"] += 1
+            return client
+
+    def report_error(self, name: str, error: Exception) -> None:
+        #Only errors that mean the connection itself is bad get the client rebuilt. A missing blob is not the client's fault.
+        if name not in self._clients:
+            return
+        rebuild_on = self._rebuild_on.get(name, ())
+        if callable(rebuild_on):
+            rebuild_on = rebuild_on()
+        if isinstance(error, rebuild_on):
+            logging.warning(f'Rebuilding the {name} client after {type(error).__name__}: {error}')
+            self.invalidate(name)
+
+    def invalidate(self, name: str) -> None:
+        with self._lock:
+            client = self._clients.pop(name, None)
+            if client is None:
+                return
+            self.stats[name]["rebuilt"] += 1
+        close = getattr(client, "close", None)
+        if close is None:
+            return
+        try:
+            result = close()
+            #The aio clients close asynchronously, so hand that off to the event loop that's running.
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result)
+        except Exception as e:
+            logging.info(f'Could not close the old {name} client: {e}')
+
+    def format_stats(self) -> str:
+        lines = []
+        for name, counts in self.stats.items():
+            uses = counts["created"] + counts["reused"]
+            rate = counts["reused"] / uses * 100 if uses else 0
+            lines.append(f"{name}: {counts['reused']} reused / {counts['created']} new "
+                         f"({rate:.0f}% reuse, {counts['rebuilt']} rebuilt)")
+        #pyodbc doesn't say whether a connect came out of the ODBC pool, so for SQL there's only the time it took.
+        if sql_stats["connects"]:
+            lines.append(f"sql: {sql_stats['connects']} connects, "
+                         f"avg {sql_stats['seconds'] / sql_stats['connects'] * 1000:.1f} ms")
+        return '\n'.join(lines)
+
+
+#One per worker process. function_app.py registers its clients on this.
+clients = ClientPool()
+
+sql_stats = {"connects": 0, "seconds": 0.0}
+#The parallel export connects from several threads at once.
+_sql_stats_lock = threading.Lock()
+
+
+def connect_sql(pyodbc, conn_str: str, timeout: float = None):
+    """Open a SQL connection and record how long it took in sql_stats.
+
+    pyodbc leaves ODBC connection pooling on unless something turns it off,
+    so conn.close() hands the connection back to the driver manager and the
+    next connect on this worker can skip the login and TLS handshake. Neither
+    pyodbc nor the driver says whether a connect was pooled, so sql_stats can
+    only count connects and their time, not a reuse rate like the other
+    clients get.
+    With a timeout (seconds) both the login and every query on the connection
+    give up after that long, otherwise they wait as long as the driver does.
+    """
+    started = time.perf_counter()
+    if timeout is None:
+        conn = pyodbc.connect(conn_str)
+    else:
+        #Both are whole seconds and 0 means wait forever, so anything left rounds up to at least 1.
+        seconds = max(math.ceil(timeout), 1)
+        conn = pyodbc.connect(conn_str, timeout=seconds)
+        conn.timeout = seconds
+    with _sql_stats_lock:
+        sql_stats["connects"] += 1
+        sql_stats["seconds"] += time.perf_counter() - started
+    return conn
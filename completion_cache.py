@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+#This file caches what the AI said about a prompt so a retry or re-run with the same snapshots doesn't pay for the model again.
+#Entries are keyed by a sha256 of the deployment, api_version, prompt template version and the messages that were sent.
+#There are two layers:
+#   1. an LRU dict in this worker's memory, checked first and answered in microseconds
+#   2. a blob per entry in the LLM_CACHE_CONTAINER container, which survives the worker being recycled
+#Both layers drop entries older than LLM_CACHE_TTL_SECONDS, and both have a size cap with the oldest entries going first.
+
+LLM_CACHE_CONTAINER = os.getenv('LLM_CACHE_CONTAINER', 'llmcache')
+#How long a cached answer stays valid. A week by default, same as the analysis cadence.
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', str(7 * 24 * 60 * 60)))
+#Caps for the in-memory layer.
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '128'))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+#Cap for the blob layer. Once there are more blobs than this the oldest ones get deleted.
+LLM_CACHE_MAX_BLOBS = int(os.getenv('LLM_CACHE_MAX_BLOBS', '500'))
+
+
+def cache_key(deployment: str, api_version: str, template_version: str, messages: list) -> str:
+    #sort_keys so the same messages always hash the same no matter how the dicts were built.
+    payload = json.dumps({
+        "deployment": deployment,
+        "api_version": api_version,
+        "template_version": template_version,
+        "messages": messages,
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """In-memory least recently used cache with a TTL and entry and byte limits."""
+
+    def __init__(self, max_entries: int = LLM_CACHE_MAX_ENTRIES, max_bytes: int = LLM_CACHE_MAX_BYTES,
+                 ttl_seconds: int = LLM_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if time.time() - created > self.ttl_seconds:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: str, created: float = None) -> None:
+        if key in self._entries:
+            self._remove(key)
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (created or time.time(), value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value.encode('utf-8'))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+#One per worker process, so every invocation the worker handles shares it.
+memory_cache = LRUCache()
+
+
+#The blob side uses the azure.storage.blob.aio clients so analyse_visits doesn't block the event loop while it checks the cache.
+async def get_cache_container(blob_service_client):
+    container_client = blob_service_client.get_container_client(LLM_CACHE_CONTAINER)
+    try:
+        await container_client.create_container()
+    except ResourceExistsError:
+        pass
+    return container_client
+
+
+async def lookup(container_client, key: str):
+    """Return the cached response for key, or None. Checks memory first, then the blob."""
+    value = memory_cache.get(key)
+    if value is not None:
+        logging.warning(f'LLM cache hit in memory for {key[:12]}')
+        return value
+    try:
+        downloader = await container_client.download_blob(f"{key}.json")
+        entry = json.loads((await downloader.readall()).decode('utf-8'))
+    except ResourceNotFoundError:
+        return None
+    if time.time() - entry["created"] > LLM_CACHE_TTL_SECONDS:
+        logging.info(f'LLM cache entry {key[:12]} has expired')
+        return None
+    memory_cache.put(key, entry["response"], entry["created"])
+    logging.warning(f'LLM cache hit in blob storage for {key[:12]}')
+    return entry["response"]
+
+
+async def store(container_client, key: str, response: str) -> None:
+    created = time.time()
+    memory_cache.put(key, response, created)
+    await container_client.upload_blob(f"{key}.json", json.dumps({"created": created, "response": response}), overwrite=True)
+    await prune(container_client)
+
+
+async def prune(container_client) -> None:
+    #Deletes expired blobs, then the oldest ones if there are still more than LLM_CACHE_MAX_BLOBS.
+    now = time.time()
+    blobs = sorted([blob async for blob in container_client.list_blobs()], key=lambda blob: blob.last_modified)
+    keep = []
+    for blob in blobs:
+        if now - blob.last_modified.timestamp() > LLM_CACHE_TTL_SECONDS:
+            await container_client.delete_blob(blob.name)
+        else:
+            keep.append(blob)
+    for blob in keep[:max(len(keep) - LLM_CACHE_MAX_BLOBS, 0)]:
+        await container_client.delete_blob(blob.name)
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+#This file is the email outbox. analyse_visits used to send the email itself and then wait for Azure Communication Services
+#to say it was delivered. Now it just writes the message to a blob in the outbox container and finishes,
+#and the send_outbox timer function in function_app.py sends whatever is waiting.
+#
+#   outbox/pending/{id}.json    waiting to be sent, or waiting to be retried
+#   outbox/sent/{id}.json       delivered, with the result from Communication Services
+#   outbox/failed/{id}.json     gave up after OUTBOX_MAX_ATTEMPTS
+#
+#Each blob is {"id", "created", "attempts", "message", "last_error"}. When a pending message can next be tried
+#is kept in the blob's metadata, so working out what's due is one list call with no downloads.
+#Every send uses "{id}-{attempt}" as the operation id. If the sender dies after sending but before it recorded that,
+#the next run sends with the same operation id and Communication Services treats it as the same email rather than a second one.
+
+OUTBOX_CONTAINER = os.getenv('OUTBOX_CONTAINER', 'outbox')
+#How many messages one run of send_outbox sends at the same time.
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '10'))
+#How long to wait for Communication Services to finish delivering before leaving it for the next run.
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '60'))
+#Failed sends are retried with a backoff of OUTBOX_RETRY_SECONDS, doubling every attempt, up to this many attempts.
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_RETRY_SECONDS = int(os.getenv('OUTBOX_RETRY_SECONDS', '120'))
+
+
+async def get_outbox_container(blob_service_client):
+    container_client = blob_service_client.get_container_client(OUTBOX_CONTAINER)
+    try:
+        await container_client.create_container()
+    except ResourceExistsError:
+        pass
+    return container_client
+
+
+async def _save(container_client, folder: str, entry: dict, next_attempt: float = 0) -> None:
+    await container_client.upload_blob(f"{folder}/{entry['id']}.json", json.dumps(entry), overwrite=True,
+                                       metadata={"next_attempt": str(int(next_attempt))})
+
+
+async def enqueue_email(blob_service_client, message: dict) -> str:
+    """Put message (the dict EmailClient.begin_send takes) in the outbox. Returns the blob it was saved as."""
+    container_client = await get_outbox_container(blob_service_client)
+    entry = {"id": uuid.uuid4().hex, "created": time.time(), "attempts": 0, "message": message, "last_error": None}
+    await _save(container_client, "pending", entry)
+    return f"{OUTBOX_CONTAINER}/pending/{entry['id']}.json"
+
+
+async def _send_one(container_client, email_client, name: str) -> str:
+    #Returns 'sent', 'retry', 'failed' or 'waiting' (still being delivered, checked again next run).
+    downloader = await container_client.download_blob(name)
+    entry = json.loads((await downloader.readall()).decode('utf-8'))
+    operation_id = f"{entry['id']}-{entry['attempts']}"
+    try:
+        poller = await email_client.begin_send(entry["message"], operation_id=operation_id)
+        result = await asyncio.wait_for(poller.result(), OUTBOX_POLL_SECONDS)
+        status = (result or {}).get("status")
+        if status != "Succeeded":
+            raise RuntimeError(f"Communication Services says {status}: {(result or {}).get('error')}")
+    except asyncio.TimeoutError:
+        #Not an error, it just hasn't finished. Same operation id next time so it isn't sent twice.
+        logging.warning(f"Email {entry['id']} still being delivered after {OUTBOX_POLL_SECONDS}s, checking again next run")
+        return "waiting"
+    except Exception as e:
+        entry["attempts"] += 1
+        entry["last_error"] = str(e)
+        if entry["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            logging.error(f"Giving up on email {entry['id']} after {entry['attempts']} attempts: {e}")
+            await _save(container_client, "failed", entry)
+            await container_client.delete_blob(name)
+            return "failed"
+        backoff = OUTBOX_RETRY_SECONDS * 2 ** (entry["attempts"] - 1)
+        logging.error(f"Email {entry['id']} failed (attempt {entry['attempts']}), retrying in {backoff}s: {e}")
+        await _save(container_client, "pending", entry, next_attempt=time.time() + backoff)
+        return "retry"
+    entry["sent"] = time.time()
+    entry["result"] = result
+    await _save(container_client, "sent", entry)
+    await container_client.delete_blob(name)
+    return "sent"
+
+
+async def send_pending(blob_service_client, email_client, batch_size: int = OUTBOX_BATCH_SIZE) -> dict:
+    """Send up to batch_size due messages from the outbox at once. Returns how many ended up in each state."""
+    container_client = await get_outbox_container(blob_service_client)
+    now = time.time()
+    due = []
+    async for blob in container_client.list_blobs(name_starts_with="pending/", include=["metadata"]):
+        if float((blob.metadata or {}).get("next_attempt", 0)) <= now:
+            due.append(blob)
+    #Oldest first so a backlog drains in order.
+    due = sorted(due, key=lambda blob: blob.last_modified)[:batch_size]
+    outcomes = {"sent": 0, "retry": 0, "failed": 0, "waiting": 0}
+    if not due:
+        return outcomes
+    results = await asyncio.gather(*(_send_one(container_client, email_client, blob.name) for blob in due),
+                                   return_exceptions=True)
+    for blob, result in zip(due, results):
+        if isinstance(result, ResourceNotFoundError):
+            #Another run already sent it and cleaned up.
+            continue
+        if isinstance(result, Exception):
+            logging.error(f"Could not process {blob.name}: {result}")
+            outcomes["retry"] += 1
+        else:
+            outcomes[result] += 1
+    return outcomes
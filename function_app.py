@@ -1,15 +1,73 @@
 import os
-import pyodbc
-from azure.storage.blob import BlobClient, BlobServiceClient
+import asyncio
 import datetime
-from openai import AzureOpenAI
 import logging
 import azure.functions as func
-from azure.core.exceptions import ResourceNotFoundError
-from azure.communication.email import EmailClient
+from azure.core.exceptions import ResourceNotFoundError, ServiceRequestError, ServiceResponseError
+from snapshot_format import SNAPSHOT_EXTENSION, read_snapshot_async, parse_text_snapshot, apply_deltas
+from visitor_diff import diff_snapshots, format_diff
+from prompt_builder import PROMPT_TEMPLATE_VERSION, PROMPT_TOP_N, build_prompt, format_report
+from completion_cache import cache_key, get_cache_container, lookup, store
+from visitor_export import (EXPORT_MODE, EXPORT_VERIFY_MODE, EXPORT_PARTITIONS, export_full, export_incremental, export_parallel,
+                            verify_upload, iter_export_groups, save_watermark)
+from run_checkpoint import RunCheckpoint
+from client_pool import clients, connect_sql
+from visit_index import PeriodBuilder, load_stored_index, save_stored_index, update_visit_index, load_visit_index_async
+from visitor_anomalies import detect_anomalies, anomaly_sections, format_anomalies
+from ip_enrichment import get_ip_index, aggregate_diff, annotate, network_sections
+from stage_timing import StageTimings
+from visitor_stats import STATS_MAX_LIMIT, stats_cache, top_visitors, ip_history, period_diff
+from visit_ingest import VisitBuffer, upsert_visits
+from visitor_summary import export_aggregate
+from snapshot_catalog import parse_snapshot_name, record_snapshot, load_catalog_async, resolve_pair, describe_view
+from llm_stream import stream_completion, format_metrics
+from email_outbox import enqueue_email, send_pending
+from blob_compression import upload_compressed, open_download_async, download_bytes_async
+from prompt_templates import batch_jobs
+from chat_batch import run_batch, format_digest
+# pyodbc, openai, azure.storage.blob and azure.communication.email are imported where they're used instead of up here.
+# They're slow to import and each trigger only needs some of them, so a cold start only pays for what it runs.
+# To see what importing this file costs run: python benchmarks/import_time.py
 
 app = func.FunctionApp()
 
+# The Azure OpenAI deployment I send prompts to and the API version I talk to it with.
+OPENAI_DEPLOYMENT = "BrandonAI"
+OPENAI_API_VERSION = "2024-02-01"
+
+# Shared clients. Each one is built the first time it's needed and then reused by every invocation on this worker,
+# so the HTTP connection pools stay warm. If a call fails because the connection itself broke, the client gets rebuilt. See client_pool.py
+AZURE_CONNECTION_ERRORS = (ServiceRequestError, ServiceResponseError)
+
+def make_blob_client():
+    from azure.storage.blob import BlobServiceClient
+    return BlobServiceClient.from_connection_string(os.getenv('AzureWebJobsStorage'))
+
+def make_async_blob_client():
+    from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+    return AsyncBlobServiceClient.from_connection_string(os.environ.get('BLOB_KEY'))
+
+def make_openai_client():
+    from openai import AsyncAzureOpenAI
+    return AsyncAzureOpenAI(
+        api_key = os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version = OPENAI_API_VERSION,
+        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT"))
+
+def openai_connection_errors():
+    # Only looked up once the openai client has been built, so openai is already imported by then
+    from openai import APIConnectionError
+    return (APIConnectionError,)
+
+def make_email_client():
+    from azure.communication.email.aio import EmailClient as AsyncEmailClient
+    return AsyncEmailClient.from_connection_string(os.environ.get('EMAIL_KEY'))
+
+clients.register("blob", make_blob_client, rebuild_on=AZURE_CONNECTION_ERRORS)
+clients.register("blob_aio", make_async_blob_client, rebuild_on=AZURE_CONNECTION_ERRORS)
+clients.register("openai", make_openai_client, rebuild_on=openai_connection_errors)
+clients.register("email", make_email_client, rebuild_on=AZURE_CONNECTION_ERRORS)
+
 #The timer trigger decorator is what defines when and how often my function is running.
 #The retry decorator defines how often my app will try again if it fails for whatever reason. 
 #Both of these decorators have the "power" to make my function app run again 
@@ -18,13 +76,30 @@ app = func.FunctionApp()
 @app.timer_trigger(schedule="0 45 8 * * 5", arg_name="myTimer", run_on_startup=False,use_monitor=False) 
 @app.retry(strategy="fixed_delay", max_retry_count="5",delay_interval="00:00:01")
 def dbqueryandsave(myTimer: func.TimerRequest, context: func.Context) -> None:
+    # Only this trigger talks to SQL so pyodbc is imported here rather than at the top
+    import pyodbc
+    # Set the date I plan to use for my results filename
+    # putting "f" infront of strings means it parses the variables inside the string, instead of just putting the name of the variable. 
+    today = datetime.date.today().strftime("%Y%m%d")
+    # Each numbered smoke test gets timed, along with the bytes it moved and which retry this is. See stage_timing.py
+    timings = StageTimings("dbqueryandsave", today, context.retry_context.retry_count)
+    # Set up front so the smoke test summary at the end still works if something fails part way through
+    conn = None
+    blob_service_client = None
+    sqlstate_result = '#1 - Did not connect to the DB'
+    blob_service_client_result = '#2 - Did not connect to Blob storage'
+    all_rows_str_result = '#3 - Did not query the DB'
+    blob_contents_results = '#4 - Did not check the upload'
     try:
         if myTimer.past_due:
             logging.info('The timer is past due!')
 #1 - DB Connect Test
         # Create a new connection
         conn_str = os.getenv('SQLDB_CONNECTION_STRING')
-        conn = pyodbc.connect(conn_str)
+        # pyodbc leaves ODBC connection pooling on, so after the first run on this worker this reuses an already logged in connection.
+        timings.start(1, "db_connect")
+        conn = connect_sql(pyodbc, conn_str)
+        timings.finish(1, ok=bool(conn))
         if conn:
             sqlstate_result = f'#1 - Successfully connected to the DB after {context.retry_context.retry_count + 1} attempts'
             logging.warning(sqlstate_result)
@@ -34,7 +109,9 @@ def dbqueryandsave(myTimer: func.TimerRequest, context: func.Context) -> None:
 
         # Get the connection strings from the environmental settings
         # This connects to my blob storage and my SQL DB
-        blob_service_client = BlobServiceClient.from_connection_string(os.getenv('AzureWebJobsStorage'))
+        timings.start(2, "blob_connect")
+        blob_service_client = clients.get("blob")
+        timings.finish(2, ok=bool(blob_service_client))
 #2 - Blob Storage Connection Test
         if blob_service_client:
             blob_service_client_result = '#2 - Connected to Blob storage successfully'
@@ -43,43 +120,118 @@ def dbqueryandsave(myTimer: func.TimerRequest, context: func.Context) -> None:
             blob_service_client_result = '#2 - Connection to Blob storage failed'
             logging.error(blob_service_client_result)
 
+        # If this is a retry, pick up from the first stage the earlier attempt didn't finish. See run_checkpoint.py
+        checkpoint = RunCheckpoint.load(blob_service_client, "dbqueryandsave", today)
+
         # Query my database and get data from the ResumeVisitors table
-        logging.warning('Attempting query..')
-        cur.execute("SELECT TOP (1000) * FROM ResumeVisitors")
-
-        # Set the filename I plan to use for my results
-        # putting "f" infront of strings means it parses the variables inside the string, instead of just putting the name of the variable. 
-        today = datetime.date.today().strftime("%Y%m%d")
-        filename = f"visitors{today}.txt"
-        blob_client = blob_service_client.get_blob_client("results", filename)
-        # Fetch all the results of the query and add it to my file
-        rows = cur.fetchall()
-        all_rows = []
-        #For each row found in the query results, combine them into one string. 
-        for row in rows:
-            all_rows.append(str(row))
-
-        all_rows_str = '\n'.join(all_rows)
-        logging.warning(all_rows_str)
+        # Read the results in batches with fetchmany and stage each batch as a block, then commit them all at the end.
+        # Only one batch is held in memory at a time. See visitor_export.py
+        # In incremental mode only the rows that changed since the last run are exported, and the deltas get compacted into a full snapshot every so often.
+        # In aggregate mode SQL keeps a per day summary table and only the per visitor totals are read out of it.
+        # If this file already exists with different content, the commit will fail. This is intentional.
+        # If it exists with the same content (a retry re-uploading the same export) that's fine. 
+        timings.start(3, "export")
+        export_resumed = checkpoint.done("export")
+        if export_resumed:
+            # An earlier attempt already exported today's rows, so reuse that instead of querying and uploading it all again
+            export = checkpoint.get("export")
+            index_builder = None
+            filename, row_count, byte_count = export["filename"], export["row_count"], export["byte_count"]
+            content_md5 = bytes.fromhex(export["content_md5"]) if export["content_md5"] else None
+            watermark = export.get("watermark")
+            logging.warning(f'Already exported {row_count} rows ({byte_count} bytes) to {filename} on an earlier attempt')
+        else:
+            # Today's visit index column is built from the rows as the export streams them past, so the export doesn't have to be
+            # downloaded again afterwards. Only the index's IPs are loaded for that, its columns stay compressed. See visit_index.py
+            index_builder = None
+            if not checkpoint.done("visit_index"):
+                try:
+                    index_builder = PeriodBuilder(load_stored_index(blob_service_client))
+                except Exception as e:
+                    logging.error(f'Could not load the visit index before the export: {e}')
+            on_batch = index_builder.add_rows if index_builder else None
+            logging.warning('Attempting query..')
+            watermark = None
+            if EXPORT_MODE == 'aggregate':
+                # SQL adds everything up and only one row per visitor comes back, see visitor_summary.py
+                filename, row_count, byte_count, content_md5 = export_aggregate(conn, cur, blob_service_client, today, on_batch)
+            elif EXPORT_MODE == 'incremental':
+                filename, row_count, byte_count, content_md5, watermark = export_incremental(cur, blob_service_client, today,
+                                                                                             on_batch)
+            elif EXPORT_PARTITIONS > 1:
+                # Big tables: read EXPORT_PARTITIONS key ranges at once, each on its own pooled connection. Same file as the serial export.
+                # If rows come or go while the ranges are being read it notices and does a serial export instead.
+                filename, row_count, byte_count, content_md5 = export_parallel(
+                    cur, lambda: connect_sql(pyodbc, conn_str), blob_service_client, today, on_batch,
+                    index_builder.clear if index_builder else None)
+            else:
+                filename, row_count, byte_count, content_md5 = export_full(cur, blob_service_client, today, on_batch)
+            logging.warning(f'Exported {row_count} rows ({byte_count} bytes) to {filename}')
+            checkpoint.complete("export", filename=filename, row_count=row_count, byte_count=byte_count,
+                                content_md5=content_md5.hex() if content_md5 else None, watermark=watermark)
+        # The incremental watermark only moves on once the export is checkpointed. If the run dies before that, the retry
+        # exports the same rows again instead of finding nothing new. Saving it again on a resumed run is harmless.
+        if watermark:
+            save_watermark(blob_service_client, watermark)
+        # A delta (or a quiet day with no delta at all) only has the IPs that changed
+        exported_delta = filename is None or filename.endswith(".delta.txt")
 #3 - Query DB Test
-        if all_rows_str:
+        if row_count or (EXPORT_MODE == 'incremental' and filename is None):
             all_rows_str_result = '#3 - Queried DB successfully'
             logging.warning(all_rows_str_result)
         else:
             all_rows_str_result = '#3 - Query DB unsuccessfully'
             logging.error(all_rows_str_result)
-        # Upload all the results to the storage account using the predefined filename. 
-        # If this file already exists, the attempt to upload will fail. This is intentional. 
-        blob_client.upload_blob(all_rows_str)
+        timings.finish(3, ok=all_rows_str_result == '#3 - Queried DB successfully', bytes_moved=0 if export_resumed else byte_count,
+                       resumed=export_resumed)
 #4 - Confirm upload was successful
-        blob_data = blob_client.download_blob()
-        blob_contents = blob_data.readall()
-        if blob_contents:
-            blob_contents_results = (f'#4 - Uploaded data to {filename} successfully')
+        # Every block was MD5 checked by blob storage as it was staged, so checking the blob is just comparing its stored size.
+        # That's one small call no matter how big the export is. Set EXPORT_VERIFY_MODE=deep to download and hash the whole blob as well.
+        timings.start(4, "verify_upload")
+        verify_resumed = checkpoint.done("verify")
+        if filename is None:
+            upload_ok, downloaded_bytes, verify_detail = True, 0, 'nothing changed'
+            filename = 'delta (no changes since last export)'
+        elif verify_resumed:
+            upload_ok, downloaded_bytes, verify_detail = True, 0, checkpoint.get("verify")["detail"]
+        else:
+            blob_client = blob_service_client.get_blob_client("results", filename)
+            upload_ok, downloaded_bytes, verify_detail = verify_upload(blob_client, byte_count, content_md5, EXPORT_VERIFY_MODE)
+            if upload_ok:
+                checkpoint.complete("verify", detail=verify_detail)
+        timings.finish(4, ok=upload_ok, bytes_moved=downloaded_bytes, resumed=verify_resumed)
+        if upload_ok:
+            blob_contents_results = (f'#4 - Uploaded data to {filename} successfully, {verify_detail}')
             logging.warning(blob_contents_results)
         else:
-            blob_contents_results = (f'#4 - Failed to upload data to {filename}')
+            blob_contents_results = (f'#4 - Failed to upload data to {filename}, {verify_detail}')
             logging.error(blob_contents_results)
+        # Add today's counts to the per-IP history in visit_index.py, so trends over any window only need that one blob.
+        # Incremental deltas only have the IPs that changed, so everyone else carries over their count from last time.
+        # If this fails the export itself is still fine, so it only logs the problem.
+        # The builder already has the rows from the export. A retry that resumed after the export never saw them, so it
+        # (or a run that couldn't load the index beforehand) streams them back off the exported blob one row group at a time.
+        if not checkpoint.done("visit_index"):
+            try:
+                if index_builder:
+                    save_stored_index(blob_service_client, index_builder.finish(today, carry_forward=exported_delta))
+                else:
+                    groups = iter_export_groups(blob_service_client, filename) if row_count else []
+                    update_visit_index(blob_service_client, today, groups, carry_forward=exported_delta)
+                checkpoint.complete("visit_index")
+                # The stats endpoints on this worker should pick up the new index on their next request
+                stats_cache.invalidate()
+            except Exception as e:
+                logging.error(f'Could not update the visit index: {e}')
+        # Add the export to the snapshot catalog, so analyse_visits can find the nearest snapshot with one small read. See snapshot_catalog.py
+        # Same as the visit index, a failure here doesn't undo the export. The next successful run's entry goes in next to it.
+        if upload_ok and parse_snapshot_name(filename) and not checkpoint.done("catalog"):
+            try:
+                entry = record_snapshot(blob_service_client, filename, byte_count, row_count, content_md5)
+                checkpoint.complete("catalog")
+                logging.warning(f'Catalogued {filename} ({entry["format"]}, {entry["bytes"]} bytes, {entry["rows"]} rows)')
+            except Exception as e:
+                logging.error(f'Could not update the snapshot catalog: {e}')
        
     # Error logging - this section provides more verbose errors if the function app fails for whatever reason.\
     # \n refers to printing a new line
@@ -88,26 +240,38 @@ def dbqueryandsave(myTimer: func.TimerRequest, context: func.Context) -> None:
         sqlstate = ex.args[0] if len(ex.args) > 0 else None
         sqlstate_result =(f'Database error occurred:\nSQLState: {sqlstate}\nError: {ex}')
         logging.error(sqlstate_result)
+        timings.fail_open_spans(ex)
         if context.retry_context.retry_count == context.retry_context.max_retry_count:
             logging.error(
                 f"Max retries of {context.retry_context.max_retry_count} for "
                 f"function {context.function_name} has been reached")
+        else:
+            # Let the retry decorator run it again. The checkpoint means the retry skips whatever already finished.
+            raise
 
     except Exception as e:
         logging.error(f'An error occurred: {e}')
+        timings.fail_open_spans(e)
+        # If the blob connection itself broke, throw the shared client away so the retry gets a fresh one
+        clients.report_error("blob", e)
         if context.retry_context.retry_count == context.retry_context.max_retry_count:
             logging.info(
                 f"Max retries of {context.retry_context.max_retry_count} for "
                 f"function {context.function_name} has been reached")
+        else:
+            raise
 
     finally:
 #5 - Confirm DB Connection closes
         # Closes the connection to the SQL DB once the function completes. This is to avoid a "leaked" connection.
+        timings.start(5, "db_close")
         if conn is not None:
             conn.close()
+            timings.finish(5, ok=True)
             dbclose_result = ('#5 - Connection to DB was closed successfully.')
             logging.warning(dbclose_result)
         else:
+            timings.finish(5, ok=False)
             dbclose_result = ('#5 - Connection to DB was not closed successfully')
             logging.error(dbclose_result)
 
@@ -120,12 +284,78 @@ def dbqueryandsave(myTimer: func.TimerRequest, context: func.Context) -> None:
                     {blob_contents_results}
                     {dbclose_result}'''
         smoketests_filename = f"smoketests_{today}.txt"
-        smoketest_blob_client = blob_service_client.get_blob_client("smoketests", smoketests_filename)
-        smoketest_blob_client.upload_blob(tests1to5)
+        # Overwritten on every attempt so the retries don't fail on it, and the file always has the latest attempt's results.
+        # The same results as JSON with the timings, so stage_timing.py can work out p50/p95 per stage over past runs.
+        # Both are gzipped on the way up, see blob_compression.py
+        if blob_service_client is not None:
+            try:
+                smoketest_blob_client = blob_service_client.get_blob_client("smoketests", smoketests_filename)
+                upload_compressed(smoketest_blob_client, tests1to5, overwrite=True)
+                timings.upload(blob_service_client)
+            except Exception as e:
+                logging.error(f'Could not save the smoke test results: {e}')
+        logging.warning(clients.format_stats())
+
+#Parsing a big .txt snapshot is pure Python, so it's done on a thread to keep the event loop free for other invocations.
+def parse_text_blob(data: bytes):
+    return parse_text_snapshot(data.decode('utf-8'))
+
+def merge_deltas(ips, counts, delta_texts):
+    return apply_deltas(ips, counts, [parse_text_snapshot(text) for text in delta_texts])
+
+#Reads the snapshot for a given day. With a name from the snapshot catalog that exact blob is read.
+#Without one the compact .vsnap format is tried first and is streamed straight into arrays,
+#then it falls back to the old repr-of-Row .txt file. Raises ResourceNotFoundError if neither exists.
+#Also returns how many bytes were downloaded, for the smoke test timings.
+#This uses the azure.storage.blob.aio client so the download doesn't hold up the event loop.
+#Compressed .txt snapshots are decompressed as they stream in, old uncompressed ones are read as they are.
+async def load_snapshot(blob_service_client, day, snapshotname=None):
+    if snapshotname is not None:
+        chunks, size = await open_download_async(blob_service_client.get_blob_client("results", snapshotname))
+        if snapshotname.endswith(SNAPSHOT_EXTENSION):
+            ips, counts = await read_snapshot_async(chunks)
+        else:
+            ips, counts = await asyncio.to_thread(parse_text_blob, b''.join([chunk async for chunk in chunks]))
+        return snapshotname, ips, counts, size
+    snapshotname = f"visitors{day}{SNAPSHOT_EXTENSION}"
+    try:
+        chunks, size = await open_download_async(blob_service_client.get_blob_client("results", snapshotname))
+        ips, counts = await read_snapshot_async(chunks)
+        return snapshotname, ips, counts, size
+    except ResourceNotFoundError:
+        snapshotname = f"visitors{day}.txt"
+        chunks, size = await open_download_async(blob_service_client.get_blob_client("results", snapshotname))
+        ips, counts = await asyncio.to_thread(parse_text_blob, b''.join([chunk async for chunk in chunks]))
+        return snapshotname, ips, counts, size
+
+#Reads a view from the snapshot catalog: the full snapshot it's based on, with any incremental deltas since then folded in.
+#In incremental mode that's how a day that only wrote a visitors{date}.delta.txt gets all its visitors.
+#The deltas are downloaded alongside the base. Returns the same shape as load_snapshot, the bytes are everything downloaded.
+async def load_view(blob_service_client, snapshot_view):
+    base_download, *delta_texts = await asyncio.gather(
+        load_snapshot(blob_service_client, snapshot_view["base"]["date"], snapshot_view["base"]["name"]),
+        *(download_text(blob_service_client, "results", delta["name"]) for delta in snapshot_view["deltas"]))
+    _, ips, counts, size = base_download
+    if delta_texts:
+        ips, counts = await asyncio.to_thread(merge_deltas, ips, counts, delta_texts)
+        size += sum(delta["bytes"] for delta in snapshot_view["deltas"])
+    return describe_view(snapshot_view), ips, counts, size
+
+#Downloads a text blob, e.g. the smoketests results. Decompressed if it was saved compressed.
+async def download_text(blob_service_client, container, blobname):
+    return (await download_bytes_async(blob_service_client.get_blob_client(container, blobname))).decode('utf-8')
 
 #FYI Azure CRON jobs are in UTC.. not local time
+#Everything in here is awaited on the async Blob, OpenAI and Email clients, so while it's waiting on the network
+#the worker is free to run other invocations.
 @app.timer_trigger(schedule="0 0 9 * * 5", arg_name="myTimer", run_on_startup=False, use_monitor=False) 
 async def analyse_visits(myTimer: func.TimerRequest) -> None:
+    #Define the dates for what I want to access
+    lastweek = (datetime.date.today() - datetime.timedelta(days=7)).strftime("%Y%m%d")
+    thisweek = datetime.date.today().strftime("%Y%m%d")
+    # Smoke tests #6 - #10 get timed the same way as #1 - #5 in dbqueryandsave. See stage_timing.py
+    timings = StageTimings("analyse_visits", thisweek)
+    blob_service_client = None
     try:
         if myTimer.past_due:
             logging.info('The timer is past due!')
@@ -135,75 +365,154 @@ async def analyse_visits(myTimer: func.TimerRequest) -> None:
         if not blobkey:
             logging.error("BLOB_KEY environment variable not set")
             return
-        #Define the filenames for what I want to access
-        lastweek = (datetime.date.today() - datetime.timedelta(days=7)).strftime("%Y%m%d")
-        lastweektxt = f"visitors{lastweek}.txt"
-        thisweek = datetime.date.today().strftime("%Y%m%d")
-        thisweektxt = f"visitors{thisweek}.txt"
-        # Setup the blob connections for this week and last week
-        blob_lastweek = BlobClient.from_connection_string(blobkey, "results", lastweektxt)
-        blob_thisweek = BlobClient.from_connection_string(blobkey, "results", thisweektxt)
-        # Convert the txt inside the files to something that's useable
+        blob_service_client = clients.get("blob_aio")
+        # Look up which snapshots to compare in the catalog: the newest view up to today, and the newest one up to a week ago
+        # that's older than it. So a missed export means comparing against whatever came before it instead of giving up.
+        # In incremental mode a view is the last full snapshot plus the deltas since, see load_view.
+        # Before dbqueryandsave has written a catalog this falls back to the exact dates.
+        lastweek_view, thisweek_view = None, None
+        catalog = await load_catalog_async(blob_service_client)
+        if catalog is not None:
+            thisweek_view, lastweek_view = resolve_pair(catalog, thisweek, lastweek)
+            if thisweek_view is None or lastweek_view is None:
+                logging.error(f"The snapshot catalog has nothing on or before {thisweek if thisweek_view is None else lastweek} to compare")
+                return
+            if (thisweek_view["date"], lastweek_view["date"]) != (thisweek, lastweek):
+                logging.warning(f"Comparing the nearest snapshots found, {describe_view(lastweek_view)} and {describe_view(thisweek_view)}")
+        # Load the snapshots for this week and last week into a list of IPs and an array of visit counts,
+        # and grab the smoketest results from dbqueryandsave and the per-IP history (for the anomalies) while I'm at it.
+        # All four downloads run at the same time so this only takes as long as the slowest one.
+        # load_snapshot reads the .vsnap format and falls back to the old .txt files.
+        tests1to5_resultstxt = f"smoketests_{thisweek}.txt"
+        lastweek_download, thisweek_download, tests1to5_download, visit_index = await asyncio.gather(
+            timings.timed(6, "lastweek_snapshot", load_view(blob_service_client, lastweek_view) if lastweek_view else load_snapshot(blob_service_client, lastweek), bytes_of=lambda download: download[3]),
+            timings.timed(7, "thisweek_snapshot", load_view(blob_service_client, thisweek_view) if thisweek_view else load_snapshot(blob_service_client, thisweek), bytes_of=lambda download: download[3]),
+            download_text(blob_service_client, "smoketests", tests1to5_resultstxt),
+            load_visit_index_async(blob_service_client),
+            return_exceptions=True)
  #6 - Check access to last week's results
-        try:
-            data_lastweek = blob_lastweek.download_blob().readall().decode('utf-8')
-            if data_lastweek:
-                blob_lastweek_result = (f"#6 - Access to {lastweektxt} was successful.")
-                logging.warning(blob_lastweek_result)
-        except ResourceNotFoundError:
-            blob_lastweek_result = (f"#6 - Could not find blob {lastweektxt} in container 'results'")
+        if isinstance(lastweek_download, ResourceNotFoundError):
+            blob_lastweek_result = (f"#6 - Could not find a snapshot for {lastweek} in container 'results'")
             logging.error(blob_lastweek_result)
             return
+        elif isinstance(lastweek_download, Exception):
+            raise lastweek_download
+        lastweektxt, ips_lastweek, counts_lastweek, _ = lastweek_download
+        blob_lastweek_result = (f"#6 - Access to {lastweektxt} was successful.")
+        logging.warning(blob_lastweek_result)
 #7 - Check access to this week's results
-        try:
-            data_thisweek = blob_thisweek.download_blob().readall().decode('utf-8')
-            if data_thisweek:
-                data_thisweek_result = (f"#7 - Access to {thisweektxt} was successful.")
-                logging.warning(data_thisweek_result)            
-        except ResourceNotFoundError:
-            blob_thisweek_result = (f"#7 - Could not find blob {thisweektxt} in container 'results'")
+        if isinstance(thisweek_download, ResourceNotFoundError):
+            blob_thisweek_result = (f"#7 - Could not find a snapshot for {thisweek} in container 'results'")
             logging.error(blob_thisweek_result)
             return
-        #Define the prompt I want to be using that includes a reference to the data contained in the text files.
-        prompt = f'''I have two sets of results that display the Public IP address of my visitors and how many times they've visited. 
-                    I want to compare last week's visit tally with today. Please advise me of the following:
-                    1. Any new visitors or changes in visit count
-                    2. Any other interesting trends that you've noticed.
-                    3. Take today's date {thisweek} and tell me an interesting historical thing that happened on the same date.
-                    Last week:
-                    {data_lastweek}
-                    Today:
-                    {data_thisweek}'''
-
-        client = AzureOpenAI(
-        api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
-        api_version = "2024-02-01",
-        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+        elif isinstance(thisweek_download, Exception):
+            raise thisweek_download
+        thisweektxt, ips_thisweek, counts_thisweek, _ = thisweek_download
+        data_thisweek_result = (f"#7 - Access to {thisweektxt} was successful.")
+        logging.warning(data_thisweek_result)            
+        # Work out the new, gone and changed visitors locally so the AI only gets sent what actually changed.
+        # This is a single pass over each snapshot, see visitor_diff.py
+        # It's seconds of plain Python at a million IPs, so like the anomaly check below it runs on a thread rather than the event loop.
+        visitor_diff = await asyncio.to_thread(diff_snapshots, ips_lastweek, counts_lastweek, ips_thisweek, counts_thisweek)
+        # Only the totals and the PROMPT_TOP_N biggest movers of each kind go in the log and the email. The whole diff
+        # of a million visitors would be tens of MB, past what the email service will take.
+        visitor_changes = await asyncio.to_thread(format_diff, visitor_diff, PROMPT_TOP_N)
+        logging.warning(visitor_changes)
+        # Look for spikes and new bursts over every IP's history in the visit index, see visitor_anomalies.py
+        # It's plain NumPy, so it's run on a thread to keep the event loop free. Without the index there's just no anomalies section.
+        anomalies = None
+        if isinstance(visit_index, Exception):
+            logging.error(f"Could not load the visit index, skipping the anomaly check: {visit_index}")
+        else:
+            anomalies = await asyncio.to_thread(detect_anomalies, visit_index)
+        # Which networks (ASN and country) this week's visits came from, and who the flagged IPs belong to.
+        # The IP data is a local file loaded once per worker, no lookups go over the network. See ip_enrichment.py
+        network_facts = []
+        ip_index = await asyncio.to_thread(get_ip_index)
+        if ip_index is not None:
+            network_facts = network_sections(await asyncio.to_thread(aggregate_diff, ip_index, visitor_diff))
+            if anomalies is not None:
+                annotate(ip_index, anomalies["spikes"] + anomalies["bursts"])
+        if anomalies is None:
+            anomaly_facts, visitor_anomalies = [], "The visit index could not be loaded, no anomaly check this time"
+        else:
+            anomaly_facts, visitor_anomalies = anomaly_sections(anomalies), format_anomalies(anomalies)
+        visitor_anomalies = '\n\n'.join([visitor_anomalies] + [text for _, text in network_facts])
+        logging.warning(visitor_anomalies)
+        #Define the prompt I want to be using that includes a reference to the changes between the snapshots.
+        instructions = f'''I have compared last week's list of visitor Public IP addresses and visit counts with today's. 
+                    Below are the totals plus only the visitors that are new, gone or whose visit count changed,
+                    followed by visitors my own statistics flagged as anomalies against their history and the networks the visits came from.
+                    Please advise me of the following:
+                    1. A summary of the new visitors and changes in visit count
+                    2. What the flagged anomalies might mean, plus any other interesting trends that you've noticed.
+                    3. Take today's date {thisweek} and tell me an interesting historical thing that happened on the same date.'''
+        # Keep the prompt under PROMPT_TOKEN_BUDGET. If the changes don't fit it falls back to the top movers, then /24 subnets, then just the totals.
+        # The anomalies go in at every level.
+        prompt, prompt_report = await asyncio.to_thread(build_prompt, instructions, visitor_diff, facts=anomaly_facts + network_facts)
+        logging.warning(format_report(prompt_report))
+
+        # Check if this exact prompt has already been analysed, e.g. on a retry or a re-run. If so there's no need to pay for the model again.
+        # The key covers the deployment, api version, prompt template version and the data. See completion_cache.py
+        messages = [{"role": "user", "content": prompt}]
+        llm_cache_key = cache_key(OPENAI_DEPLOYMENT, OPENAI_API_VERSION, PROMPT_TEMPLATE_VERSION, messages)
+        llm_cache = await get_cache_container(blob_service_client)
+        cached_response = await lookup(llm_cache, llm_cache_key)
+
+        client = clients.get("openai")
         logging.warning(client)
 
         
 #8 - Confirm API connected successfully.
+        timings.start(8, "openai_test")
         try:
-            response_test = client.chat.completions.create(model="BrandonAI", messages=[{"role": "user", "content": 'Hello Mr.AI are you there?'}])
-            response_test_response = (response_test.choices[0].message.content)
-            if response_test_response:
-                response_result = ("#8 - Connection to Azure OpenAI was successful")
+            if cached_response is not None:
+                timings.finish(8, ok=True)
+                response_result = ("#8 - Skipped the Azure OpenAI connection test, the analysis was served from the cache")
                 logging.warning(response_result)
             else:
-                response_result = ("#8 - Connection to Azure OpenAI failed.")
-                logging.error(response_result)
+                # Streamed with a deadline so a slow model can't hold this up, see llm_stream.py
+                response_test_response, test_metrics = await stream_completion(
+                    client, OPENAI_DEPLOYMENT, [{"role": "user", "content": 'Hello Mr.AI are you there?'}])
+                logging.warning(format_metrics(test_metrics))
+                timings.finish(8, ok=bool(response_test_response), bytes_moved=len((response_test_response or '').encode('utf-8')))
+                if response_test_response:
+                    response_result = ("#8 - Connection to Azure OpenAI was successful")
+                    logging.warning(response_result)
+                else:
+                    response_result = ("#8 - Connection to Azure OpenAI failed.")
+                    logging.error(response_result)
         except Exception as e:
                 logging.error(f"An error occurred: {e}")
+                timings.fail_open_spans(e)
+                clients.report_error("openai", e)
 
+        timings.start(9, "prompt")
         try:
-            response = client.chat.completions.create(
-                model="BrandonAI", # model = "deployment_name".
-                messages=[{"role": "user", "content": prompt}])
-            # Log the content of the first message in the completion choices
-            promptresponse = (response.choices[0].message.content)
+            if cached_response is not None:
+                promptresponse = cached_response
+                prompt_bytes = 0
+            else:
+                prompt_bytes = len(prompt.encode('utf-8'))
+                # The answer is streamed in and put together as it arrives. If it isn't finished by LLM_DEADLINE_SECONDS
+                # I get whatever arrived so far, and the email says it was cut short.
+                promptresponse, prompt_metrics = await stream_completion(
+                    client, OPENAI_DEPLOYMENT, # model = "deployment_name".
+                    messages)
+                logging.warning(format_metrics(prompt_metrics))
+                if prompt_metrics["timed_out"] and promptresponse:
+                    promptresponse = f"{promptresponse}\n\n[The analysis was cut off after {prompt_metrics['total_ms'] / 1000:.0f} seconds]"
+                # Save the answer so the next run with the same data doesn't need to ask again
+                # If saving fails I still want the email to go out, so it only logs the problem.
+                # A cut off answer isn't saved, so the next run gets another go at the whole thing.
+                if promptresponse and not prompt_metrics["timed_out"]:
+                    try:
+                        await store(llm_cache, llm_cache_key, promptresponse)
+                    except Exception as e:
+                        logging.error(f"Could not save the response to the LLM cache: {e}")
             logging.warning(promptresponse)
 #9 - Confirm a response is received for the prompt
+            timings.finish(9, ok=bool(promptresponse), bytes_moved=prompt_bytes + len((promptresponse or '').encode('utf-8')))
             if promptresponse:
                 promptresponse_result = ("#9 - Prompt was successful, received a response.")
                 logging.warning(promptresponse_result)     
@@ -213,13 +522,15 @@ async def analyse_visits(myTimer: func.TimerRequest) -> None:
         except Exception as e:
         # Log any exceptions that occur
             logging.error(f"An error occurred: {e}")         
+            timings.fail_open_spans(e)
+            clients.report_error("openai", e)
         #Email the results to me
-        emailkey = os.environ.get('EMAIL_KEY')
-        client = EmailClient.from_connection_string(emailkey)
+        #The email goes into the outbox and send_outbox (below) sends it, so this function doesn't wait around for the delivery.
 #10 - Include all results in the email 
-        tests1to5_resultstxt = f"smoketests_{thisweek}.txt"
-        blob_tests1to5_results = BlobClient.from_connection_string(blobkey, "smoketests", tests1to5_resultstxt)
-        data_tests1to5_results = blob_tests1to5_results.download_blob().readall().decode('utf-8')
+        # This was downloaded alongside the snapshots above
+        if isinstance(tests1to5_download, Exception):
+            raise tests1to5_download
+        data_tests1to5_results = tests1to5_download
 
         all_results = f'''
                     {data_tests1to5_results}
@@ -227,7 +538,7 @@ async def analyse_visits(myTimer: func.TimerRequest) -> None:
                     {data_thisweek_result}
                     {response_result}
                     {promptresponse_result}
-                    #10 - Email sent successfully
+                    #10 - Email queued in the outbox
                     '''
         message = {
             "senderAddress": "visitormonitor@brandedkai.net",
@@ -236,21 +547,179 @@ async def analyse_visits(myTimer: func.TimerRequest) -> None:
             },
             "content": {
                 "subject": f"Visitors analysis of {thisweek}",
-                "plainText": f"{promptresponse} {all_results}",
+                "plainText": f"{promptresponse}\n\n{visitor_changes}\n\n{visitor_anomalies}\n{all_results}",
             }
         }
 
-        poller = client.begin_send(message)
-        poller.result() 
-#10 - Confirm email sent successfully
-        poller_result = poller.result() 
-        if poller_result:
-            email_result = '#10 - Email sent successfully'
-            logging.warning(email_result)
-        else:
-            email_result = '#10 - Email failed to send'
-            logging.error(email_result)
+        timings.start(10, "email_queued")
+        outbox_blob = await enqueue_email(blob_service_client, message)
+#10 - Confirm email was queued successfully
+        timings.finish(10, ok=bool(outbox_blob), bytes_moved=len(message["content"]["plainText"].encode('utf-8')))
+        email_result = f'#10 - Email queued as {outbox_blob}, send_outbox will deliver it'
+        logging.warning(email_result)
 
     except Exception as e:
         # Log any exceptions that occur
         logging.error(f"An error occurred: {e}")
+        timings.fail_open_spans(e)
+
+        # If the connection under one of the shared clients broke, throw it away so the next run gets a fresh one
+        for name in ("blob_aio", "openai"):
+            clients.report_error(name, e)
+
+    finally:
+        # Save the timings for #6 - #10 next to dbqueryandsave's, see stage_timing.py for the p50/p95 summary
+        if blob_service_client is not None:
+            try:
+                await timings.upload_async(blob_service_client)
+            except Exception as e:
+                logging.error(f"Could not save the smoke test timings: {e}")
+        # The clients stay open for the next invocation, just log how often they're being reused
+        logging.warning(clients.format_stats())
+
+#Sends whatever analyse_visits (or anything else) has left in the outbox. See email_outbox.py
+#Up to OUTBOX_BATCH_SIZE emails go out at once and their delivery is checked concurrently. Failed ones are retried with a backoff on later runs.
+#Timer triggers only ever run on one instance at a time, so two runs can't pick up the same email.
+@app.timer_trigger(schedule="0 */5 * * * *", arg_name="myTimer", run_on_startup=False, use_monitor=False)
+async def send_outbox(myTimer: func.TimerRequest) -> None:
+    try:
+        outcomes = await send_pending(clients.get("blob_aio"), clients.get("email"))
+        if any(outcomes.values()):
+            logging.warning(f"Outbox: {outcomes['sent']} sent, {outcomes['retry']} to retry, "
+                            f"{outcomes['failed']} failed, {outcomes['waiting']} still delivering")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        for name in ("blob_aio", "email"):
+            clients.report_error(name, e)
+
+#Asks every persona every question in prompt_templates.py and emails me the answers as one digest.
+#chat_batch.py runs them concurrently, as fast as the deployment's quota (CHAT_RPM / CHAT_TPM) allows, and backs off on 429s.
+#It was never one of the original functions, so it only runs with PERSONA_DIGEST=1 in the app settings.
+if os.getenv('PERSONA_DIGEST', '0') == '1':
+    @app.timer_trigger(schedule="0 45 16 * * 5", arg_name="myTimer", run_on_startup=False, use_monitor=False)
+    async def persona_digest(myTimer: func.TimerRequest) -> None:
+        try:
+            today = datetime.datetime.now().strftime("%Y%m%d")
+            jobs = batch_jobs(date=today)
+            batch = await run_batch(clients.get("openai"), OPENAI_DEPLOYMENT, jobs)
+            digest = format_digest(batch)
+            logging.warning(digest.splitlines()[0])
+            message = {
+                "senderAddress": "visitormonitor@brandedkai.net",
+                "recipients":  {
+                    "to": [{"address": "brandon@allmark.me" }],
+                },
+                "content": {
+                    "subject": f"Persona digest for {today}",
+                    "plainText": digest,
+                }
+            }
+            outbox_blob = await enqueue_email(clients.get("blob_aio"), message)
+            logging.warning(f"Persona digest queued as {outbox_blob}, send_outbox will deliver it")
+        except Exception as e:
+            logging.error(f"An error occurred: {e}")
+            for name in ("blob_aio", "openai"):
+                clients.report_error(name, e)
+
+#Visitor stats over HTTP, so I don't have to wait for Friday's email. All three read the visit index through visitor_stats.py,
+#which keeps the answers in memory until a new snapshot lands. Repeat requests never touch blob storage or SQL.
+#Every response has an ETag, send it back as If-None-Match and you get a 304 if nothing changed.
+#   GET /api/stats/top?limit=10&days=28
+#   GET /api/stats/ip/1.2.3.4
+#   GET /api/stats/diff?from=20240510&to=20240517&limit=50
+def stats_http_response(req: func.HttpRequest, endpoint: str, params: dict, build) -> func.HttpResponse:
+    try:
+        status, body, etag = stats_cache.respond(clients.get("blob"), endpoint, params, build, req.headers.get('If-None-Match'))
+    except KeyError as e:
+        return func.HttpResponse(f"Not found: {e}", status_code=404)
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400)
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        clients.report_error("blob", e)
+        return func.HttpResponse("Could not load the visitor stats", status_code=500)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=0, must-revalidate"}
+    if status == 304:
+        return func.HttpResponse(status_code=304, headers=headers)
+    return func.HttpResponse(body, status_code=200, mimetype="application/json", headers=headers)
+
+#Query string numbers, with a 400 if they aren't numbers
+def int_param(req: func.HttpRequest, name: str, default):
+    value = req.params.get(name)
+    if value is None:
+        return default
+    if not value.isdigit():
+        raise ValueError(f"{name} has to be a whole number")
+    return int(value)
+
+@app.route(route="stats/top", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def stats_top(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        limit = min(int_param(req, 'limit', 10), STATS_MAX_LIMIT)
+        days = int_param(req, 'days', None)
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400)
+    return stats_http_response(req, "top", {"limit": limit, "days": days},
+                               lambda index, row_of: top_visitors(index, limit, days))
+
+@app.route(route="stats/ip/{ip}", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def stats_ip(req: func.HttpRequest) -> func.HttpResponse:
+    ip = req.route_params.get('ip')
+    return stats_http_response(req, "ip", {"ip": ip}, lambda index, row_of: ip_history(index, row_of, ip))
+
+@app.route(route="stats/diff", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def stats_diff(req: func.HttpRequest) -> func.HttpResponse:
+    start, end = req.params.get('from'), req.params.get('to')
+    try:
+        limit = min(int_param(req, 'limit', 50), STATS_MAX_LIMIT)
+        for day in (start, end):
+            if day is not None and not (len(day) == 8 and day.isdigit()):
+                raise ValueError(f"{day} isn't a date, use YYYYMMDD")
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400)
+    return stats_http_response(req, "diff", {"from": start, "to": end, "limit": limit},
+                               lambda index, row_of: period_diff(index, start, end, limit))
+
+#Counts a page view. The resume site calls this on every load, so it has to be anonymous (a function key in the page's JS wouldn't be secret anyway).
+#The visit only goes into this worker's buffer, the SQL write happens in batches every couple of seconds. See visit_ingest.py
+#   POST /api/visit                       the visitor's IP comes from X-Forwarded-For
+# timeout is how long the flush has left (only set on shutdown), it bounds the login and the upsert
+def write_visits(rows, timeout=None):
+    import pyodbc
+    conn = connect_sql(pyodbc, os.getenv('SQLDB_CONNECTION_STRING'), timeout=timeout)
+    try:
+        upsert_visits(conn, rows)
+    finally:
+        conn.close()
+
+visit_buffer = VisitBuffer(write_visits)
+# Whatever is still buffered gets written when the worker shuts down (for up to INGEST_SHUTDOWN_SECONDS)
+visit_buffer.install_shutdown_flush()
+
+#The front end appends the caller as "ip:port" (or "[ipv6]:port") to X-Forwarded-For. Returns None if there isn't a valid IP.
+#Only the last entry is the one it added, anything before that came from the caller and could say anything, same as a body would.
+def client_ip(req: func.HttpRequest):
+    import ipaddress
+    forwarded = req.headers.get('X-Forwarded-For')
+    if not forwarded:
+        return None
+    candidate = forwarded.split(',')[-1].strip()
+    if candidate.startswith('['):
+        candidate = candidate[1:].split(']')[0]
+    elif candidate.count(':') == 1:
+        candidate = candidate.split(':')[0]
+    try:
+        return str(ipaddress.ip_address(candidate)) if candidate else None
+    except ValueError:
+        return None
+
+@app.route(route="visit", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+def ingest_visit(req: func.HttpRequest) -> func.HttpResponse:
+    ip = client_ip(req)
+    if ip is None:
+        return func.HttpResponse("Could not work out the visitor's IP", status_code=400)
+    if not visit_buffer.add(ip):
+        logging.error(f'Visit buffer is full, dropped a visit. {visit_buffer.format_stats()}')
+        return func.HttpResponse("Too many visits waiting to be written", status_code=503)
+    # 202 because it's accepted but not in the database yet
+    return func.HttpResponse(status_code=202)
@@ -0,0 +1,322 @@
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import struct
+import logging
+import functools
+import threading
+import ipaddress
+
+#This file adds network context (ASN, network name and country) to visitor IPs without calling anything over the network.
+#The data comes from a local CSV of CIDR blocks, e.g. an export of one of the free IP to ASN databases:
+#   network,asn,country,as_name
+#   1.0.0.0/24,13335,AU,CLOUDFLARENET
+#
+#The CIDRs are flattened into sorted, non-overlapping integer ranges (a more specific block wins over the one it sits inside),
+#so finding an IP is a binary search for the last range that starts at or before it. IPv4 and IPv6 get a table each.
+#IPv6 is keyed on the top 64 bits, nothing smaller than a /64 gets routed anyway.
+#
+#Parsing a few hundred thousand CIDRs takes seconds, so `python ip_enrichment.py build networks.csv` writes the flattened
+#tables to ip_networks.ipidx. That file is memory mapped when a worker starts, so loading it costs next to nothing and the
+#workers on one machine share the same pages. Without the prebuilt file the CSV is parsed once per worker instead.
+#Lookups are memoised in an LRU, so an IP that comes up again is a dict hit.
+#To time it run: python benchmarks/ip_enrichment_bench.py 500000
+
+#The CSV with the CIDR blocks, and the prebuilt index made from it. Relative paths are next to this file.
+IP_NETWORKS_CSV = os.getenv('IP_NETWORKS_CSV', 'ip_networks.csv')
+IP_NETWORKS_INDEX = os.getenv('IP_NETWORKS_INDEX', 'ip_networks.ipidx')
+#How many IPs each worker remembers the answer for.
+IP_LOOKUP_CACHE_SIZE = int(os.getenv('IP_LOOKUP_CACHE_SIZE', '65536'))
+#How many networks make it into the report.
+IP_NETWORKS_TOP_N = int(os.getenv('IP_NETWORKS_TOP_N', '15'))
+
+IP_INDEX_MAGIC = b'IPNX'
+IP_INDEX_VERSION = 1
+#Every table in the file starts on a multiple of this so numpy can map it straight in.
+_ALIGN = 8
+_UNKNOWN = {"asn": 0, "country": "", "name": "Unknown network"}
+
+
+def _path(name: str) -> str:
+    return name if os.path.isabs(name) else os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def ip_key(ip: str):
+    """(version, integer to search for) for an IP string, or None if it isn't one. IPv6 keeps its top 64 bits."""
+    try:
+        return 4, struct.unpack('>I', socket.inet_pton(socket.AF_INET, ip))[0]
+    except OSError:
+        pass
+    try:
+        return 6, struct.unpack('>Q', socket.inet_pton(socket.AF_INET6, ip)[:8])[0]
+    except OSError:
+        return None
+
+
+def flatten(blocks: list) -> list:
+    """Turn nested (start, end, network) blocks into sorted non-overlapping (start, end, network) ranges.
+
+    CIDR blocks are either nested or separate, never partly overlapping.
+    Where they nest the inner (more specific) block wins, and the outer one
+    covers whatever is left on each side of it.
+    """
+    #Outer blocks sort before the blocks inside them.
+    blocks = sorted(blocks, key=lambda block: (block[0], -block[1]))
+    ranges = []
+    stack = []
+    cursor = 0
+
+    def emit(start, end, network):
+        if start <= end:
+            ranges.append((start, end, network))
+
+    for start, end, network in blocks:
+        #Anything on the stack that ends before this block starts is finished, so its tail can go out.
+        while stack and stack[-1][1] < start:
+            _, finished_end, finished_network = stack.pop()
+            emit(cursor, finished_end, finished_network)
+            cursor = max(cursor, finished_end + 1)
+        if stack:
+            emit(cursor, start - 1, stack[-1][2])
+        cursor = start
+        stack.append((start, end, network))
+    while stack:
+        _, finished_end, finished_network = stack.pop()
+        emit(cursor, finished_end, finished_network)
+        cursor = max(cursor, finished_end + 1)
+    return ranges
+
+
+def read_networks_csv(path: str):
+    """Read the CIDR CSV into (IPv4 blocks, IPv6 blocks, networks). Blocks point into the networks list of (asn, country, name)."""
+    networks = []
+    network_of = {}
+    blocks = {4: [], 6: []}
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        for line_number, row in enumerate(csv.DictReader(csv_file), start=2):
+            try:
+                cidr = ipaddress.ip_network(row["network"].strip(), strict=False)
+                asn = int(row.get("asn") or 0)
+            except (KeyError, ValueError) as e:
+                logging.warning(f"Skipping line {line_number} of {path}: {e}")
+                continue
+            details = (asn, (row.get("country") or "").strip().upper()[:2], (row.get("as_name") or "").strip())
+            if details not in network_of:
+                network_of[details] = len(networks)
+                networks.append(details)
+            start, end = int(cidr.network_address), int(cidr.broadcast_address)
+            if cidr.version == 6:
+                start, end = start >> 64, end >> 64
+            blocks[cidr.version].append((start, end, network_of[details]))
+    return blocks[4], blocks[6], networks
+
+
+#The order the tables are stored in the prebuilt file, and their types. The names are one utf-8 blob cut up by name_offsets.
+_TABLES = [("v4_starts", 'u8'), ("v4_ends", 'u8'), ("v4_networks", 'u4'),
+           ("v6_starts", 'u8'), ("v6_ends", 'u8'), ("v6_networks", 'u4'),
+           ("asns", 'u4'), ("countries", 'S2'), ("name_offsets", 'u4'), ("names", 'u1')]
+
+
+class IPNetworkIndex:
+    """Sorted, non-overlapping IP ranges with the network (ASN, country, name) each one belongs to."""
+
+    def __init__(self, tables: dict, source: str, cache_size: int = IP_LOOKUP_CACHE_SIZE):
+        #tables holds a numpy array for every name in _TABLES. The ranges are sorted by start.
+        self.tables = tables
+        self.source = source
+        #A per-instance LRU, so swapping the index for a new one also throws the old answers away.
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'IPNetworkIndex':
+        import numpy as np
+        v4_blocks, v6_blocks, networks = read_networks_csv(path)
+        tables = {}
+        for version, blocks in ((4, v4_blocks), (6, v6_blocks)):
+            ranges = flatten(blocks)
+            tables[f"v{version}_starts"] = np.array([start for start, _, _ in ranges], dtype='u8')
+            tables[f"v{version}_ends"] = np.array([end for _, end, _ in ranges], dtype='u8')
+            tables[f"v{version}_networks"] = np.array([network for _, _, network in ranges], dtype='u4')
+        names = [name.encode('utf-8') for _, _, name in networks]
+        tables["asns"] = np.array([asn for asn, _, _ in networks], dtype='u4')
+        tables["countries"] = np.array([country.encode('ascii', 'replace') for _, country, _ in networks], dtype='S2')
+        tables["name_offsets"] = np.concatenate([[0], np.cumsum([len(name) for name in names])]).astype('u4')
+        tables["names"] = np.frombuffer(b''.join(names), dtype='u1')
+        return cls(tables, path)
+
+    def save(self, path: str) -> int:
+        """Write the tables to path for load to memory map. Returns the file size."""
+        header = json.dumps({"version": IP_INDEX_VERSION, "source": os.path.basename(self.source),
+                             "lengths": {name: len(self.tables[name]) for name, _ in _TABLES}}).encode('utf-8')
+        with open(path, 'wb') as index_file:
+            index_file.write(IP_INDEX_MAGIC + struct.pack('<I', len(header)) + header)
+            for name, dtype in _TABLES:
+                index_file.write(b'\0' * (-index_file.tell() % _ALIGN))
+                index_file.write(self.tables[name].astype(dtype, copy=False).tobytes())
+            return index_file.tell()
+
+    @classmethod
+    def load(cls, path: str) -> 'IPNetworkIndex':
+        """Memory map a file written by save. Nothing past the small header is read until a lookup touches it."""
+        import mmap
+        import numpy as np
+        with open(path, 'rb') as index_file:
+            mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:4] != IP_INDEX_MAGIC:
+            raise ValueError(f"{path} is not an IP network index")
+        (header_length,) = struct.unpack_from('<I', mapped, 4)
+        header = json.loads(mapped[8:8 + header_length].decode('utf-8'))
+        if header["version"] > IP_INDEX_VERSION:
+            raise ValueError(f"IP network index version {header['version']} is newer than this reader ({IP_INDEX_VERSION})")
+        offset = 8 + header_length
+        tables = {}
+        for name, dtype in _TABLES:
+            offset += -offset % _ALIGN
+            count = header["lengths"][name]
+            #Plain arrays over the mapping, not np.memmap, whose per-item access is a lot slower.
+            tables[name] = np.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+            offset += count * np.dtype(dtype).itemsize
+        return cls(tables, path)
+
+    def network(self, number: int) -> dict:
+        offsets = self.tables["name_offsets"]
+        name = self.tables["names"][offsets[number]:offsets[number + 1]].tobytes().decode('utf-8')
+        return {"asn": int(self.tables["asns"][number]), "country": self.tables["countries"][number].decode('ascii'), "name": name}
+
+    def _lookup(self, ip: str):
+        #The network ip is in as a dict (asn, country, name), or None if it isn't in any of the ranges.
+        key = ip_key(ip)
+        if key is None:
+            return None
+        import numpy as np
+        version, value = key
+        starts = self.tables[f"v{version}_starts"]
+        #The last range starting at or before the IP, a bisect_right done by numpy over the mapped array.
+        #It only counts if the IP is also before that range's end.
+        #The value has to be a uint64 too, a plain int would make numpy convert the whole table to float first.
+        position = int(starts.searchsorted(np.uint64(value), side='right')) - 1
+        if position < 0 or int(self.tables[f"v{version}_ends"][position]) < value:
+            return None
+        return self.network(int(self.tables[f"v{version}_networks"][position]))
+
+    def network_numbers(self, ips) -> list:
+        """The network number of every IP in ips (-1 for no network), found with one binary search per IP family."""
+        import numpy as np
+        keys = [ip_key(ip) for ip in ips]
+        numbers = np.full(len(keys), -1, dtype=np.int64)
+        for version in (4, 6):
+            rows = np.array([row for row, key in enumerate(keys) if key is not None and key[0] == version], dtype=np.int64)
+            if not len(rows) or not len(self.tables[f"v{version}_starts"]):
+                continue
+            values = np.array([keys[row][1] for row in rows], dtype='u8')
+            positions = self.tables[f"v{version}_starts"].searchsorted(values, side='right') - 1
+            found = positions >= 0
+            found[found] = self.tables[f"v{version}_ends"][positions[found]] >= values[found]
+            numbers[rows[found]] = self.tables[f"v{version}_networks"][positions[found]]
+        return numbers
+
+    def __len__(self) -> int:
+        return len(self.tables["v4_starts"]) + len(self.tables["v6_starts"])
+
+
+def aggregate_by_network(index: IPNetworkIndex, ips, visits, limit: int = IP_NETWORKS_TOP_N) -> dict:
+    """Add up visits and visitors per network (ASN). Returns the totals and the top limit networks by visits."""
+    import numpy as np
+    visits = np.asarray(visits, dtype=np.int64)
+    keep = np.flatnonzero(visits > 0)
+    ips = [ips[row] for row in keep]
+    visits = visits[keep]
+    #Shifted up by one so "no network" (-1) gets a bucket of its own at 0.
+    buckets = index.network_numbers(ips) + 1
+    size = len(index.tables["asns"]) + 1
+    visits_per = np.bincount(buckets, weights=visits, minlength=size)
+    visitors_per = np.bincount(buckets, minlength=size)
+    used = np.flatnonzero(visitors_per)
+    top = used[np.lexsort((used, -visits_per[used]))][:limit]
+    return {
+        "networks": len(used),
+        "visitors": len(ips),
+        "visits": int(visits.sum()),
+        "top": [dict(index.network(bucket - 1) if bucket else _UNKNOWN, visits=int(visits_per[bucket]), visitors=int(visitors_per[bucket]))
+                for bucket in top],
+    }
+
+
+def network_sections(aggregate: dict, label: str = "this week's new and returning visits") -> list:
+    """The per network totals as prompt sections, same (name, text) shape as visitor_diff.diff_sections."""
+    if not aggregate["top"]:
+        return []
+    lines = [f"Networks behind {label}: {aggregate['visits']} visits from {aggregate['visitors']} visitors "
+             f"across {aggregate['networks']} networks. Biggest first (ASN, network, country, visits, visitors):"]
+    lines += [f"AS{network['asn']}, {network['name']}, {network['country'] or '??'}, {network['visits']}, {network['visitors']}"
+              for network in aggregate["top"]]
+    return [("networks", '\n'.join(lines))]
+
+
+def aggregate_diff(index: IPNetworkIndex, diff: dict, limit: int = IP_NETWORKS_TOP_N) -> dict:
+    """aggregate_by_network over a visitor diff's activity: every new visitor's visits plus the increase for returning ones."""
+    ips = [ip for ip, _ in diff["new"]] + [ip for ip, _, _, delta in diff["changed"] if delta > 0]
+    visits = [visits for _, visits in diff["new"]] + [delta for _, _, _, delta in diff["changed"] if delta > 0]
+    return aggregate_by_network(index, ips, visits, limit)
+
+
+def annotate(index: IPNetworkIndex, items: list) -> None:
+    #Adds a "network" label to every dict in items that has an "ip", e.g. the spikes and bursts from visitor_anomalies.py
+    for item in items:
+        item["network"] = describe(index, item["ip"])
+
+
+def describe(index: IPNetworkIndex, ip: str) -> str:
+    #Short label for one IP, e.g. for the anomaly list.
+    network = index.lookup(ip) if index is not None else None
+    if network is None:
+        return "unknown network"
+    return f"AS{network['asn']} {network['name']}, {network['country'] or '??'}"
+
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def get_ip_index():
+    """This worker's IP network index, built or mapped the first time it's asked for. None if there's no data to build it from."""
+    global _index, _index_loaded
+    with _index_lock:
+        if not _index_loaded:
+            _index_loaded = True
+            started = time.perf_counter()
+            try:
+                if os.path.exists(_path(IP_NETWORKS_INDEX)):
+                    _index = IPNetworkIndex.load(_path(IP_NETWORKS_INDEX))
+                elif os.path.exists(_path(IP_NETWORKS_CSV)):
+                    _index = IPNetworkIndex.from_csv(_path(IP_NETWORKS_CSV))
+                else:
+                    logging.warning(f"No {IP_NETWORKS_INDEX} or {IP_NETWORKS_CSV} found, visitors won't get network details")
+            except Exception as e:
+                logging.error(f"Could not load the IP network data, visitors won't get network details: {e}")
+                _index = None
+            if _index is not None:
+                logging.warning(f"Loaded {len(_index)} IP ranges from {_index.source} in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return _index
+
+
+if __name__ == '__main__':
+    #python ip_enrichment.py build [networks.csv] [ip_networks.ipidx]
+    #python ip_enrichment.py lookup 1.2.3.4 ...
+    if len(sys.argv) >= 2 and sys.argv[1] == 'build':
+        source = sys.argv[2] if len(sys.argv) > 2 else _path(IP_NETWORKS_CSV)
+        target = sys.argv[3] if len(sys.argv) > 3 else _path(IP_NETWORKS_INDEX)
+        started = time.perf_counter()
+        built = IPNetworkIndex.from_csv(source)
+        size = built.save(target)
+        print(f"{len(built)} ranges and {len(built.tables['asns'])} networks from {source} -> {target} ({size} bytes) "
+              f"in {time.perf_counter() - started:.1f}s")
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'lookup':
+        for address in sys.argv[2:]:
+            print(f"{address}: {describe(get_ip_index(), address)}")
+    else:
+        print("usage: python ip_enrichment.py build [networks.csv] [ip_networks.ipidx] | lookup IP ...")
@@ -0,0 +1,95 @@
+import os
+import asyncio
+import logging
+from prompt_builder import count_tokens
+
+#This file is the one place the functions ask the model for a completion.
+#It asks for the answer as a stream (stream=True) and glues the pieces together as they arrive, which means I can see
+#how long the model took to start answering (time to first token) and how fast it answered after that (tokens per second).
+#Every call also has a deadline. If the model is still going when it runs out, the stream is closed and whatever
+#text has arrived so far is returned with timed_out set, so a slow model can't hold the worker for the whole function timeout.
+
+#How long one completion is allowed to take, start to finish.
+LLM_DEADLINE_SECONDS = float(os.getenv('LLM_DEADLINE_SECONDS', '90'))
+
+
+async def _close(stream) -> None:
+    #Closing the stream drops the HTTP connection so the model stops sending (and I stop paying for) the rest.
+    close = getattr(stream, "close", None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        logging.warning(f"Could not close the completion stream: {e}")
+
+
+async def stream_completion(client, model: str, messages: list, deadline_seconds: float = LLM_DEADLINE_SECONDS, **kwargs):
+    """Stream a chat completion from an async OpenAI client. Returns (text, metrics).
+
+    text is everything received before the stream finished or the deadline
+    hit. metrics has ttft_ms (time to first token), total_ms, tokens,
+    tokens_per_second (after the first token), chunks, finish_reason and
+    timed_out. Errors from the API itself are raised as normal.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + deadline_seconds
+    pieces = []
+    first_token = None
+    chunks = 0
+    finish_reason = None
+    timed_out = False
+    stream = None
+    try:
+        stream = await asyncio.wait_for(
+            client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs), deadline_seconds)
+        chunk_iterator = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunk_iterator.__anext__(), max(deadline - loop.time(), 0))
+            except StopAsyncIteration:
+                break
+            chunks += 1
+            #Azure sends a first chunk with no choices that only has the content filter results in it.
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta is not None and choice.delta.content:
+                if first_token is None:
+                    first_token = loop.time()
+                pieces.append(choice.delta.content)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    except asyncio.TimeoutError:
+        timed_out = True
+        logging.error(f"{model} didn't finish within {deadline_seconds}s, keeping the {len(''.join(pieces))} characters received so far")
+    finally:
+        if stream is not None and (timed_out or finish_reason is None):
+            await _close(stream)
+
+    finished = loop.time()
+    text = ''.join(pieces)
+    tokens = count_tokens(text) if text else 0
+    generating = finished - first_token if first_token is not None else 0
+    metrics = {
+        "model": model,
+        "ttft_ms": round((first_token - started) * 1000, 1) if first_token is not None else None,
+        "total_ms": round((finished - started) * 1000, 1),
+        "tokens": tokens,
+        "tokens_per_second": round(tokens / generating, 1) if generating > 0 else None,
+        "chunks": chunks,
+        "finish_reason": finish_reason,
+        "timed_out": timed_out,
+    }
+    return text, metrics
+
+
+def format_metrics(metrics: dict) -> str:
+    ttft = f"{metrics['ttft_ms']:.0f} ms" if metrics["ttft_ms"] is not None else "no tokens"
+    speed = f"{metrics['tokens_per_second']:.1f} tokens/s" if metrics["tokens_per_second"] is not None else "- tokens/s"
+    status = "TIMED OUT" if metrics["timed_out"] else metrics["finish_reason"]
+    return (f"{metrics['model']}: first token {ttft}, {metrics['tokens']} tokens in {metrics['total_ms']:.0f} ms, "
+            f"{speed} ({status})")
@@ -0,0 +1,148 @@
+import os
+import math
+import logging
+import ipaddress
+from visitor_diff import diff_sections, format_totals
+
+#This file builds the analyse_visits prompt and makes sure it fits in a token budget.
+#If the whole visitor diff doesn't fit it steps down until something does:
+#   1. full     every new, gone and changed visitor
+#   2. top_n    only the biggest movers in each list
+#   3. subnets  visitors grouped into /24 subnets (/48 for IPv6), biggest movers first
+#   4. summary  just the totals
+#Facts worked out locally (the anomalies from visitor_anomalies.py) are kept at every level, they're already capped in size.
+#Tokens are counted locally with tiktoken if it's installed, otherwise estimated at roughly 4 characters per token.
+#Each level only formats as many lines as it keeps, and a level that's obviously too long by its character count
+#(or, for the full diff, by its number of lines) is skipped without being formatted or tokenized at all.
+
+#The most tokens the prompt is allowed to use. Leave room under the deployment's context window for the answer.
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '3000'))
+#How many of the biggest movers to keep per list when the full diff doesn't fit.
+PROMPT_TOP_N = int(os.getenv('PROMPT_TOP_N', '50'))
+#Bump this whenever the instructions or the layout of the prompt change, it's part of the LLM cache key (see completion_cache.py).
+PROMPT_TEMPLATE_VERSION = '3'
+#Which tiktoken encoding to count with. cl100k_base matches the gpt-35-turbo and gpt-4 deployments.
+PROMPT_TOKEN_ENCODING = os.getenv('PROMPT_TOKEN_ENCODING', 'cl100k_base')
+#No real prompt gets more than this many characters into a token (IP lists are nearer 3, English text about 4),
+#so anything longer than budget x this can't fit and isn't worth counting.
+PROMPT_MAX_CHARS_PER_TOKEN = 8
+
+#tiktoken is loaded the first time something is counted rather than on import, it's slow to load and only analyse_visits needs it.
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(PROMPT_TOKEN_ENCODING)
+        except Exception:
+            #tiktoken is optional, the estimate below is close enough for English text and IP lists.
+            _encoding = None
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+
+def subnet_of(ip: str) -> str:
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    prefix = 24 if address.version == 4 else 48
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+def group_by_subnet(diff: dict) -> dict:
+    """Roll a visitor diff up into subnets. Same shape as visitor_diff.diff_snapshots returns."""
+    new = {}
+    gone = {}
+    changed = {}
+    for ip, visits in diff["new"]:
+        subnet = subnet_of(ip)
+        new[subnet] = new.get(subnet, 0) + visits
+    for ip, visits in diff["gone"]:
+        subnet = subnet_of(ip)
+        gone[subnet] = gone.get(subnet, 0) + visits
+    for ip, before, after, _ in diff["changed"]:
+        subnet = subnet_of(ip)
+        was_before, was_after = changed.get(subnet, (0, 0))
+        changed[subnet] = (was_before + before, was_after + after)
+    return {
+        "new": sorted(new.items(), key=lambda item: (-item[1], item[0])),
+        "gone": sorted(gone.items(), key=lambda item: (-item[1], item[0])),
+        "changed": sorted(((subnet, before, after, after - before) for subnet, (before, after) in changed.items()),
+                          key=lambda item: (-abs(item[3]), item[0])),
+        "totals": diff["totals"],
+    }
+
+
+def _assemble(instructions: str, sections: list) -> str:
+    return '\n\n'.join([instructions] + [text for _, text in sections])
+
+
+def _section_tokens(instructions: str, sections: list) -> dict:
+    section_tokens = {"instructions": count_tokens(instructions)}
+    for name, text in sections:
+        section_tokens[name] = count_tokens(text)
+    return section_tokens
+
+
+def _attempts(diff: dict, top_n: int, budget: int):
+    #Each level is only formatted if the one before it didn't fit.
+    #Every line of the full diff is at least a token, so with more lines than the budget it isn't even formatted.
+    if len(diff["new"]) + len(diff["changed"]) + len(diff["gone"]) <= budget:
+        yield "full", None, diff_sections(diff)
+    #Halve the number of movers each time until it fits, first per IP and then per subnet.
+    limit = top_n
+    while limit >= 1:
+        yield "top_n", limit, diff_sections(diff, limit)
+        limit //= 2
+    subnets = group_by_subnet(diff)
+    limit = top_n
+    while limit >= 1:
+        yield "subnets", limit, diff_sections(subnets, limit, label="Subnet")
+        limit //= 2
+    #The totals on their own, without formatting the rest of the diff just to throw it away.
+    yield "summary", None, [("totals", format_totals(diff["totals"]))]
+
+
+def build_prompt(instructions: str, diff: dict, budget: int = PROMPT_TOKEN_BUDGET, top_n: int = PROMPT_TOP_N,
+                 facts: list = ()):
+    """Build the prompt from the instructions and a visitor diff without going over budget tokens.
+
+    facts is a list of extra (section name, text) sections, e.g. from
+    visitor_anomalies.anomaly_sections, that go after the diff at every level.
+
+    Returns (prompt, report). The report says which level was used (and how
+    many movers per list for top_n and subnets), the budget, the total token
+    count and how many tokens each section took.
+    """
+    for level, level_limit, sections in _attempts(diff, top_n, budget):
+        sections = sections + list(facts)
+        prompt = _assemble(instructions, sections)
+        #The summary is the last resort so it's always counted, even if it's too long.
+        if level != "summary" and len(prompt) > budget * PROMPT_MAX_CHARS_PER_TOKEN:
+            continue
+        total = count_tokens(prompt)
+        if total <= budget:
+            break
+    #Only the level that's used gets its sections counted for the report.
+    report = {"level": level, "top_n": level_limit, "budget": budget, "total": total,
+              "sections": _section_tokens(instructions, sections)}
+    if total > budget:
+        logging.error(f"Prompt is still {total} tokens with only the summary, over the budget of {budget}")
+    return prompt, report
+
+
+def format_report(report: dict) -> str:
+    sections = ', '.join(f"{name} {tokens}" for name, tokens in report["sections"].items())
+    return f"Prompt used {report['total']} of {report['budget']} tokens at level '{report['level']}' ({sections})"
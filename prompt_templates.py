@@ -0,0 +1,63 @@
+#This file is the one list of chat personas and the questions I ask them, so the persona functions
+#(ChatWithBillGates.py, Chatwithsam.py and the optional persona_digest timer in function_app.py) don't each hard-code their own prompt.
+#A persona is a system message that says who the model is pretending to be (the persona_digest timer sends it, the two
+#persona functions leave it off and only send their question, same as they always have). A question is a template that gets
+#filled in with format() when the batch is built, e.g. {date}. Questions registered for '*' are asked of every persona.
+#chat_batch.py runs personas x questions through the model concurrently.
+
+PERSONAS = {}
+QUESTIONS = {}
+
+
+def register_persona(name: str, system: str) -> None:
+    PERSONAS[name] = system
+
+
+def register_question(persona: str, key: str, template: str) -> None:
+    """Add a question for persona, or for every persona with '*'. Re-registering a key replaces it."""
+    QUESTIONS.setdefault(persona, {})[key] = template
+
+
+def questions_for(persona: str) -> dict:
+    #The questions every persona gets, then this persona's own.
+    return {**QUESTIONS.get('*', {}), **QUESTIONS.get(persona, {})}
+
+
+def render(persona: str, question: str, persona_message: bool = True, **values) -> list:
+    """The chat messages for one persona and question, with values filled into the template. Raises KeyError for unknown names.
+
+    With persona_message False there's no system message, only the question, the way the persona functions have always asked it.
+    """
+    template = questions_for(persona)[question]
+    messages = [{"role": "user", "content": template.format(**values)}]
+    if persona_message:
+        messages.insert(0, {"role": "system", "content": PERSONAS[persona]})
+    return messages
+
+
+def batch_jobs(personas: list = None, questions: list = None, persona_message: bool = True, **values) -> list:
+    """Every persona x question pair as {"persona", "question", "messages"}, ready for chat_batch.run_batch.
+
+    personas and questions default to everything registered. A question is
+    skipped for a persona that doesn't have it. persona_message is passed on to render.
+    """
+    jobs = []
+    for persona in personas or list(PERSONAS):
+        available = questions_for(persona)
+        for question in questions or list(available):
+            if question in available:
+                messages = render(persona, question, persona_message, **values)
+                jobs.append({"persona": persona, "question": question, "messages": messages})
+    return jobs
+
+
+register_persona("bill_gates", "You are Bill Gates, co-founder of Microsoft. Answer the way he would, in the first person.")
+register_persona("sam_altman", "You are Sam Altman, CEO of OpenAI. Answer the way he would, in the first person.")
+
+#The prompts the two persona functions used to hard-code.
+register_question("bill_gates", "megasoft", '''Bill I need you to explain the following:
+                            Why did you name Microsoft Microsoft and not Megasoft?''')
+register_question("sam_altman", "whats_next", '''Hello Sam, whats next in the OpenAI adventure?''')
+#Asked of everyone.
+register_question('*', "this_week", "It's {date}. What's the one thing you'd want a cloud engineer to be learning this week?")
+register_question('*', "advice", "What's the best piece of advice you've had about building things that last?")
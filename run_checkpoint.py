@@ -0,0 +1,47 @@
+import json
+import logging
+from azure.core.exceptions import ResourceNotFoundError
+
+#This file lets a retry of dbqueryandsave pick up where the failed attempt left off instead of starting again from the top.
+#Every stage that finishes is written to a small JSON checkpoint blob for that function and run date, along with whatever
+#the later stages need from it (e.g. the export's filename, size and MD5). On a retry, finished stages are skipped and their saved
+#results are used instead, so a failure after the export only costs the stages after it, not another full query and upload.
+#
+#   results/checkpoints/dbqueryandsave_20240517.json
+#   {"function": "dbqueryandsave", "run_date": "20240517", "stages": {"export": {...}, "verify": {...}}}
+
+CHECKPOINT_CONTAINER = "results"
+CHECKPOINT_PREFIX = "checkpoints/"
+
+
+class RunCheckpoint:
+    def __init__(self, blob_client, function_name: str, run_date: str, stages: dict = None):
+        self.blob_client = blob_client
+        self.function_name = function_name
+        self.run_date = run_date
+        self.stages = stages or {}
+
+    @classmethod
+    def load(cls, blob_service_client, function_name: str, run_date: str) -> "RunCheckpoint":
+        """Read the checkpoint for this function and run date, or start an empty one if this is the first attempt."""
+        blob_client = blob_service_client.get_blob_client(CHECKPOINT_CONTAINER,
+                                                          f"{CHECKPOINT_PREFIX}{function_name}_{run_date}.json")
+        try:
+            state = json.loads(blob_client.download_blob().readall().decode('utf-8'))
+        except ResourceNotFoundError:
+            return cls(blob_client, function_name, run_date)
+        logging.warning(f"Resuming {function_name} for {run_date}, already finished: {', '.join(state['stages']) or 'nothing'}")
+        return cls(blob_client, function_name, run_date, state["stages"])
+
+    def done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def get(self, stage: str) -> dict:
+        return self.stages[stage]
+
+    def complete(self, stage: str, **results) -> None:
+        #Written straight away so the stage counts as done even if the very next line fails.
+        #results has to be plain JSON (no bytes or datetimes).
+        self.stages[stage] = results
+        state = {"function": self.function_name, "run_date": self.run_date, "stages": self.stages}
+        self.blob_client.upload_blob(json.dumps(state), overwrite=True)
@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import bisect
+import datetime
+import logging
+from azure.core.exceptions import ResourceNotFoundError
+from blob_compression import codec_for, upload_compressed, download_bytes, download_bytes_async
+
+#This file keeps a catalog of every visitors snapshot in one small blob next to them, so nobody has to guess blob names
+#from today's date or list the whole results container to find out what's there.
+#dbqueryandsave adds an entry every time it writes a snapshot (or an incremental delta). Each entry has:
+#   date, name, format (vsnap, txt or delta), bytes stored, rows, the MD5 of the stored bytes and the compression it was saved with.
+#The entries are kept sorted by date, so the nearest snapshot on or before a day, or every snapshot in a date range,
+#is a binary search over the one blob that was read.
+#In incremental mode most days only have a delta, so a day's view is the nearest full snapshot plus the deltas written after it (view).
+#If the catalog doesn't exist yet the first write builds it from a single listing of the container (rebuild_catalog),
+#those older entries have no row count. Readers that find no catalog at all fall back to the exact date names.
+#Only dbqueryandsave writes it, and timer triggers only run one at a time, so a read-modify-write is safe.
+
+SNAPSHOT_CATALOG_BLOB = os.getenv('SNAPSHOT_CATALOG_BLOB', 'snapshotcatalog.json')
+SNAPSHOT_CATALOG_VERSION = 1
+#The formats a reader can load on their own. A delta is only the rows that changed, so it's catalogued but never picked as a snapshot.
+FULL_FORMATS = ('vsnap', 'txt')
+
+#visitors20240517.vsnap, visitors20240517.txt, visitors20240517.delta.txt
+_SNAPSHOT_NAME = re.compile(r'visitors(\d{8})(\.vsnap|\.delta\.txt|\.txt)$')
+_FORMATS = {'.vsnap': 'vsnap', '.txt': 'txt', '.delta.txt': 'delta'}
+
+
+def empty_catalog() -> dict:
+    return {"version": SNAPSHOT_CATALOG_VERSION, "snapshots": []}
+
+
+def parse_snapshot_name(name: str):
+    """(date, format) for a snapshot blob name, or None if it isn't one."""
+    match = _SNAPSHOT_NAME.fullmatch(name)
+    if not match:
+        return None
+    return match.group(1), _FORMATS[match.group(2)]
+
+
+def make_entry(name: str, byte_count: int, row_count, content_md5, encoding=None) -> dict:
+    day, snapshot_format = parse_snapshot_name(name)
+    if isinstance(content_md5, (bytes, bytearray)):
+        content_md5 = bytes(content_md5).hex()
+    return {"date": day, "name": name, "format": snapshot_format, "bytes": byte_count, "rows": row_count,
+            "md5": content_md5, "encoding": encoding}
+
+
+def add_entry(catalog: dict, entry: dict) -> dict:
+    #Same name replaces the old entry (a retry or a re-run), otherwise it goes in at its place in date order.
+    snapshots = [existing for existing in catalog["snapshots"] if existing["name"] != entry["name"]]
+    snapshots.append(entry)
+    snapshots.sort(key=lambda snapshot: (snapshot["date"], snapshot["name"]))
+    catalog["snapshots"] = snapshots
+    return catalog
+
+
+def decode_catalog(data: bytes) -> dict:
+    catalog = json.loads(data.decode('utf-8'))
+    if catalog.get("version") != SNAPSHOT_CATALOG_VERSION:
+        raise ValueError(f"Unsupported snapshot catalog version {catalog.get('version')}")
+    return catalog
+
+
+def load_catalog(blob_service_client, container: str = "results"):
+    """The catalog, or None if there isn't one yet."""
+    try:
+        return decode_catalog(download_bytes(blob_service_client.get_blob_client(container, SNAPSHOT_CATALOG_BLOB)))
+    except ResourceNotFoundError:
+        return None
+
+
+async def load_catalog_async(blob_service_client, container: str = "results"):
+    #Same as load_catalog for the azure.storage.blob.aio client analyse_visits uses.
+    try:
+        return decode_catalog(await download_bytes_async(blob_service_client.get_blob_client(container, SNAPSHOT_CATALOG_BLOB)))
+    except ResourceNotFoundError:
+        return None
+
+
+def save_catalog(blob_service_client, catalog: dict, container: str = "results") -> int:
+    return upload_compressed(blob_service_client.get_blob_client(container, SNAPSHOT_CATALOG_BLOB), json.dumps(catalog),
+                             overwrite=True, content_type="application/json")
+
+
+def rebuild_catalog(blob_service_client, container: str = "results") -> dict:
+    """Build a catalog from one listing of the container. Row counts aren't in the listing so they're left as None."""
+    catalog = empty_catalog()
+    for blob in blob_service_client.get_container_client(container).list_blobs(name_starts_with="visitors"):
+        if parse_snapshot_name(blob.name) is None:
+            continue
+        settings = blob.content_settings
+        add_entry(catalog, make_entry(blob.name, blob.size, None, settings.content_md5 if settings else None,
+                                      settings.content_encoding if settings else None))
+    logging.warning(f'Built the snapshot catalog from a listing, found {len(catalog["snapshots"])} snapshots')
+    return catalog
+
+
+def record_snapshot(blob_service_client, name: str, byte_count: int, row_count: int, content_md5,
+                    container: str = "results") -> dict:
+    """Add (or replace) name's entry in the catalog and save it. One small read and one small write. Returns the entry."""
+    catalog = load_catalog(blob_service_client, container)
+    if catalog is None:
+        catalog = rebuild_catalog(blob_service_client, container)
+    entry = make_entry(name, byte_count, row_count, content_md5, codec_for(name))
+    save_catalog(blob_service_client, add_entry(catalog, entry), container)
+    return entry
+
+
+def _full_snapshots(catalog: dict, formats=FULL_FORMATS) -> list:
+    return [snapshot for snapshot in catalog["snapshots"] if snapshot["format"] in formats]
+
+
+def nearest(catalog: dict, day: str, formats=FULL_FORMATS):
+    """The latest snapshot on or before day (YYYYMMDD), or None. If a day has both a .vsnap and a .txt the .vsnap wins."""
+    snapshots = _full_snapshots(catalog, formats)
+    position = bisect.bisect_right([snapshot["date"] for snapshot in snapshots], day)
+    if not position:
+        return None
+    day_found = snapshots[position - 1]["date"]
+    same_day = [snapshot for snapshot in snapshots[:position] if snapshot["date"] == day_found]
+    return min(same_day, key=lambda snapshot: FULL_FORMATS.index(snapshot["format"]) if snapshot["format"] in FULL_FORMATS else 0)
+
+
+def between(catalog: dict, start: str, end: str, formats=FULL_FORMATS) -> list:
+    """Every snapshot from start to end (YYYYMMDD, both included), oldest first."""
+    snapshots = _full_snapshots(catalog, formats)
+    dates = [snapshot["date"] for snapshot in snapshots]
+    return snapshots[bisect.bisect_left(dates, start):bisect.bisect_right(dates, end)]
+
+
+def view(catalog: dict, day: str):
+    """Everything needed to see the visitors as of day: {"date", "base", "deltas"}, or None if nothing is early enough.
+
+    base is the nearest full snapshot on or before day and deltas are the
+    incremental deltas written after it up to day, oldest first. date is the
+    newest of those. A delta on the same day as its base is already in it
+    (that's the day the deltas got compacted), so it's left out.
+    """
+    base = nearest(catalog, day)
+    if base is None:
+        return None
+    deltas = [delta for delta in between(catalog, base["date"], day, formats=('delta',)) if delta["date"] > base["date"]]
+    return {"date": deltas[-1]["date"] if deltas else base["date"], "base": base, "deltas": deltas}
+
+
+def describe_view(snapshot_view: dict) -> str:
+    deltas = len(snapshot_view["deltas"])
+    return snapshot_view["base"]["name"] + (f" + {deltas} delta{'s' if deltas > 1 else ''}" if deltas else '')
+
+
+def resolve_pair(catalog: dict, this_day: str, last_day: str):
+    """The views to compare: this_day's, and last_day's or the nearest view older than this_day's.
+
+    Either can be None if there's nothing early enough.
+    """
+    current = view(catalog, this_day)
+    if current is None:
+        return None, None
+    day_before = (datetime.datetime.strptime(current["date"], "%Y%m%d") - datetime.timedelta(days=1)).strftime("%Y%m%d")
+    return current, view(catalog, min(last_day, day_before))
@@ -0,0 +1,235 @@
+import re
+import ast
+import json
+import zlib
+import struct
+from array import array
+
+#This file defines the .vsnap format I use for visitor snapshots instead of the old repr-of-Row .txt files.
+#
+#Layout (all numbers little endian):
+#   b'VSNP'                      magic
+#   uint16 version               SNAPSHOT_VERSION
+#   uint32 + json                length prefixed schema, e.g. {"columns": [["ip", "utf8"], ["visits", "int64"]]}
+#   row groups, each one:
+#       uint32 row count
+#       uint32 + zlib bytes      the IPs for this group joined with '\n'
+#       uint32 + zlib bytes      the visit counts for this group as raw int64s
+#   uint32 0                     a row group with no rows marks the end of the file
+#
+#Each row group is one batch from the cursor, so the writer never holds more than a batch
+#and the reader can hand back rows as soon as the first group has arrived.
+
+SNAPSHOT_MAGIC = b'VSNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SCHEMA = {"columns": [["ip", "utf8"], ["visits", "int64"]]}
+SNAPSHOT_EXTENSION = ".vsnap"
+
+
+class SnapshotFormatError(ValueError):
+    pass
+
+
+def _int64s(values) -> array:
+    counts = array('q', values)
+    #array uses the machine's byte order, the file is always little endian.
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        counts.byteswap()
+    return counts
+
+
+def encode_header() -> bytes:
+    schema = json.dumps(SNAPSHOT_SCHEMA).encode('utf-8')
+    return SNAPSHOT_MAGIC + struct.pack('<HI', SNAPSHOT_VERSION, len(schema)) + schema
+
+
+def encode_row_group(ips, counts) -> bytes:
+    ip_block = zlib.compress('\n'.join(ips).encode('utf-8'))
+    count_block = zlib.compress(_int64s(counts).tobytes())
+    return (struct.pack('<II', len(ips), len(ip_block)) + ip_block
+            + struct.pack('<I', len(count_block)) + count_block)
+
+
+def encode_row_batch(rows, ip_index: int = 0, count_index: int = 1) -> bytes:
+    #One batch of database rows as a row group.
+    return encode_row_group([str(row[ip_index]) for row in rows], [int(row[count_index]) for row in rows])
+
+
+def encode_footer() -> bytes:
+    return struct.pack('<I', 0)
+
+
+def encode_snapshot(row_batches, ip_index: int = 0, count_index: int = 1):
+    """Yield a .vsnap file piece by piece from an iterable of row batches.
+
+    Each batch becomes one row group. ip_index and count_index say which
+    column of the row is the IP and which is the visit count.
+    """
+    yield encode_header()
+    for rows in row_batches:
+        if not rows:
+            continue
+        yield encode_row_batch(rows, ip_index, count_index)
+    yield encode_footer()
+
+
+class _SnapshotDecoder:
+    #Bytes get fed in as they arrive (e.g. from download_blob().chunks()) and finished row groups come out,
+    #so the same decoder works for the sync and the async reader.
+    def __init__(self):
+        self._buffer = bytearray()
+        self._header_read = False
+        self.finished = False
+
+    def _read_header(self) -> bool:
+        if len(self._buffer) < 10:
+            return False
+        if bytes(self._buffer[:4]) != SNAPSHOT_MAGIC:
+            raise SnapshotFormatError("Not a visitor snapshot")
+        version, schema_length = struct.unpack('<HI', bytes(self._buffer[4:10]))
+        if version > SNAPSHOT_VERSION:
+            raise SnapshotFormatError(f"Snapshot version {version} is newer than this reader ({SNAPSHOT_VERSION})")
+        if len(self._buffer) < 10 + schema_length:
+            return False
+        schema = json.loads(bytes(self._buffer[10:10 + schema_length]).decode('utf-8'))
+        if schema != SNAPSHOT_SCHEMA:
+            raise SnapshotFormatError(f"Unexpected snapshot schema {schema}")
+        del self._buffer[:10 + schema_length]
+        self._header_read = True
+        return True
+
+    def _read_row_group(self):
+        #Only consumes the buffer once the whole row group is there.
+        if len(self._buffer) < 4:
+            return None
+        (row_count,) = struct.unpack('<I', bytes(self._buffer[:4]))
+        if row_count == 0:
+            del self._buffer[:4]
+            self.finished = True
+            return None
+        offset = 4
+        if len(self._buffer) < offset + 4:
+            return None
+        (ip_length,) = struct.unpack('<I', bytes(self._buffer[offset:offset + 4]))
+        ip_start = offset + 4
+        count_length_start = ip_start + ip_length
+        if len(self._buffer) < count_length_start + 4:
+            return None
+        (count_length,) = struct.unpack('<I', bytes(self._buffer[count_length_start:count_length_start + 4]))
+        count_start = count_length_start + 4
+        if len(self._buffer) < count_start + count_length:
+            return None
+        ip_block = bytes(self._buffer[ip_start:count_length_start])
+        count_block = bytes(self._buffer[count_start:count_start + count_length])
+        del self._buffer[:count_start + count_length]
+
+        ips = zlib.decompress(ip_block).decode('utf-8').split('\n')
+        counts = array('q')
+        counts.frombytes(zlib.decompress(count_block))
+        if struct.pack('=H', 1) != struct.pack('<H', 1):
+            counts.byteswap()
+        if len(ips) != row_count or len(counts) != row_count:
+            raise SnapshotFormatError("Row group is corrupt")
+        return ips, counts
+
+    def feed(self, chunk: bytes) -> list:
+        """Add a chunk of the file and return any row groups it completed as [(ips, counts)]."""
+        if self.finished:
+            return []
+        self._buffer += chunk
+        if not self._header_read and not self._read_header():
+            return []
+        groups = []
+        while not self.finished:
+            group = self._read_row_group()
+            if group is None:
+                break
+            groups.append(group)
+        return groups
+
+    def close(self) -> None:
+        if not self.finished:
+            raise SnapshotFormatError("Snapshot ended unexpectedly")
+
+
+def iter_row_groups(chunks):
+    """Read a .vsnap file from an iterable of byte chunks, yielding (ips, counts) per row group."""
+    decoder = _SnapshotDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    decoder.close()
+
+
+def read_snapshot(chunks):
+    """Load a whole .vsnap file into a list of IPs and an int64 array of visit counts."""
+    ips = []
+    counts = array('q')
+    for group_ips, group_counts in iter_row_groups(chunks):
+        ips.extend(group_ips)
+        counts.extend(group_counts)
+    return ips, counts
+
+
+async def read_snapshot_async(chunks):
+    """Same as read_snapshot but for an async iterable of chunks, e.g. the aio download_blob().chunks()."""
+    decoder = _SnapshotDecoder()
+    ips = []
+    counts = array('q')
+    async for chunk in chunks:
+        for group_ips, group_counts in decoder.feed(chunk):
+            ips.extend(group_ips)
+            counts.extend(group_counts)
+    decoder.close()
+    return ips, counts
+
+
+#A text line is str() of a pyodbc Row, e.g. ('1.2.3.4', 5, datetime.datetime(2024, 5, 10, 12, 0)). Only the IP and
+#the count at the front get parsed, literal_eval can't read the datetime.datetime(...) (or Decimal(...)) that can come after them.
+_ROW_START = re.compile(r"""\(\s*('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")\s*,\s*(-?\d+)\s*[,)]""")
+
+
+def parse_row_line(line: str):
+    """(ip, visits) from one line of a text snapshot or delta."""
+    match = _ROW_START.match(line.strip())
+    if not match:
+        raise SnapshotFormatError(f"Not a visitor row: {line[:80]}")
+    return str(ast.literal_eval(match.group(1))), int(match.group(2))
+
+
+def parse_text_snapshot(text: str):
+    """Parse one of the old repr-of-Row visitors*.txt files into the same shape as read_snapshot."""
+    ips = []
+    counts = array('q')
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        ip, count = parse_row_line(line)
+        ips.append(ip)
+        counts.append(count)
+    return ips, counts
+
+
+def apply_deltas(ips, counts, deltas):
+    """Fold incremental deltas (each an (ips, counts) pair, oldest first) into a snapshot. Returns new (ips, counts).
+
+    A delta only has the visitors that changed, so an IP in a delta replaces
+    its count in the snapshot and an IP that isn't there yet is added on the end.
+    """
+    ips = list(ips)
+    counts = array('q', counts)
+    position = {ip: row for row, ip in enumerate(ips)}
+    for delta_ips, delta_counts in deltas:
+        for ip, count in zip(delta_ips, delta_counts):
+            row = position.get(ip)
+            if row is None:
+                position[ip] = len(ips)
+                ips.append(ip)
+                counts.append(count)
+            else:
+                counts[row] = count
+    return ips, counts
+
+
+def format_snapshot(ips, counts) -> str:
+    #Plain 'ip, visits' lines, which is what ends up in the prompt.
+    return '\n'.join(f"{ip}, {count}" for ip, count in zip(ips, counts))
@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import time
+import math
+import logging
+from blob_compression import upload_compressed, upload_compressed_async, download_bytes
+
+#This file times the numbered smoke test stages (#1 DB connect through #10 email).
+#Each stage gets a span with how long it took, how many bytes it moved, which retry attempt it was and whether it passed.
+#The spans are saved as JSON in the smoketests container next to the human readable smoketests_{date}.txt,
+#one file per function per run: smoketests_{date}_{function}.json
+#aggregate_stage_timings reads those back and works out p50/p95 per stage, so when a run gets slower I can see which stage did it.
+
+SMOKETESTS_CONTAINER = "smoketests"
+
+
+class StageTimings:
+    def __init__(self, function_name: str, run_date: str, retry_count: int = 0):
+        self.function_name = function_name
+        self.run_date = run_date
+        self.retry_count = retry_count
+        self.spans = {}
+
+    def start(self, number: int, name: str) -> None:
+        self.spans[number] = {"stage": number, "name": name, "started": time.time(), "_clock": time.perf_counter(),
+                              "duration_ms": None, "bytes": 0, "retries": self.retry_count, "ok": None}
+
+    def finish(self, number: int, ok: bool = True, bytes_moved: int = 0, error: str = None, resumed: bool = False) -> None:
+        span = self.spans.get(number)
+        if span is None or span["duration_ms"] is not None:
+            return
+        span["duration_ms"] = round((time.perf_counter() - span.pop("_clock")) * 1000, 3)
+        span["ok"] = bool(ok)
+        span["bytes"] = int(bytes_moved or 0)
+        if error:
+            span["error"] = error
+        #A retry that skipped this stage because an earlier attempt finished it, see run_checkpoint.py
+        if resumed:
+            span["resumed"] = True
+
+    async def timed(self, number: int, name: str, awaitable, bytes_of=None):
+        """Await awaitable inside a span. bytes_of turns the result into the number of bytes moved."""
+        self.start(number, name)
+        try:
+            result = await awaitable
+        except Exception as e:
+            self.finish(number, ok=False, error=str(e))
+            raise
+        self.finish(number, ok=True, bytes_moved=bytes_of(result) if bytes_of else 0)
+        return result
+
+    def fail_open_spans(self, error: Exception) -> None:
+        #Anything still running when an exception came through gets marked as failed by it.
+        for number, span in self.spans.items():
+            if span["duration_ms"] is None:
+                self.finish(number, ok=False, error=str(error))
+
+    def to_json(self) -> str:
+        spans = [{key: value for key, value in span.items() if not key.startswith('_')}
+                 for _, span in sorted(self.spans.items())]
+        return json.dumps({"function": self.function_name, "run_date": self.run_date,
+                           "retry_count": self.retry_count, "stages": spans}, indent=2)
+
+    @property
+    def blob_name(self) -> str:
+        return f"smoketests_{self.run_date}_{self.function_name}.json"
+
+    def upload(self, blob_service_client) -> None:
+        #Overwrites so a retry replaces the failed attempt's timings with its own.
+        #Gzipped like the rest of the smoketests container, see blob_compression.py
+        upload_compressed(blob_service_client.get_blob_client(SMOKETESTS_CONTAINER, self.blob_name), self.to_json(), overwrite=True,
+                          content_type="application/json")
+
+    async def upload_async(self, blob_service_client) -> None:
+        await upload_compressed_async(blob_service_client.get_blob_client(SMOKETESTS_CONTAINER, self.blob_name), self.to_json(),
+                                      overwrite=True, content_type="application/json")
+
+
+def percentile(values: list, fraction: float) -> float:
+    #Nearest rank percentile, good enough for a few dozen runs.
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def summarise(runs: list) -> dict:
+    """p50/p95 duration, average bytes and pass rate per stage across the given runs (parsed JSON dicts)."""
+    by_stage = {}
+    for run in runs:
+        for span in run["stages"]:
+            #Resumed stages didn't do any work this time, so they'd only drag the percentiles down.
+            if span["duration_ms"] is None or span.get("resumed"):
+                continue
+            by_stage.setdefault((span["stage"], span["name"]), []).append(span)
+    summary = {}
+    for (number, name), spans in sorted(by_stage.items()):
+        durations = [span["duration_ms"] for span in spans]
+        summary[f"#{number} {name}"] = {
+            "runs": len(spans),
+            "p50_ms": percentile(durations, 0.50),
+            "p95_ms": percentile(durations, 0.95),
+            "avg_bytes": sum(span["bytes"] for span in spans) / len(spans),
+            "pass_rate": sum(1 for span in spans if span["ok"]) / len(spans),
+        }
+    return summary
+
+
+def aggregate_stage_timings(blob_service_client, since: str = None) -> dict:
+    """Read every smoketests_*.json in the smoketests container (from since, YYYYMMDD, onwards) and summarise them."""
+    container_client = blob_service_client.get_container_client(SMOKETESTS_CONTAINER)
+    runs = []
+    for blob in container_client.list_blobs(name_starts_with="smoketests_"):
+        if not blob.name.endswith(".json"):
+            continue
+        if since and blob.name[len("smoketests_"):len("smoketests_") + 8] < since:
+            continue
+        runs.append(json.loads(download_bytes(container_client.get_blob_client(blob.name))))
+    return summarise(runs)
+
+
+def format_summary(summary: dict) -> str:
+    return '\n'.join(f"{stage:<32} runs {stats['runs']:>4}  p50 {stats['p50_ms']:>10.1f} ms  p95 {stats['p95_ms']:>10.1f} ms"
+                     f"  avg {stats['avg_bytes']:>12,.0f} B  passed {stats['pass_rate']:>4.0%}"
+                     for stage, stats in summary.items())
+
+
+#Run it straight from a terminal with the storage connection string set to get the p50/p95 table:
+#   AzureWebJobsStorage="..." python stage_timing.py [YYYYMMDD]
+if __name__ == '__main__':
+    from azure.storage.blob import BlobServiceClient
+    logging.basicConfig(level=logging.WARNING)
+    service = BlobServiceClient.from_connection_string(os.environ['AzureWebJobsStorage'])
+    print(format_summary(aggregate_stage_timings(service, sys.argv[1] if len(sys.argv) > 1 else None)))
@@ -0,0 +1,54 @@
+import os
+import sys
+import pytest
+
+#The tests import the repo's modules the same way the Functions host does (flat from the repo root),
+#and use the local service stand-ins the benchmarks use, so nothing here needs Azure.
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'benchmarks'))
+
+for setting in ('SQLDB_CONNECTION_STRING', 'AzureWebJobsStorage', 'BLOB_KEY', 'EMAIL_KEY'):
+    os.environ.setdefault(setting, 'standin')
+
+
+_functions = {}
+
+
+class App:
+    """function_app wired up to in-memory stand-ins: a SQLite ResumeVisitors table, blob storage, OpenAI and email."""
+
+    def __init__(self, visitors):
+        import standins
+        import function_app
+        from e2e_bench import user_functions
+        self.standins = standins
+        self.module = function_app
+        self.blobs = {}
+        self.blob = standins.MemoryBlobService(self.blobs)
+        self.blob_aio = standins.AsyncMemoryBlobService(self.blobs)
+        self.blob_aio.containers = self.blob.containers
+        self.pyodbc = standins.FakePyodbc(visitors)
+        sys.modules['pyodbc'] = self.pyodbc
+        function_app.clients.register("blob", lambda: self.blob)
+        function_app.clients.register("blob_aio", lambda: self.blob_aio)
+        function_app.clients.register("openai", lambda: standins.FakeOpenAI(0))
+        function_app.clients.register("email", lambda: standins.NullEmail())
+        #The pool keeps whatever it built for the last test, so drop those to get this test's stand-ins.
+        for name in ("blob", "blob_aio", "openai", "email"):
+            function_app.clients.invalidate(name)
+        #The FunctionApp only lets its functions be listed once.
+        if not _functions:
+            _functions.update(user_functions(function_app.app))
+        self.functions = _functions
+
+    def context(self, retry_count: int = 0):
+        context = self.standins.FakeContext("dbqueryandsave")
+        context.retry_context.retry_count = retry_count
+        return context
+
+
+@pytest.fixture
+def app():
+    import standins
+    return App(standins.make_visitors(2000))
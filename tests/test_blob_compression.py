@@ -0,0 +1,23 @@
+import gzip
+import standins
+from blob_compression import compress_block, decompress_chunks, download_bytes, upload_compressed
+
+
+def test_blocks_compressed_apart_read_back_as_one():
+    blocks = [f"('10.0.0.{n}', {n})\n".encode() * 50 for n in range(4)]
+    stored = b''.join(compress_block(block, 'gzip') for block in blocks)
+    #Whole gzip members glued together are still one valid gzip file, read here in awkward sized chunks.
+    chunks = [stored[i:i + 7] for i in range(0, len(stored), 7)]
+    assert b''.join(decompress_chunks(chunks, 'gzip')) == b''.join(blocks)
+    assert gzip.decompress(stored) == b''.join(blocks)
+
+
+def test_upload_compresses_text_but_not_vsnap():
+    blob_service_client = standins.MemoryBlobService({})
+    text = "('10.0.0.1', 3)\n" * 1000
+    text_blob = blob_service_client.get_blob_client("results", "visitors20240517.txt")
+    assert upload_compressed(text_blob, text, codec='gzip') < len(text)
+    assert download_bytes(text_blob) == text.encode()
+    vsnap_blob = blob_service_client.get_blob_client("results", "visitors20240517.vsnap")
+    assert upload_compressed(vsnap_blob, b'VSNAP' * 100, codec='gzip') == 500
+    assert download_bytes(vsnap_blob) == b'VSNAP' * 100
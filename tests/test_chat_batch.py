@@ -0,0 +1,39 @@
+import asyncio
+import standins
+import chat_batch
+from chat_batch import run_batch, format_digest
+from prompt_templates import batch_jobs
+
+
+class FlakyOpenAI(standins.FakeOpenAI):
+    """Answers a 429 to the first request of each prompt, and a 400 to anything mentioning Megasoft."""
+
+    def __init__(self):
+        super().__init__(0)
+        self.seen = set()
+        create = self.chat.completions.create
+
+        async def flaky(model, messages, **kwargs):
+            question = messages[-1]["content"]
+            if "Megasoft" in question:
+                error = RuntimeError("Error code: 400 - bad request")
+                error.status_code = 400
+                raise error
+            if question not in self.seen:
+                self.seen.add(question)
+                raise standins.FakeRateLimitError(0.01)
+            return await create(model, messages, **kwargs)
+
+        self.chat.completions.create = flaky
+
+
+def test_429s_are_retried_and_other_errors_are_not(monkeypatch):
+    monkeypatch.setattr(chat_batch, "CHAT_BACKOFF_SECONDS", 0.01)
+    jobs = batch_jobs(["bill_gates"], ["megasoft", "advice"]) + batch_jobs(["sam_altman"], ["whats_next"])
+    batch = asyncio.run(run_batch(FlakyOpenAI(), "gpt-3.5-turbo", jobs, rpm=6000, tpm=10000000))
+    results = {result["question"]: result for result in batch["results"]}
+    assert [result["question"] for result in batch["results"]] == ["megasoft", "advice", "whats_next"]
+    assert results["megasoft"]["attempts"] == 1 and "400" in results["megasoft"]["error"]
+    assert results["advice"]["attempts"] == 2 and results["advice"]["text"]
+    assert results["whats_next"]["attempts"] == 2 and results["whats_next"]["error"] is None
+    assert format_digest(batch).startswith("2 of 3 prompts answered")
@@ -0,0 +1,23 @@
+from client_pool import ClientPool
+
+
+class Client:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_only_connection_errors_rebuild_the_client():
+    pool = ClientPool()
+    pool.register("blob", Client, rebuild_on=lambda: (ConnectionError,))
+    first = pool.get("blob")
+    assert pool.get("blob") is first
+    #A missing blob or a bad request isn't the client's fault.
+    pool.report_error("blob", KeyError("visitors.txt"))
+    assert pool.get("blob") is first
+    pool.report_error("blob", ConnectionResetError("reset by peer"))
+    assert first.closed
+    assert pool.get("blob") is not first
+    assert pool.stats["blob"] == {"created": 2, "reused": 2, "rebuilt": 1}
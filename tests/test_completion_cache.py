@@ -0,0 +1,38 @@
+import time
+import asyncio
+import standins
+import completion_cache
+from completion_cache import LRUCache, cache_key, get_cache_container, lookup, store
+
+
+def test_lru_drops_the_least_recently_used_and_the_expired():
+    cache = LRUCache(max_entries=2, max_bytes=1000, ttl_seconds=60)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", None, "3")
+    cache.put("old", "4", created=time.time() - 120)
+    assert cache.get("old") is None
+    #Anything bigger than the whole cache isn't kept at all.
+    cache.put("big", "x" * 2000)
+    assert cache.get("big") is None and cache.get("c") == "3"
+
+
+def test_blob_layer_survives_a_recycled_worker(monkeypatch):
+    monkeypatch.setattr(completion_cache, "memory_cache", LRUCache())
+    messages = [{"role": "user", "content": "What happened this week?"}]
+    key = cache_key("BrandonAI", "2024-02-01", "3", messages)
+    #The same messages built in a different order hash the same.
+    assert key == cache_key("BrandonAI", "2024-02-01", "3", [{"content": "What happened this week?", "role": "user"}])
+    assert key != cache_key("BrandonAI", "2024-02-01", "4", messages)
+
+    async def run():
+        container = await get_cache_container(standins.AsyncMemoryBlobService({}))
+        assert await lookup(container, key) is None
+        await store(container, key, "Nothing much.")
+        #A new worker starts with an empty memory layer and finds it in blob storage.
+        completion_cache.memory_cache.clear()
+        return await lookup(container, key)
+
+    assert asyncio.run(run()) == "Nothing much."
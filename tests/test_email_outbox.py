@@ -0,0 +1,33 @@
+import json
+import asyncio
+import standins
+import email_outbox
+from email_outbox import enqueue_email, send_pending
+
+
+class BrokenEmail(standins.NullEmail):
+    async def begin_send(self, message, **kwargs):
+        raise RuntimeError("Communication Services is down")
+
+
+def outbox(blob_service_client):
+    return sorted(name for container, name in blob_service_client.blobs if container == email_outbox.OUTBOX_CONTAINER)
+
+
+def test_failed_send_waits_for_its_backoff_then_goes_out_once():
+    blob_service_client = standins.AsyncMemoryBlobService({})
+    message = {"content": {"subject": "Visitors analysis of today", "plainText": "hello"}}
+    name = asyncio.run(enqueue_email(blob_service_client, message))
+    email_id = name.split('/')[-1]
+
+    assert asyncio.run(send_pending(blob_service_client, BrokenEmail()))["retry"] == 1
+    #Not due again until the backoff is up, so the next run leaves it alone.
+    assert asyncio.run(send_pending(blob_service_client, standins.NullEmail()))["sent"] == 0
+    entry = json.loads(blob_service_client.blobs[(email_outbox.OUTBOX_CONTAINER, f"pending/{email_id}")][0])
+    assert entry["attempts"] == 1 and "down" in entry["last_error"]
+
+    blob_service_client.blobs[(email_outbox.OUTBOX_CONTAINER, f"pending/{email_id}")][1]["next_attempt"] = "0"
+    email = standins.NullEmail()
+    assert asyncio.run(send_pending(blob_service_client, email))["sent"] == 1
+    assert email.sent == [message]
+    assert outbox(blob_service_client) == [f"sent/{email_id}"]
@@ -0,0 +1,73 @@
+import datetime
+import pytest
+import standins
+from run_checkpoint import RunCheckpoint
+from snapshot_catalog import load_catalog
+from visit_index import load_visit_index
+from visitor_export import export_incremental, save_watermark, load_watermark, iter_export_groups
+
+
+def delta_ips(blob_service_client, filename):
+    return sorted(ip for ips, _ in iter_export_groups(blob_service_client, filename) for ip in ips)
+
+
+def test_rows_at_the_watermark_are_exported_once():
+    pyodbc = standins.FakePyodbc(standins.make_visitors(50))
+    blob_service_client = standins.MemoryBlobService({})
+    conn = pyodbc.connect()
+    cur = conn.cursor()
+
+    filename, row_count, _, _, state = export_incremental(cur, blob_service_client, "20240510")
+    assert (filename, row_count) == ("visitors20240510.txt", 50)
+    #Every row has the same LastVisited, so they're all remembered as exported at the watermark.
+    assert len(state["at_watermark"]) == 50
+    save_watermark(blob_service_client, state)
+    assert export_incremental(cur, blob_service_client, "20240511") == (None, 0, 0, None, None)
+
+    #A visitor that turns up later with exactly the watermark's timestamp, and one that comes back afterwards.
+    watermark = load_watermark(blob_service_client)["value"]
+    cur.execute("INSERT INTO ResumeVisitors VALUES (?, ?, ?)", "0.0.0.1", 1, watermark)
+    cur.execute("SELECT IPAddress FROM ResumeVisitors WHERE IPAddress <> ?", "0.0.0.1")
+    returning = cur.fetchone()[0]
+    cur.execute("UPDATE ResumeVisitors SET VisitCount = VisitCount + 1, LastVisited = ? WHERE IPAddress = ?",
+                watermark + datetime.timedelta(hours=1), returning)
+    conn.commit()
+    filename, row_count, _, _, state = export_incremental(cur, blob_service_client, "20240512")
+    assert filename == "visitors20240512.delta.txt"
+    assert delta_ips(blob_service_client, filename) == sorted(["0.0.0.1", returning])
+    assert state["deltas"] == [filename] and list(state["at_watermark"]) == [returning]
+
+
+def test_a_retry_still_records_the_delta(app, monkeypatch):
+    #Yesterday's full export left a watermark behind. Then one visitor comes back.
+    conn = app.pyodbc.connect()
+    cur = conn.cursor()
+    save_watermark(app.blob, export_incremental(cur, app.blob, "20240101")[4])
+    cur.execute("SELECT IPAddress FROM ResumeVisitors")
+    returning = cur.fetchone()[0]
+    cur.execute("UPDATE ResumeVisitors SET VisitCount = VisitCount + 1, LastVisited = ? WHERE IPAddress = ?",
+                datetime.datetime.now() + datetime.timedelta(days=1), returning)
+    conn.commit()
+
+    #The first attempt dies right after the delta is written, before the export is checkpointed.
+    monkeypatch.setattr(app.module, "EXPORT_MODE", "incremental")
+    real_complete = RunCheckpoint.complete
+    failed = []
+
+    def complete(self, stage, **results):
+        if stage == "export" and not failed:
+            failed.append(stage)
+            raise RuntimeError("lost the connection to blob storage")
+        return real_complete(self, stage, **results)
+
+    monkeypatch.setattr(RunCheckpoint, "complete", complete)
+    with pytest.raises(RuntimeError):
+        app.functions["dbqueryandsave"](app.standins.FakeTimer(), app.context(0))
+    #The retry finds the same changed row, so the delta makes it into the catalog and the visit index.
+    app.functions["dbqueryandsave"](app.standins.FakeTimer(), app.context(1))
+    today = datetime.date.today().strftime("%Y%m%d")
+    delta = f"visitors{today}.delta.txt"
+    assert delta_ips(app.blob, delta) == [returning]
+    assert delta in [snapshot["name"] for snapshot in load_catalog(app.blob)["snapshots"]]
+    assert today in load_visit_index(app.blob)["periods"]
+    assert load_watermark(app.blob)["deltas"] == [delta]
@@ -0,0 +1,80 @@
+import pytest
+import standins
+from visit_index import PeriodBuilder, empty_stored_index
+from visitor_export import RESULTS_CONTAINER, export_full, export_parallel, partition_bounds
+
+
+@pytest.fixture
+def pyodbc():
+    #Enough rows for a few key ranges at the default batch size.
+    return standins.FakePyodbc(standins.make_visitors(30000))
+
+
+def stored_bytes(blob_service_client, filename):
+    return blob_service_client.get_blob_client(RESULTS_CONTAINER, filename).download_blob(decompress=False).readall()
+
+
+def serial_export(pyodbc):
+    blob_service_client = standins.MemoryBlobService({})
+    filename, row_count, _, content_md5 = export_full(pyodbc.connect().cursor(), blob_service_client, "20240517")
+    return stored_bytes(blob_service_client, filename), row_count, content_md5
+
+
+def test_parallel_matches_serial(pyodbc):
+    blob_service_client = standins.MemoryBlobService({})
+    filename, row_count, _, content_md5 = export_parallel(pyodbc.connect().cursor(), pyodbc.connect, blob_service_client,
+                                                          "20240517", partitions=4, workers=4)
+    assert (stored_bytes(blob_service_client, filename), row_count, content_md5) == serial_export(pyodbc)
+
+
+def test_partitions_are_capped_in_rows(pyodbc):
+    cur = pyodbc.connect().cursor()
+    #Two ranges would be 15000 rows each. With a cap of 12000 a range gets two whole batches, so it takes three ranges.
+    bounds, batches_per_partition, total = partition_bounds(cur, "IPAddress", 2, batch_size=5000, max_rows=12000)
+    assert (len(bounds), batches_per_partition, total) == (3, 2, 30000)
+    #A cap smaller than a batch still gets a batch per range.
+    assert partition_bounds(cur, "IPAddress", 2, batch_size=5000, max_rows=100)[1] == 1
+
+
+def test_rows_added_during_the_run_fall_back_to_serial(pyodbc):
+    #The first range's connection adds a visitor after the ranges were planned, so one range comes back a row longer.
+    connections = []
+
+    def connect():
+        conn = pyodbc.connect()
+        if not connections:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO ResumeVisitors VALUES (?, ?, ?)", "0.0.0.1", 7, "2024-05-17T00:00:00")
+            conn.commit()
+        connections.append(conn)
+        return conn
+
+    blob_service_client = standins.MemoryBlobService({})
+    filename, row_count, _, content_md5 = export_parallel(pyodbc.connect().cursor(), connect, blob_service_client,
+                                                          "20240517", partitions=4, workers=1)
+    assert row_count == 30001
+    assert (stored_bytes(blob_service_client, filename), row_count, content_md5) == serial_export(pyodbc)
+
+
+def test_rows_removed_during_the_run_are_not_indexed(pyodbc):
+    #Just before the last key range is read, the first and last visitors are removed. The first range was already read
+    #and handed its rows to the visit index, so when it falls back what the ranges handed over has to be thrown away.
+    cur = pyodbc.connect().cursor()
+    cur.execute("SELECT MIN(IPAddress), MAX(IPAddress) FROM ResumeVisitors")
+    removed = list(cur.fetchone())
+    connections = []
+
+    def connect():
+        conn = pyodbc.connect()
+        if len(connections) == 2:
+            conn.cursor().execute("DELETE FROM ResumeVisitors WHERE IPAddress IN (?, ?)", *removed)
+            conn.commit()
+        connections.append(conn)
+        return conn
+
+    builder = PeriodBuilder(empty_stored_index())
+    _, row_count, _, _ = export_parallel(pyodbc.connect().cursor(), connect, standins.MemoryBlobService({}), "20240517",
+                                         builder.add_rows, builder.clear, partitions=4, workers=1)
+    assert row_count == 29998
+    stored = builder.finish("20240517")
+    assert len(stored["ips"]) == 29998 and not set(removed) & set(stored["ips"])
@@ -0,0 +1,58 @@
+import random
+import ipaddress
+from ip_enrichment import IPNetworkIndex, flatten
+
+
+def most_specific(blocks, value):
+    #What a lookup should find: the smallest block the value is in, or None.
+    inside = [block for block in blocks if block[0] <= value <= block[1]]
+    return min(inside, key=lambda block: block[1] - block[0])[2] if inside else None
+
+
+def covering(ranges, value):
+    inside = [network for start, end, network in ranges if start <= value <= end]
+    assert len(inside) <= 1
+    return inside[0] if inside else None
+
+
+def test_flatten_nested_blocks():
+    #A /16-ish block with a /24 carved out of it, a /28 carved out of that, and one on its own.
+    blocks = [(0, 255, "outer"), (64, 127, "middle"), (80, 95, "inner"), (96, 96, "single"), (300, 310, "apart")]
+    ranges = flatten(blocks)
+    assert ranges == [(0, 63, "outer"), (64, 79, "middle"), (80, 95, "inner"), (96, 96, "single"), (97, 127, "middle"),
+                      (128, 255, "outer"), (300, 310, "apart")]
+
+
+def test_flatten_matches_most_specific_block():
+    #Random CIDR-shaped blocks (aligned powers of two) are always nested or separate, like real ones.
+    random.seed(7)
+    blocks = set()
+    while len(blocks) < 60:
+        size = 2 ** random.randint(0, 8)
+        start = random.randrange(0, 1024, size)
+        blocks.add((start, start + size - 1))
+    blocks = [(start, end, f"net{number}") for number, (start, end) in enumerate(sorted(blocks))]
+    ranges = flatten(blocks)
+    assert all(ranges[number][1] < ranges[number + 1][0] for number in range(len(ranges) - 1))
+    for value in range(1100):
+        assert covering(ranges, value) == most_specific(blocks, value)
+
+
+def test_index_lookup_with_overlapping_cidrs(tmp_path):
+    csv_path = tmp_path / "networks.csv"
+    csv_path.write_text("network,asn,country,as_name\n"
+                        "10.0.0.0/8,1,AU,BIG\n"
+                        "10.1.0.0/16,2,NZ,CARVED\n"
+                        "10.1.2.0/24,3,US,CARVED-AGAIN\n"
+                        "2001:db8::/32,4,DE,V6\n", encoding='utf-8')
+    built = IPNetworkIndex.from_csv(str(csv_path))
+    built.save(str(tmp_path / "networks.ipidx"))
+    for index in (built, IPNetworkIndex.load(str(tmp_path / "networks.ipidx"))):
+        assert index.lookup("10.200.0.1")["asn"] == 1
+        assert index.lookup("10.1.9.9")["asn"] == 2
+        assert index.lookup("10.1.2.3")["asn"] == 3
+        assert index.lookup("10.1.3.0")["asn"] == 2
+        assert index.lookup(str(ipaddress.ip_address("10.1.255.255") + 1))["asn"] == 1
+        assert index.lookup("2001:db8::1")["asn"] == 4
+        assert index.lookup("11.0.0.1") is None
+        assert index.lookup("not an ip") is None
@@ -0,0 +1,30 @@
+import asyncio
+import standins
+from llm_stream import stream_completion
+
+MESSAGES = [{"role": "user", "content": "Hello Sam, whats next in the OpenAI adventure?"}]
+
+
+def test_whole_answer_with_metrics():
+    text, metrics = asyncio.run(stream_completion(standins.FakeOpenAI(0), "gpt-3.5-turbo", MESSAGES))
+    assert text.startswith("Stand-in analysis of a")
+    assert metrics["finish_reason"] == "stop" and not metrics["timed_out"]
+    assert metrics["tokens"] > 0 and metrics["ttft_ms"] is not None
+
+
+def test_deadline_keeps_what_arrived_and_closes_the_stream():
+    streams = []
+    client = standins.FakeOpenAI(0, tokens_per_second=5)
+    create = client.chat.completions.create
+
+    async def record(**kwargs):
+        stream = await create(**kwargs)
+        streams.append(stream)
+        return stream
+
+    client.chat.completions.create = record
+    text, metrics = asyncio.run(stream_completion(client, "gpt-3.5-turbo", MESSAGES, deadline_seconds=0.5))
+    assert metrics["timed_out"] and metrics["finish_reason"] is None
+    whole = f"Stand-in analysis of a {len(MESSAGES[0]['content'])} character prompt."
+    assert text and whole.startswith(text) and text != whole
+    assert streams[0].closed
@@ -0,0 +1,41 @@
+import asyncio
+import importlib
+import standins
+from e2e_bench import user_functions
+
+
+def run_persona_app(monkeypatch, name: str, client_class: str):
+    #Each persona file is its own FunctionApp with its own clients, swapped here for the stand-ins.
+    module = importlib.import_module(name)
+    monkeypatch.setenv("OPENAI_API_KEY", "standin")
+    openai = standins.FakeOpenAI(0)
+    asked = []
+    create = openai.chat.completions.create
+
+    async def record(model, messages, **kwargs):
+        asked.append(messages)
+        return await create(model, messages, **kwargs)
+
+    monkeypatch.setattr(openai.chat.completions, "create", record)
+    monkeypatch.setattr(module, client_class, lambda **kwargs: openai)
+    email = standins.NullEmail()
+    if hasattr(module, "EmailClient"):
+        monkeypatch.setattr(module.EmailClient, "from_connection_string", lambda key: email)
+    function, = user_functions(module.app).values()
+    asyncio.run(function(standins.FakeTimer()))
+    return asked, email.sent
+
+
+def test_bill_gets_only_his_question_and_emails_only_the_answer(monkeypatch):
+    asked, sent = run_persona_app(monkeypatch, "ChatWithBillGates", "AsyncAzureOpenAI")
+    assert len(asked) == 1 and [message["role"] for message in asked[0]] == ["user"]
+    assert "Megasoft" in asked[0][0]["content"]
+    assert len(sent) == 1
+    assert sent[0]["content"]["plainText"].startswith("Stand-in analysis of a")
+    assert "prompts answered" not in sent[0]["content"]["plainText"]
+
+
+def test_sam_gets_only_his_question(monkeypatch):
+    asked, sent = run_persona_app(monkeypatch, "Chatwithsam", "AsyncOpenAI")
+    assert asked == [[{"role": "user", "content": "Hello Sam, whats next in the OpenAI adventure?"}]]
+    assert not sent
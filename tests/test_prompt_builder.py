@@ -0,0 +1,41 @@
+import prompt_builder
+from prompt_builder import build_prompt
+from visitor_diff import diff_snapshots
+
+
+def make_diff(visitors):
+    last = [f"10.0.{n // 256}.{n % 256}" for n in range(visitors)]
+    this = last[visitors // 2:] + [f"10.9.{n // 256}.{n % 256}" for n in range(visitors // 2)]
+    return diff_snapshots(last, range(visitors), this, [n + 1 for n in range(visitors)])
+
+
+def test_small_diff_goes_in_whole():
+    prompt, report = build_prompt("Analyse this.", make_diff(10), budget=3000)
+    assert report["level"] == "full"
+    assert "10.9.0.4" in prompt and "more" not in prompt
+
+
+def test_steps_down_until_it_fits():
+    diff = make_diff(20000)
+    prompt, report = build_prompt("Analyse this.", diff, budget=1000, top_n=50)
+    assert report["level"] in ("top_n", "subnets")
+    assert report["total"] <= 1000
+    #A budget too small for anything but the totals still gets the totals.
+    prompt, report = build_prompt("Analyse this.", diff, budget=60, top_n=50)
+    assert report["level"] == "summary"
+    assert prompt == "Analyse this.\n\n" + prompt_builder.format_totals(diff["totals"])
+    assert list(report["sections"]) == ["instructions", "totals"]
+
+
+def test_no_level_formats_the_whole_diff_it_cannot_use(monkeypatch):
+    limits = []
+    real_sections = prompt_builder.diff_sections
+
+    def diff_sections(diff, limit=None, label="IP"):
+        limits.append(limit)
+        return real_sections(diff, limit, label)
+
+    monkeypatch.setattr(prompt_builder, "diff_sections", diff_sections)
+    _, report = build_prompt("Analyse this.", make_diff(20000), budget=60, top_n=50)
+    assert report["level"] == "summary"
+    assert None not in limits
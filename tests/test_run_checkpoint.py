@@ -0,0 +1,42 @@
+import pytest
+from run_checkpoint import RunCheckpoint
+
+
+def test_checkpoint_round_trip(app):
+    checkpoint = RunCheckpoint.load(app.blob, "dbqueryandsave", "20240517")
+    assert not checkpoint.done("export")
+    checkpoint.complete("export", filename="visitors20240517.vsnap", row_count=3)
+    resumed = RunCheckpoint.load(app.blob, "dbqueryandsave", "20240517")
+    assert resumed.done("export") and not resumed.done("verify")
+    assert resumed.get("export")["filename"] == "visitors20240517.vsnap"
+    #A different run date starts from nothing.
+    assert not RunCheckpoint.load(app.blob, "dbqueryandsave", "20240518").done("export")
+
+
+def test_retry_resumes_after_the_export(app, monkeypatch):
+    #The first attempt fails checking the upload. The retry has to skip the query and upload and carry on from the check.
+    exports = []
+    real_export, real_verify = app.module.export_full, app.module.verify_upload
+
+    def counted_export(*args, **kwargs):
+        exports.append(1)
+        return real_export(*args, **kwargs)
+
+    def broken_verify(*args, **kwargs):
+        raise RuntimeError("blob storage went away")
+
+    monkeypatch.setattr(app.module, "export_full", counted_export)
+    monkeypatch.setattr(app.module, "verify_upload", broken_verify)
+    with pytest.raises(RuntimeError):
+        app.functions["dbqueryandsave"](app.standins.FakeTimer(), app.context(0))
+    assert len(exports) == 1
+
+    monkeypatch.setattr(app.module, "verify_upload", real_verify)
+    app.functions["dbqueryandsave"](app.standins.FakeTimer(), app.context(1))
+    assert len(exports) == 1
+    today = app.module.datetime.date.today().strftime("%Y%m%d")
+    checkpoint = RunCheckpoint.load(app.blob, "dbqueryandsave", today)
+    assert all(checkpoint.done(stage) for stage in ("export", "verify", "visit_index"))
+    #The visit index was rebuilt from the blob the first attempt uploaded, so it has every visitor.
+    from visit_index import load_visit_index
+    assert len(load_visit_index(app.blob)["ips"]) == 2000
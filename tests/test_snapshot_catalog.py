@@ -0,0 +1,20 @@
+import standins
+from snapshot_catalog import load_catalog, nearest, record_snapshot, resolve_pair, describe_view
+
+
+def test_nearest_snapshot_and_deltas_on_top():
+    blob_service_client = standins.MemoryBlobService({})
+    for name in ("visitors20240503.txt", "visitors20240510.vsnap", "visitors20240510.txt",
+                 "visitors20240512.delta.txt", "visitors20240514.delta.txt"):
+        record_snapshot(blob_service_client, name, 100, 10, b'\x01' * 16)
+    catalog = load_catalog(blob_service_client)
+    #The .vsnap wins on a day that has both, and a delta is never picked as a snapshot on its own.
+    assert nearest(catalog, "20240513")["name"] == "visitors20240510.vsnap"
+    assert nearest(catalog, "20240502") is None
+    this_week, last_week = resolve_pair(catalog, "20240517", "20240510")
+    assert describe_view(this_week) == "visitors20240510.vsnap + 2 deltas" and this_week["date"] == "20240514"
+    assert describe_view(last_week) == "visitors20240510.vsnap"
+    #Re-recording a snapshot replaces its entry.
+    record_snapshot(blob_service_client, "visitors20240503.txt", 200, 20, None)
+    entries = [entry for entry in load_catalog(blob_service_client)["snapshots"] if entry["name"] == "visitors20240503.txt"]
+    assert [(entry["bytes"], entry["rows"]) for entry in entries] == [(200, 20)]
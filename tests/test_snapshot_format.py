@@ -0,0 +1,71 @@
+import random
+import datetime
+import pytest
+from array import array
+from decimal import Decimal
+from snapshot_format import (SnapshotFormatError, _SnapshotDecoder, encode_snapshot, read_snapshot, parse_text_snapshot,
+                             apply_deltas)
+
+
+def make_snapshot():
+    random.seed(3)
+    batches = [[(f"10.0.{group}.{row}", random.randint(1, 10 ** 9)) for row in range(size)] for group, size in enumerate((5, 1, 40))]
+    ips = [ip for batch in batches for ip, _ in batch]
+    counts = array('q', (count for batch in batches for _, count in batch))
+    return b''.join(encode_snapshot(batches)), ips, counts
+
+
+def test_every_split_point_decodes_the_same():
+    #Chunks from download_blob() can end anywhere, including in the middle of a header or a length.
+    data, ips, counts = make_snapshot()
+    for split in range(len(data) + 1):
+        assert read_snapshot([data[:split], data[split:]]) == (ips, counts)
+
+
+def test_one_byte_at_a_time():
+    data, ips, counts = make_snapshot()
+    decoder = _SnapshotDecoder()
+    groups = []
+    for position in range(len(data)):
+        groups.extend(decoder.feed(data[position:position + 1]))
+    decoder.close()
+    assert [len(group_ips) for group_ips, _ in groups] == [5, 1, 40]
+    assert [ip for group_ips, _ in groups for ip in group_ips] == ips
+
+
+def test_truncated_snapshot_is_an_error():
+    #Anything short of the end marker has to fail rather than quietly hand back fewer visitors.
+    data, _, _ = make_snapshot()
+    for length in range(len(data)):
+        with pytest.raises(SnapshotFormatError):
+            read_snapshot([data[:length]])
+
+
+def test_not_a_snapshot():
+    with pytest.raises(SnapshotFormatError):
+        read_snapshot([b"('1.2.3.4', 5)\n('5.6.7.8', 1)"])
+
+
+def test_corrupt_row_group():
+    data, _, _ = make_snapshot()
+    #Claim one more row in the first row group than it has. The header is 10 bytes plus the schema.
+    header_length = 10 + int.from_bytes(data[6:10], 'little')
+    rows = int.from_bytes(data[header_length:header_length + 4], 'little')
+    corrupt = data[:header_length] + (rows + 1).to_bytes(4, 'little') + data[header_length + 4:]
+    with pytest.raises(SnapshotFormatError):
+        read_snapshot([corrupt])
+
+
+def test_apply_deltas():
+    base = parse_text_snapshot("('1.1.1.1', 5, 'x')\n('2.2.2.2', 3, 'x')")
+    deltas = [parse_text_snapshot("('2.2.2.2', 4, 'y')"), parse_text_snapshot("('3.3.3.3', 1, 'z')\n('2.2.2.2', 6, 'z')")]
+    assert apply_deltas(*base, deltas) == (['1.1.1.1', '2.2.2.2', '3.3.3.3'], array('q', [5, 6, 1]))
+
+
+def test_text_rows_with_datetimes():
+    #What str(pyodbc.Row) gives for a row with SQL Server's DATETIME2 LastVisited (and a Decimal for good measure).
+    rows = [('1.2.3.4', 5, datetime.datetime(2024, 5, 10, 12, 0)),
+            ('2001:db8::1', 12, datetime.datetime(2024, 5, 10, 12, 0, 0, 123456), Decimal('1.5'))]
+    assert parse_text_snapshot('\n'.join(str(row) for row in rows)) == (['1.2.3.4', '2001:db8::1'], array('q', [5, 12]))
+    with pytest.raises(SnapshotFormatError):
+        parse_text_snapshot("1.2.3.4, 5")
@@ -0,0 +1,67 @@
+import json
+import datetime
+import zlib
+import struct
+import numpy as np
+import visit_index
+from visit_index import (VISIT_INDEX_BLOB, decode_index, encode_index, empty_stored_index, encode_stored_index,
+                         read_stored_index, append_period, update_visit_index, load_visit_index)
+
+
+def groups(*rows, size=2):
+    #rows as (ip, count), handed over in row groups of size like iter_export_groups would.
+    for start in range(0, len(rows), size):
+        chunk = rows[start:start + size]
+        yield [ip for ip, _ in chunk], [count for _, count in chunk]
+
+
+def test_append_only_adds_blocks():
+    stored = append_period(empty_stored_index(), "20240510", groups(("a", 1), ("b", 2), ("c", 3)))
+    first_column = stored["columns"][0]
+    stored = read_stored_index(encode_stored_index(stored))
+    stored = append_period(stored, "20240517", groups(("b", 5), ("d", 1)))
+    #The first column's compressed block is copied across untouched and is shorter than the IP list now.
+    assert stored["columns"][0] == first_column
+    index = decode_index(encode_stored_index(stored))
+    assert index["ips"] == ["a", "b", "c", "d"]
+    assert index["periods"] == ["20240510", "20240517"]
+    assert index["counts"].tolist() == [[1, 0], [2, 5], [3, 0], [0, 1]]
+
+
+def test_delta_carries_forward_and_late_days_keep_date_order():
+    stored = append_period(empty_stored_index(), "20240517", groups(("a", 4), ("b", 2)))
+    stored = append_period(stored, "20240510", groups(("a", 1), ("c", 1)))
+    stored = append_period(stored, "20240524", groups(("c", 9)), carry_forward=True)
+    #Re-appending a day replaces it.
+    stored = append_period(stored, "20240524", groups(("c", 7)), carry_forward=True)
+    index = decode_index(encode_stored_index(stored))
+    assert index["periods"] == ["20240510", "20240517", "20240524"]
+    assert dict(zip(index["ips"], index["counts"].tolist())) == {"a": [1, 4, 4], "b": [0, 2, 2], "c": [1, 0, 7]}
+
+
+def test_version_1_blobs_still_read_and_update(app, monkeypatch):
+    old = {"periods": ["20240510"], "ips": ["a", "b"], "counts": np.array([[1], [2]], dtype='<i4'),
+           "appends_since_compact": 0}
+    header = json.dumps({"version": 1, "periods": old["periods"], "ip_count": 2, "appends_since_compact": 0}).encode()
+    blocks = [header, zlib.compress(b"a\nb"), zlib.compress(old["counts"].tobytes())]
+    data = b'VIDX' + b''.join(struct.pack('<I', len(block)) + block for block in blocks)
+    assert decode_index(data)["counts"].tolist() == [[1], [2]]
+    assert decode_index(encode_index(old))["counts"].tolist() == [[1], [2]]
+
+    monkeypatch.setattr(visit_index, "VISIT_INDEX_COMPACT_EVERY", 100)
+    app.blob.get_blob_client("results", VISIT_INDEX_BLOB).upload_blob(data, overwrite=True)
+    update_visit_index(app.blob, "20240517", groups(("b", 3)), carry_forward=True)
+    assert load_visit_index(app.blob)["counts"].tolist() == [[1, 1], [2, 3]]
+
+
+def test_export_feeds_the_index_without_reading_it_back(app, monkeypatch):
+    def iter_export_groups(*args):
+        raise AssertionError("the export was downloaded again for the visit index")
+
+    monkeypatch.setattr(app.module, "iter_export_groups", iter_export_groups)
+    app.functions["dbqueryandsave"](app.standins.FakeTimer(), app.context(0))
+    cur = app.pyodbc.connect().cursor()
+    cur.execute("SELECT IPAddress, VisitCount FROM ResumeVisitors")
+    index = load_visit_index(app.blob)
+    assert index["periods"] == [datetime.date.today().strftime("%Y%m%d")]
+    assert dict(zip(index["ips"], index["counts"][:, 0].tolist())) == {ip: count for ip, count in cur.fetchall()}
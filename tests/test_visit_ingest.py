@@ -0,0 +1,41 @@
+import json
+import time
+import azure.functions as func
+from visit_ingest import VisitBuffer
+from client_pool import connect_sql
+
+
+def visit_request(forwarded=None, body=b''):
+    headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+    return func.HttpRequest(method='POST', url='/api/visit', headers=headers, body=body)
+
+
+def test_client_ip_is_the_entry_the_front_end_added(app):
+    client_ip = app.module.client_ip
+    #Whatever the caller put in the header comes first, the front end's own entry is the last one.
+    assert client_ip(visit_request('6.6.6.6, 203.0.113.7:50211')) == '203.0.113.7'
+    assert client_ip(visit_request('6.6.6.6,[2001:db8::1]:443')) == '2001:db8::1'
+    assert client_ip(visit_request('203.0.113.7, not-an-ip')) is None
+    #The body is never trusted for the IP.
+    assert client_ip(visit_request(body=json.dumps({"ip": "1.2.3.4"}).encode())) is None
+
+
+def test_shutdown_flush_is_bounded(app):
+    timeouts = []
+    buffer = VisitBuffer(lambda rows, timeout: timeouts.append(timeout), flush_size=100)
+    buffer.add('203.0.113.7')
+    #Another flush that never finishes is holding the lock, close still has to give up on time.
+    buffer._flush_lock.acquire()
+    started = time.monotonic()
+    buffer.close(timeout=0.2)
+    assert time.monotonic() - started < 1
+    assert buffer.pending() == 1 and not timeouts
+    #Once it can flush, the write is told how long it has left.
+    buffer._flush_lock.release()
+    assert buffer.flush(deadline=time.monotonic() + 5) == 1
+    assert 0 < timeouts[0] <= 5
+
+
+def test_connect_timeout_covers_login_and_queries(app):
+    conn = connect_sql(app.pyodbc, 'standin', timeout=0.3)
+    assert conn.timeout == 1
@@ -0,0 +1,24 @@
+import numpy as np
+from visitor_anomalies import detect_anomalies, format_anomalies
+
+
+def test_spikes_and_new_bursts_in_the_latest_period():
+    #Running totals over six periods: a steady visitor, one that spikes at the end, one that shows up out of nowhere.
+    steady = [0, 10, 21, 30, 41, 50]
+    spiky = [0, 10, 20, 31, 40, 140]
+    burst = [0, 0, 0, 0, 0, 30]
+    index = {"periods": [f"2024050{day}" for day in range(1, 7)], "ips": ["a", "b", "c"],
+             "counts": np.array([steady, spiky, burst], dtype='<i4'), "appends_since_compact": 0}
+    anomalies = detect_anomalies(index, window=4, z_threshold=3, min_visits=10, burst_visits=25)
+    assert anomalies["window"] == 4 and anomalies["active"] == 3
+    assert [spike["ip"] for spike in anomalies["spikes"]] == ["b"]
+    assert anomalies["bursts"] == [{"ip": "c", "visits": 30}]
+    assert "1 spikes and 1 new bursts" in format_anomalies(anomalies)
+
+
+def test_not_enough_history():
+    index = {"periods": ["20240501", "20240502"], "ips": ["a"], "counts": np.array([[1, 50]], dtype='<i4'),
+             "appends_since_compact": 0}
+    anomalies = detect_anomalies(index)
+    assert anomalies["window"] == 0 and not anomalies["spikes"] and not anomalies["bursts"]
+    assert format_anomalies(anomalies).startswith("Not enough history")
@@ -0,0 +1,23 @@
+from visitor_diff import diff_snapshots, format_diff
+
+
+def test_new_gone_and_changed():
+    diff = diff_snapshots(["a", "b", "c", "c"], [5, 3, 1, 1], ["a", "b", "d", "e"], [5, 9, 2, 7])
+    assert diff["new"] == [("e", 7), ("d", 2)]
+    #The same IP twice in one snapshot is added together.
+    assert diff["gone"] == [("c", 2)]
+    assert diff["changed"] == [("b", 3, 9, 6)]
+    assert diff["totals"] == {"visitors_before": 3, "visitors_after": 4, "visits_before": 10, "visits_after": 23,
+                              "new_visitors": 2, "gone_visitors": 1, "changed_visitors": 1, "unchanged_visitors": 1}
+
+
+def test_format_diff_keeps_the_biggest_movers():
+    last = [f"10.0.{n // 256}.{n % 256}" for n in range(100000)]
+    this = last[1000:] + [f"10.9.{n // 256}.{n % 256}" for n in range(1000)]
+    diff = diff_snapshots(last, range(100000), this, [n + 1 for n in range(100000)])
+    text = format_diff(diff, 5)
+    assert "Unique visitors: 100000 -> 100000" in text
+    assert "... and 995 more" in text and "... and 98995 more" in text
+    #What goes in the log and the email stays small however many visitors there are.
+    assert len(text) < 2000
+    assert len(format_diff(diff)) > 100 * len(text)
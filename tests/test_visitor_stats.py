@@ -0,0 +1,47 @@
+import json
+import pytest
+import azure.functions as func
+from visit_index import decode_index, encode_stored_index, empty_stored_index, append_period, update_visit_index
+from visitor_stats import period_diff
+
+
+def make_index(*periods):
+    stored = empty_stored_index()
+    for day, rows in periods:
+        stored = append_period(stored, day, [([ip for ip, _ in rows], [count for _, count in rows])])
+    return decode_index(encode_stored_index(stored))
+
+
+def test_diff_of_the_last_two_periods_and_a_chosen_pair():
+    index = make_index(("20240503", [("a", 1)]), ("20240510", [("a", 2), ("b", 1)]), ("20240517", [("b", 4), ("c", 1)]))
+    diff = period_diff(index)
+    assert (diff["from"], diff["to"]) == ("20240510", "20240517")
+    assert diff["new"] == [{"ip": "c", "visits": 1}] and diff["gone"] == [{"ip": "a", "visits": 2}]
+    assert diff["changed"] == [{"ip": "b", "before": 1, "after": 4, "delta": 3}]
+    diff = period_diff(index, "20240503", "20240510")
+    assert diff["new"] == [{"ip": "b", "visits": 1}] and diff["changed"][0]["delta"] == 1
+
+
+def test_nothing_before_the_first_period():
+    index = make_index(("20240510", [("a", 2)]), ("20240517", [("a", 5)]))
+    #Only to= the first period used to compare it with the latest one, backwards.
+    with pytest.raises(ValueError):
+        period_diff(index, end="20240510")
+    with pytest.raises(ValueError):
+        period_diff(make_index(("20240510", [("a", 2)])))
+
+
+def test_diff_endpoint_says_400_with_no_earlier_period(app):
+    update_visit_index(app.blob, "20240510", [(["a"], [2])])
+    update_visit_index(app.blob, "20240517", [(["a", "b"], [5, 1])])
+    app.module.stats_cache.invalidate()
+
+    def get(**params):
+        req = func.HttpRequest(method='GET', url='/api/stats/diff', params=params, body=b'')
+        return app.functions["stats_diff"](req)
+
+    response = get(to="20240510")
+    assert response.status_code == 400
+    response = get(to="20240517")
+    assert response.status_code == 200
+    assert json.loads(response.get_body())["new"] == [{"ip": "b", "visits": 1}]
@@ -0,0 +1,38 @@
+import json
+import datetime
+from visitor_summary import daily_totals, daily_totals_filename, refresh_summary, visitor_totals_query
+from visitor_export import RESULTS_CONTAINER, snapshot_filename, iter_export_groups
+
+
+def visits_by_ip(cur, sql):
+    cur.execute(sql)
+    return {row[0]: row[1] for row in cur.fetchall()}
+
+
+def test_refresh_catches_up_once_and_then_only_new_visits(app):
+    conn = app.pyodbc.connect()
+    cur = conn.cursor()
+    assert refresh_summary(conn) == 2000
+    #Nothing new, so a second run adds nothing.
+    assert refresh_summary(conn) == 0
+    source = visits_by_ip(cur, "SELECT IPAddress, VisitCount FROM ResumeVisitors")
+    assert visits_by_ip(cur, visitor_totals_query()) == source
+
+    #One visitor comes back tomorrow with 5 more visits. Only those 5 go on tomorrow.
+    ip = next(iter(source))
+    tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+    cur.execute("UPDATE ResumeVisitors SET VisitCount = VisitCount + 5, LastVisited = ? WHERE IPAddress = ?", tomorrow, ip)
+    conn.commit()
+    assert refresh_summary(conn) == 1
+    assert visits_by_ip(cur, visitor_totals_query())[ip] == source[ip] + 5
+    days = daily_totals(cur, datetime.date.today())
+    assert [(day["visitors"], day["visits"]) for day in days] == [(2000, sum(source.values())), (1, 5)]
+
+
+def test_aggregate_export_runs_end_to_end(app, monkeypatch):
+    monkeypatch.setattr(app.module, "EXPORT_MODE", "aggregate")
+    app.functions["dbqueryandsave"](app.standins.FakeTimer(), app.context(0))
+    today = datetime.date.today().strftime("%Y%m%d")
+    assert sum(len(ips) for ips, _ in iter_export_groups(app.blob, snapshot_filename(today))) == 2000
+    totals = json.loads(app.blob.get_blob_client(RESULTS_CONTAINER, daily_totals_filename(today)).download_blob().readall())
+    assert totals["days"][0]["visitors"] == 2000
@@ -0,0 +1,319 @@
+import os
+import json
+import zlib
+import struct
+import bisect
+import datetime
+import logging
+import threading
+from azure.core.exceptions import ResourceNotFoundError
+
+#This file keeps a per-IP history of visit counts in a single blob, so trends over weeks or months don't need every
+#old visitors*.txt downloaded and parsed. dbqueryandsave adds a column to it every run.
+#
+#The index is a matrix with one row per IP and one column per period (run date). Each cell is the visit count
+#that IP had in that period's snapshot. Counts in ResumeVisitors only go up, so visits during a window are
+#the last column minus the column just before the window.
+#
+#Layout of the blob (version 2):
+#   b'VIDX'
+#   uint32 + json          header: version, periods (YYYYMMDD list), IPs in each IP block, rows in each column,
+#                          appends since the last compaction
+#   per IP block:          uint32 + zlib bytes, the IPs joined with '\n'
+#   per period:            uint32 + zlib bytes, that period's counts as little endian int32s, one per IP
+#A column only has the IPs there were when it was written, any IP added after that reads as 0 for it.
+#So adding a day only adds an IP block for the new IPs and one column block. The blocks already in the blob are copied
+#across as they are, nothing gets decompressed or recompressed apart from the previous column when a delta carries it forward.
+#Compacting is the only thing that rewrites the whole matrix.
+#Version 1 blobs (one IP block and one row-major matrix) can still be read, the next update rewrites them as version 2.
+
+VISIT_INDEX_BLOB = os.getenv('VISIT_INDEX_BLOB', 'visitindex.vidx')
+#Periods older than this get dropped when the index is compacted.
+VISIT_INDEX_RETENTION_DAYS = int(os.getenv('VISIT_INDEX_RETENTION_DAYS', '730'))
+#Compact after this many appends. Compacting drops old periods and any IP with no visits left in what remains.
+VISIT_INDEX_COMPACT_EVERY = int(os.getenv('VISIT_INDEX_COMPACT_EVERY', '4'))
+
+VISIT_INDEX_MAGIC = b'VIDX'
+VISIT_INDEX_VERSION = 2
+
+
+def empty_index() -> dict:
+    import numpy as np
+    return {"periods": [], "ips": [], "counts": np.zeros((0, 0), dtype='<i4'), "appends_since_compact": 0}
+
+
+def _stored(periods, ips, ip_blocks, columns, appends_since_compact) -> dict:
+    #The index as it sits in the blob: ips decoded (appending needs them to find rows) but the counts still as
+    #compressed (rows, bytes) blocks per column.
+    return {"periods": periods, "ips": ips, "ip_blocks": ip_blocks, "columns": columns,
+            "appends_since_compact": appends_since_compact}
+
+
+def _compress_ips(ips) -> bytes:
+    return zlib.compress('\n'.join(ips).encode('utf-8'))
+
+
+def _compress_column(column) -> bytes:
+    return zlib.compress(column.astype('<i4', copy=False).tobytes())
+
+
+def _column(rows: int, block: bytes):
+    import numpy as np
+    column = np.frombuffer(zlib.decompress(block), dtype='<i4')
+    if len(column) != rows:
+        raise ValueError("Visit index column is corrupt")
+    return column
+
+
+def encode_stored_index(stored: dict) -> bytes:
+    header = json.dumps({
+        "version": VISIT_INDEX_VERSION,
+        "periods": stored["periods"],
+        "ip_blocks": [count for count, _ in stored["ip_blocks"]],
+        "column_rows": [rows for rows, _ in stored["columns"]],
+        "appends_since_compact": stored["appends_since_compact"],
+    }).encode('utf-8')
+    parts = [VISIT_INDEX_MAGIC, struct.pack('<I', len(header)), header]
+    for _, block in stored["ip_blocks"] + stored["columns"]:
+        parts += [struct.pack('<I', len(block)), block]
+    return b''.join(parts)
+
+
+def encode_index(index: dict) -> bytes:
+    ips = index["ips"]
+    ip_blocks = [(len(ips), _compress_ips(ips))] if ips else []
+    columns = [(len(ips), _compress_column(index["counts"][:, i])) for i in range(len(index["periods"]))]
+    return encode_stored_index(_stored(index["periods"], ips, ip_blocks, columns, index["appends_since_compact"]))
+
+
+def _read_blocks(data: bytes, offset: int, count: int):
+    blocks = []
+    for _ in range(count):
+        (length,) = struct.unpack_from('<I', data, offset)
+        blocks.append(data[offset + 4:offset + 4 + length])
+        offset += 4 + length
+    return blocks, offset
+
+
+def _decode_version_1(header: dict, data: bytes, offset: int) -> dict:
+    import numpy as np
+    (ip_block, count_block), _ = _read_blocks(data, offset, 2)
+    ip_text = zlib.decompress(ip_block).decode('utf-8')
+    ips = ip_text.split('\n') if header["ip_count"] else []
+    counts = np.frombuffer(zlib.decompress(count_block), dtype='<i4').reshape(header["ip_count"], len(header["periods"]))
+    return {"periods": header["periods"], "ips": ips, "counts": counts.copy(),
+            "appends_since_compact": header["appends_since_compact"]}
+
+
+def read_stored_index(data: bytes) -> dict:
+    """Read the blob's header and IPs, leaving the count columns compressed. What update_visit_index appends to."""
+    if data[:4] != VISIT_INDEX_MAGIC:
+        raise ValueError("Not a visit index")
+    (header_block,), offset = _read_blocks(data, 4, 1)
+    header = json.loads(header_block.decode('utf-8'))
+    if header["version"] > VISIT_INDEX_VERSION:
+        raise ValueError(f"Visit index version {header['version']} is newer than this reader ({VISIT_INDEX_VERSION})")
+    if header["version"] == 1:
+        return read_stored_index(encode_index(_decode_version_1(header, data, offset)))
+    ip_blocks, offset = _read_blocks(data, offset, len(header["ip_blocks"]))
+    column_blocks, _ = _read_blocks(data, offset, len(header["column_rows"]))
+    ips = []
+    for block in ip_blocks:
+        ips.extend(zlib.decompress(block).decode('utf-8').split('\n'))
+    if len(ips) != sum(header["ip_blocks"]):
+        raise ValueError("Visit index IP block is corrupt")
+    return _stored(header["periods"], ips, list(zip(header["ip_blocks"], ip_blocks)),
+                   list(zip(header["column_rows"], column_blocks)), header["appends_since_compact"])
+
+
+def expand_index(stored: dict) -> dict:
+    """The full matrix for a stored index. Rows a column doesn't have yet are 0."""
+    import numpy as np
+    counts = np.zeros((len(stored["ips"]), len(stored["periods"])), dtype='<i4')
+    for i, (rows, block) in enumerate(stored["columns"]):
+        counts[:rows, i] = _column(rows, block)
+    return {"periods": stored["periods"], "ips": stored["ips"], "counts": counts,
+            "appends_since_compact": stored["appends_since_compact"]}
+
+
+def decode_index(data: bytes) -> dict:
+    return expand_index(read_stored_index(data))
+
+
+def empty_stored_index() -> dict:
+    return _stored([], [], [], [], 0)
+
+
+class PeriodBuilder:
+    """Builds the column for one day of a stored index from (ips, counts) row groups as they're handed over.
+
+    Each group is turned into row numbers straight away, so only those are kept,
+    never the IPs. This is how dbqueryandsave feeds the index from the rows the
+    export is already streaming, instead of reading the export back afterwards.
+    add is locked because the parallel export hands groups over from several threads.
+    """
+
+    def __init__(self, stored: dict):
+        self.stored = stored
+        self._row_of = {ip: row for row, ip in enumerate(stored["ips"])}
+        self._new_ips = []
+        self._row_groups = []
+        self._lock = threading.Lock()
+
+    def add(self, ips, counts) -> None:
+        import numpy as np
+        with self._lock:
+            rows = np.empty(len(ips), dtype=np.int64)
+            for i, ip in enumerate(ips):
+                row = self._row_of.get(ip)
+                if row is None:
+                    row = self._row_of[ip] = len(self._row_of)
+                    self._new_ips.append(ip)
+                rows[i] = row
+            self._row_groups.append((rows, np.asarray(counts, dtype='<i4')))
+
+    def add_rows(self, rows, ip_index: int = 0, count_index: int = 1) -> None:
+        #A batch of database rows straight off the cursor, the same columns snapshot_format.encode_row_batch reads.
+        self.add([str(row[ip_index]) for row in rows], [int(row[count_index]) for row in rows])
+
+    def clear(self) -> None:
+        #Forget every group added so far, for an export that starts again from the top.
+        with self._lock:
+            for ip in self._new_ips:
+                del self._row_of[ip]
+            self._new_ips = []
+            self._row_groups = []
+
+    def finish(self, day: str, carry_forward: bool = False) -> dict:
+        """Add the column for day to the stored index and return it. See append_period for carry_forward."""
+        import numpy as np
+        stored = self.stored
+        periods, columns = stored["periods"], stored["columns"]
+        if day in periods:
+            del columns[periods.index(day)]
+            periods.remove(day)
+        #Keep the periods in date order even if an older day gets appended late. It's only a list insert, the other columns don't move.
+        position = bisect.bisect_right(periods, day)
+
+        column = np.zeros(len(self._row_of), dtype='<i4')
+        if carry_forward and position:
+            previous = _column(*columns[position - 1])
+            column[:len(previous)] = previous
+        for rows, counts in self._row_groups:
+            column[rows] = counts
+
+        periods.insert(position, day)
+        columns.insert(position, (len(column), _compress_column(column)))
+        if self._new_ips:
+            stored["ip_blocks"].append((len(self._new_ips), _compress_ips(self._new_ips)))
+            stored["ips"].extend(self._new_ips)
+        stored["appends_since_compact"] += 1
+        return stored
+
+
+def append_period(stored: dict, day: str, groups, carry_forward: bool = False) -> dict:
+    """Add a column for day to a stored index from an iterable of (ips, counts) row groups.
+
+    The groups are read one at a time (e.g. straight off the exported blob with
+    iter_export_groups), so only their row numbers are kept, never the IPs.
+    With carry_forward (used for incremental deltas, which only hold the IPs
+    that changed) every IP not in the groups keeps its count from the period
+    before day. Otherwise it gets 0. Re-appending an existing day replaces it.
+    """
+    builder = PeriodBuilder(stored)
+    for ips, counts in groups:
+        builder.add(ips, counts)
+    return builder.finish(day, carry_forward)
+
+
+def compact_index(index: dict, today: datetime.date = None) -> dict:
+    """Drop periods older than VISIT_INDEX_RETENTION_DAYS and IPs with no visits in what's left."""
+    today = today or datetime.date.today()
+    cutoff = (today - datetime.timedelta(days=VISIT_INDEX_RETENTION_DAYS)).strftime("%Y%m%d")
+    keep_periods = [i for i, period in enumerate(index["periods"]) if period >= cutoff]
+    counts = index["counts"][:, keep_periods]
+    keep_rows = counts.any(axis=1)
+    index["periods"] = [index["periods"][i] for i in keep_periods]
+    index["counts"] = counts[keep_rows]
+    index["ips"] = [ip for ip, keep in zip(index["ips"], keep_rows) if keep]
+    index["appends_since_compact"] = 0
+    return index
+
+
+def visits_in_window(index: dict, start_day: str, end_day: str):
+    """Visits per IP between start_day and end_day (YYYYMMDD, inclusive) as (ips, numpy array).
+
+    Uses the latest period on or before end_day, minus the latest period
+    before start_day (or 0 if the window starts before the index does).
+    Only IPs with at least one visit in the window are returned.
+    """
+    import numpy as np
+    periods = index["periods"]
+    end_columns = [i for i, period in enumerate(periods) if period <= end_day]
+    if not end_columns:
+        return [], np.zeros(0, dtype=np.int64)
+    end = index["counts"][:, end_columns[-1]].astype(np.int64)
+    before_columns = [i for i, period in enumerate(periods) if period < start_day]
+    before = index["counts"][:, before_columns[-1]].astype(np.int64) if before_columns else 0
+    visits = np.maximum(end - before, 0)
+    rows = np.flatnonzero(visits)
+    return [index["ips"][row] for row in rows], visits[rows]
+
+
+def last_days(index: dict, days: int, today: datetime.date = None):
+    """Shortcut for visits_in_window over the last days days, e.g. last_days(index, 28) or last_days(index, 90)."""
+    today = today or datetime.date.today()
+    start = (today - datetime.timedelta(days=days - 1)).strftime("%Y%m%d")
+    return visits_in_window(index, start, today.strftime("%Y%m%d"))
+
+
+def load_visit_index(blob_service_client, container: str = "results") -> dict:
+    blob_client = blob_service_client.get_blob_client(container, VISIT_INDEX_BLOB)
+    try:
+        return decode_index(blob_client.download_blob().readall())
+    except ResourceNotFoundError:
+        return empty_index()
+
+
+async def load_visit_index_async(blob_service_client, container: str = "results") -> dict:
+    #Same as load_visit_index for the azure.storage.blob.aio client analyse_visits uses.
+    blob_client = blob_service_client.get_blob_client(container, VISIT_INDEX_BLOB)
+    try:
+        downloader = await blob_client.download_blob()
+        return decode_index(await downloader.readall())
+    except ResourceNotFoundError:
+        return empty_index()
+
+
+def load_stored_index(blob_service_client, container: str = "results") -> dict:
+    """The index as it's stored, or an empty one if there isn't one yet. See read_stored_index."""
+    blob_client = blob_service_client.get_blob_client(container, VISIT_INDEX_BLOB)
+    try:
+        return read_stored_index(blob_client.download_blob().readall())
+    except ResourceNotFoundError:
+        return empty_stored_index()
+
+
+def save_stored_index(blob_service_client, stored: dict, container: str = "results") -> dict:
+    """Compact the index if it's due and write it back. Returns the periods and IPs it ended up with."""
+    blob_client = blob_service_client.get_blob_client(container, VISIT_INDEX_BLOB)
+    if stored["appends_since_compact"] >= VISIT_INDEX_COMPACT_EVERY:
+        index = compact_index(expand_index(stored))
+        data = encode_index(index)
+        stored = {"periods": index["periods"], "ips": index["ips"]}
+    else:
+        data = encode_stored_index(stored)
+    blob_client.upload_blob(data, overwrite=True)
+    logging.warning(f'Visit index now has {len(stored["ips"])} IPs over {len(stored["periods"])} periods ({len(data)} bytes)')
+    return {"periods": stored["periods"], "ips": stored["ips"]}
+
+
+def update_visit_index(blob_service_client, day: str, groups, carry_forward: bool = False,
+                       container: str = "results") -> dict:
+    """Read the index, add day's counts from groups of (ips, counts), compact it if it's due and write it back.
+
+    One read and one write. Unless it's compacting, the matrix is never
+    expanded, only the new column is built. Returns the periods and IPs it ended up with.
+    """
+    stored = append_period(load_stored_index(blob_service_client, container), day, groups, carry_forward)
+    return save_stored_index(blob_service_client, stored, container)
@@ -0,0 +1,228 @@
+import os
+import sys
+import time
+import atexit
+import signal
+import logging
+import datetime
+import threading
+from visitor_export import EXPORT_MODE, EXPORT_KEY_COLUMN, EXPORT_WATERMARK_COLUMN, check_column
+from visitor_summary import SUMMARY_TABLE, summary_table_statement
+
+#This file is the write-behind buffer for the visit ingestion endpoint in function_app.py.
+#Instead of one SQL write per page view, each worker adds the visit to an in-memory dict of IP -> (visits, last visited)
+#and writes the whole dict as one batched upsert when either:
+#   - INGEST_FLUSH_SIZE different IPs are waiting, or
+#   - INGEST_FLUSH_SECONDS have passed (a background thread checks)
+#A burst of thousands of page views turns into a write every couple of seconds.
+#The upsert fast_executemany's the batch into a temp table and MERGEs that into the visitors table in one statement.
+#With the aggregate export the same upsert also adds the visits to the per day summary table (see visitor_summary.py).
+#If a write fails the visits go back in the buffer for the next flush. When the worker shuts down whatever is left
+#gets flushed, but only for up to INGEST_SHUTDOWN_SECONDS so a dead database can't hold the shutdown up. That covers waiting
+#for a flush already in progress, and each write gets whatever time is left as its SQL login and query timeout.
+
+#Flush once this many different IPs are waiting.
+INGEST_FLUSH_SIZE = int(os.getenv('INGEST_FLUSH_SIZE', '500'))
+#Flush at least this often while anything is waiting.
+INGEST_FLUSH_SECONDS = float(os.getenv('INGEST_FLUSH_SECONDS', '2'))
+#Rows per upsert. A big flush is split into several so no single statement gets too big.
+INGEST_BATCH_ROWS = int(os.getenv('INGEST_BATCH_ROWS', '1000'))
+#If the database is down the buffer keeps growing. Past this many IPs new ones are dropped (and counted) rather than eating all the memory.
+INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', '50000'))
+#How long the final flush on shutdown is allowed to take.
+INGEST_SHUTDOWN_SECONDS = float(os.getenv('INGEST_SHUTDOWN_SECONDS', '5'))
+#Where the visits go. Defaults to the table and columns dbqueryandsave exports from.
+INGEST_TABLE = os.getenv('INGEST_TABLE', 'ResumeVisitors')
+INGEST_IP_COLUMN = os.getenv('INGEST_IP_COLUMN', EXPORT_KEY_COLUMN)
+INGEST_COUNT_COLUMN = os.getenv('INGEST_COUNT_COLUMN', 'VisitCount')
+INGEST_LAST_VISITED_COLUMN = os.getenv('INGEST_LAST_VISITED_COLUMN', EXPORT_WATERMARK_COLUMN)
+#Also keep the per day summary table up to date. On by default when dbqueryandsave runs the aggregate export.
+INGEST_SUMMARY = os.getenv('INGEST_SUMMARY', '1' if EXPORT_MODE == 'aggregate' else '0') == '1'
+
+
+def summary_statements() -> list:
+    #Adds the batch onto the visitors' rows for the day in the summary table, creating the table first if it isn't there.
+    #The buffer only keeps each IP's latest visit, so that's used for first seen on a new day too. It's at most a flush apart.
+    table = check_column(SUMMARY_TABLE, 'SUMMARY_TABLE')
+    return [
+        summary_table_statement(),
+        f"MERGE {table} WITH (HOLDLOCK) AS target USING #VisitBatch AS source "
+        f"ON target.VisitDate = CAST(source.LastVisited AS DATE) AND target.IPAddress = source.IPAddress "
+        f"WHEN MATCHED THEN UPDATE SET target.Visits = target.Visits + source.Visits, "
+        f"target.LastSeen = CASE WHEN source.LastVisited > target.LastSeen THEN source.LastVisited ELSE target.LastSeen END "
+        f"WHEN NOT MATCHED THEN INSERT (VisitDate, IPAddress, Visits, FirstSeen, LastSeen) "
+        f"VALUES (CAST(source.LastVisited AS DATE), source.IPAddress, source.Visits, source.LastVisited, source.LastVisited);",
+    ]
+
+
+def upsert_statements(summary: bool = INGEST_SUMMARY) -> list:
+    """The T-SQL for one batched upsert. The second statement is the one that gets executemany'd.
+
+    With summary set the visits also go into the per day summary table,
+    those statements go after the MERGE and before the final DROP.
+    """
+    table = check_column(INGEST_TABLE, 'INGEST_TABLE')
+    ip = check_column(INGEST_IP_COLUMN, 'INGEST_IP_COLUMN')
+    count = check_column(INGEST_COUNT_COLUMN, 'INGEST_COUNT_COLUMN')
+    last_visited = check_column(INGEST_LAST_VISITED_COLUMN, 'INGEST_LAST_VISITED_COLUMN')
+    return [
+        "CREATE TABLE #VisitBatch (IPAddress NVARCHAR(45) PRIMARY KEY, Visits INT NOT NULL, LastVisited DATETIME2 NOT NULL)",
+        "INSERT INTO #VisitBatch (IPAddress, Visits, LastVisited) VALUES (?, ?, ?)",
+        f"MERGE {table} WITH (HOLDLOCK) AS target USING #VisitBatch AS source ON target.{ip} = source.IPAddress "
+        f"WHEN MATCHED THEN UPDATE SET target.{count} = target.{count} + source.Visits, "
+        f"target.{last_visited} = CASE WHEN source.LastVisited > target.{last_visited} THEN source.LastVisited ELSE target.{last_visited} END "
+        f"WHEN NOT MATCHED THEN INSERT ({ip}, {count}, {last_visited}) VALUES (source.IPAddress, source.Visits, source.LastVisited);",
+        *(summary_statements() if summary else []),
+        "DROP TABLE #VisitBatch",
+    ]
+
+
+def upsert_visits(conn, rows: list) -> None:
+    """Add rows of (ip, visits, last visited) onto the visitors table in one transaction."""
+    create, insert, *merges = upsert_statements()
+    cur = conn.cursor()
+    #Sends every row in one round trip instead of one per row.
+    cur.fast_executemany = True
+    cur.execute(create)
+    cur.executemany(insert, rows)
+    #The MERGE(s), then the DROP. All one transaction, so the summary can't end up out of step with the visitors table.
+    for statement in merges:
+        cur.execute(statement)
+    conn.commit()
+
+
+class VisitBuffer:
+    """Visit counts per IP waiting to be written. write(rows, timeout) does the actual upsert.
+
+    timeout is the seconds it has left, or None if there's no deadline.
+    """
+
+    def __init__(self, write, flush_size: int = INGEST_FLUSH_SIZE, flush_seconds: float = INGEST_FLUSH_SECONDS,
+                 batch_rows: int = INGEST_BATCH_ROWS, max_pending: int = INGEST_MAX_PENDING):
+        self.write = write
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.batch_rows = batch_rows
+        self.max_pending = max_pending
+        #_lock guards the dict, _flush_lock makes sure only one flush talks to the database at a time.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"visits": 0, "flushes": 0, "rows_written": 0, "failed_flushes": 0, "dropped": 0}
+
+    def add(self, ip: str, visits: int = 1, when: datetime.datetime = None) -> bool:
+        """Count a visit. Returns False if it had to be dropped because the buffer is full."""
+        #SQL's DATETIME2 has no time zone, so it's stored as naive UTC.
+        when = when or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            entry = self._pending.get(ip)
+            if entry is not None:
+                entry[0] += visits
+                entry[1] = max(entry[1], when)
+            elif len(self._pending) >= self.max_pending:
+                self.stats["dropped"] += visits
+                return False
+            else:
+                self._pending[ip] = [visits, when]
+            self.stats["visits"] += visits
+            due = len(self._pending) >= self.flush_size
+            if self._thread is None:
+                #Started on the first visit so workers that never get one don't run a thread for nothing.
+                self._thread = threading.Thread(target=self._flush_on_timer, name="visit-buffer", daemon=True)
+                self._thread.start()
+        if due:
+            self.flush()
+        return True
+
+    def _flush_on_timer(self) -> None:
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    def _requeue(self, rows: list) -> None:
+        #Put rows that didn't get written back so the next flush tries them again. Visits that came in meanwhile add on top.
+        with self._lock:
+            for ip, visits, when in rows:
+                entry = self._pending.get(ip)
+                if entry is not None:
+                    entry[0] += visits
+                    entry[1] = max(entry[1], when)
+                else:
+                    self._pending[ip] = [visits, when]
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, deadline: float = None) -> int:
+        """Write everything waiting, INGEST_BATCH_ROWS rows per upsert. Returns the rows written.
+
+        With a deadline (a time.monotonic() value) it only waits for another
+        flush until then, no new upsert starts after it and each one is told
+        how long is left. Anything not written goes back in the buffer.
+        """
+        if deadline is None:
+            self._flush_lock.acquire()
+        elif not self._flush_lock.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            logging.error('Another flush was still writing when the deadline came, not flushing')
+            return 0
+        try:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            rows = [(ip, visits, when) for ip, (visits, when) in batch.items()]
+            written = 0
+            try:
+                while written < len(rows):
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    chunk = rows[written:written + self.batch_rows]
+                    self.write(chunk, timeout)
+                    written += len(chunk)
+                self.stats["flushes"] += 1
+            except Exception as e:
+                self.stats["failed_flushes"] += 1
+                logging.error(f'Could not write {len(rows) - written} buffered visits, keeping them for the next flush: {e}')
+            finally:
+                self.stats["rows_written"] += written
+                if written < len(rows):
+                    self._requeue(rows[written:])
+            return written
+        finally:
+            self._flush_lock.release()
+
+    def close(self, timeout: float = INGEST_SHUTDOWN_SECONDS) -> None:
+        """Stop the timer and flush what's left, giving up after timeout seconds."""
+        self._stop.set()
+        if not self.pending():
+            return
+        self.flush(deadline=time.monotonic() + timeout)
+        left = self.pending()
+        if left:
+            logging.error(f'Shutting down with {left} IPs of visits still unwritten after {timeout}s, they are lost')
+
+    def install_shutdown_flush(self, timeout: float = INGEST_SHUTDOWN_SECONDS) -> None:
+        """Flush on interpreter exit and on SIGTERM (what the host sends when it recycles a worker)."""
+        atexit.register(self.close, timeout)
+        try:
+            previous = signal.getsignal(signal.SIGTERM)
+
+            def on_sigterm(signum, frame):
+                self.close(timeout)
+                if callable(previous):
+                    previous(signum, frame)
+                elif previous != signal.SIG_IGN:
+                    sys.exit(128 + signum)
+
+            signal.signal(signal.SIGTERM, on_sigterm)
+        except ValueError:
+            #Signal handlers can only be set from the main thread. atexit still covers a normal shutdown.
+            pass
+
+    def format_stats(self) -> str:
+        return (f"visits: {self.stats['visits']} buffered, {self.stats['rows_written']} rows written in "
+                f"{self.stats['flushes']} flushes, {self.stats['failed_flushes']} failed, "
+                f"{self.stats['dropped']} dropped, {self.pending()} waiting")
@@ -0,0 +1,130 @@
+import os
+
+#This file looks for unusual visitors in the per-IP history (visit_index.py) with plain statistics, no AI involved.
+#The index holds running totals, so the visits in each period are one column minus the one before it.
+#For the latest period every IP is compared against its own previous ANOMALY_WINDOW periods:
+#   spike      z-score of this period's visits against the rolling mean and std is at least ANOMALY_Z_THRESHOLD
+#   new burst  no visits at all in the window (brand new or back from the dead) and at least ANOMALY_BURST_VISITS now
+#It's all whole-array NumPy on just the columns the window needs, so 1M IPs x 52 periods is a fraction of a second.
+#To time it run: python benchmarks/anomaly_bench.py 1000000 52
+#The flags go into the prompt as a list of facts and into the email, so the model explains them rather than having to find them.
+
+#How many earlier periods each IP is compared against.
+ANOMALY_WINDOW = int(os.getenv('ANOMALY_WINDOW', '8'))
+#How many standard deviations above its own mean counts as a spike.
+ANOMALY_Z_THRESHOLD = float(os.getenv('ANOMALY_Z_THRESHOLD', '3'))
+#Ignore anything with fewer visits than this in the period, going from 0 to 2 isn't interesting.
+ANOMALY_MIN_VISITS = int(os.getenv('ANOMALY_MIN_VISITS', '10'))
+#How many visits an IP with no history in the window needs to count as a new burst.
+ANOMALY_BURST_VISITS = int(os.getenv('ANOMALY_BURST_VISITS', '25'))
+#Most flags of each kind that get reported.
+ANOMALY_MAX_FACTS = int(os.getenv('ANOMALY_MAX_FACTS', '20'))
+#A perfectly flat history has a std of 0, which would make any change infinitely many standard deviations.
+#Treating the std as at least this stops a visitor going from 3 to 4 a week being called a spike.
+ANOMALY_MIN_STD = float(os.getenv('ANOMALY_MIN_STD', '1'))
+
+
+def window_stats(counts, window: int):
+    """Visits in the latest period plus the mean and std of the window periods before it, for every IP at once.
+
+    counts is the index's running totals matrix (IPs x periods). Returns
+    (current visits, mean, std, periods of history used). The very first
+    period in the index has nothing before it to subtract, so it can't be
+    part of the history.
+    """
+    import numpy as np
+    ip_count, period_count = counts.shape
+    history = min(window, period_count - 2)
+    if history < 1:
+        return np.zeros(ip_count, dtype=np.int32), np.zeros(ip_count), np.zeros(ip_count), 0
+    total = np.zeros(ip_count)
+    squares = np.zeros(ip_count)
+    visits = np.empty(ip_count, dtype=np.int32)
+    #One column at a time: each one is subtracted from the one before and added to running sums,
+    #so only a few 1D arrays are ever allocated however long the window is.
+    previous = np.array(counts[:, period_count - history - 2], dtype=np.int32)
+    column = np.empty(ip_count, dtype=np.int32)
+    for position in range(period_count - history - 1, period_count):
+        np.copyto(column, counts[:, position])
+        np.subtract(column, previous, out=visits)
+        #Counts only go up, anything negative (a reset) is treated as 0.
+        np.maximum(visits, 0, out=visits)
+        if position == period_count - 1:
+            break
+        total += visits
+        squares += np.square(visits, dtype=np.float64)
+        previous, column = column, previous
+    mean = total / history
+    #E[x^2] - E[x]^2, clipped since rounding can take it just below 0.
+    std = np.sqrt(np.maximum(squares / history - mean * mean, 0))
+    return visits, mean, std, history
+
+
+def _top(rows, score, limit):
+    #argpartition finds the top limit without sorting everyone, then only those get sorted.
+    import numpy as np
+    if len(rows) > limit:
+        rows = rows[np.argpartition(-score[rows], limit - 1)[:limit]]
+    return rows[np.argsort(-score[rows], kind='stable')]
+
+
+def detect_anomalies(index: dict, window: int = ANOMALY_WINDOW, z_threshold: float = ANOMALY_Z_THRESHOLD,
+                     min_visits: int = ANOMALY_MIN_VISITS, burst_visits: int = ANOMALY_BURST_VISITS,
+                     limit: int = ANOMALY_MAX_FACTS) -> dict:
+    """Flag spikes and new bursts in the index's latest period.
+
+    Returns a dict with the period, how many periods of history were used,
+    how many IPs were checked and had visits, the total number of each flag,
+    and the top limit of each as lists of dicts (ip, visits, mean, std, z
+    for spikes; ip and visits for bursts), biggest first.
+    """
+    import numpy as np
+    periods = index["periods"]
+    result = {"period": periods[-1] if periods else None, "window": 0, "ips_checked": len(index["ips"]),
+              "active": 0, "z_threshold": z_threshold, "spike_count": 0, "burst_count": 0, "spikes": [], "bursts": []}
+    current, mean, std, history = window_stats(index["counts"], window)
+    #Needs at least one period of history before the latest one, so three snapshots in the index.
+    if not history:
+        return result
+    result["window"] = history
+    z = (current - mean) / np.maximum(std, ANOMALY_MIN_STD)
+
+    #A mean of 0 means not a single visit in the whole window.
+    quiet = mean == 0
+    bursts = np.flatnonzero(quiet & (current >= burst_visits))
+    spikes = np.flatnonzero(~quiet & (current >= min_visits) & (z >= z_threshold))
+    result["active"] = int(np.count_nonzero(current))
+    result["spike_count"] = len(spikes)
+    result["burst_count"] = len(bursts)
+    ips = index["ips"]
+    result["spikes"] = [{"ip": ips[row], "visits": int(current[row]), "mean": round(float(mean[row]), 1),
+                         "std": round(float(std[row]), 1), "z": round(float(z[row]), 1)}
+                        for row in _top(spikes, z, limit)]
+    result["bursts"] = [{"ip": ips[row], "visits": int(current[row])} for row in _top(bursts, current, limit)]
+    return result
+
+
+def _network(item: dict) -> str:
+    return f", {item['network']}" if "network" in item else ""
+
+
+def anomaly_sections(anomalies: dict) -> list:
+    """The flags as prompt sections, same (name, text) shape as visitor_diff.diff_sections."""
+    if anomalies["window"] == 0:
+        return []
+    lines = [f"Checked {anomalies['ips_checked']} IPs for {anomalies['period']} against their previous {anomalies['window']} periods, "
+             f"{anomalies['active']} had visits. {anomalies['spike_count']} spikes and {anomalies['burst_count']} new bursts were flagged."]
+    #ip_enrichment.annotate may have added which network each IP belongs to.
+    network = ", network" if any("network" in item for item in anomalies["spikes"] + anomalies["bursts"]) else ""
+    if anomalies["spikes"]:
+        lines.append(f"Spikes, at least {anomalies['z_threshold']:g} std above the IP's own average (IP, visits, average, std, z-score{network}):")
+        lines += [f"{spike['ip']}, {spike['visits']}, {spike['mean']}, {spike['std']}, {spike['z']}" + _network(spike) for spike in anomalies["spikes"]]
+    if anomalies["bursts"]:
+        lines.append(f"New bursts, no visits in the previous {anomalies['window']} periods (IP, visits{network}):")
+        lines += [f"{burst['ip']}, {burst['visits']}" + _network(burst) for burst in anomalies["bursts"]]
+    return [("anomalies", '\n'.join(lines))]
+
+
+def format_anomalies(anomalies: dict) -> str:
+    #Plain text version for the email.
+    return '\n'.join(text for _, text in anomaly_sections(anomalies)) or "Not enough history in the visit index to look for anomalies yet"
@@ -0,0 +1,95 @@
+#This file works out what changed between two visitor snapshots before anything goes to the AI.
+#Last period's snapshot is loaded into a dict keyed by IP, then this period's snapshot is walked once and looked up against it.
+#That's one pass over each snapshot, so it stays O(n) however many visitors there are, and only the IPs that actually
+#changed make it into the prompt.
+
+
+def tally(ips, counts) -> dict:
+    #Same IP showing up twice in one snapshot gets added together rather than the second one winning.
+    visits = {}
+    for ip, count in zip(ips, counts):
+        visits[ip] = visits.get(ip, 0) + int(count)
+    return visits
+
+
+def diff_snapshots(last_ips, last_counts, this_ips, this_counts) -> dict:
+    """Compare two snapshots by IP.
+
+    Returns a dict with:
+        new      [(ip, visits)] for IPs only in this period
+        gone     [(ip, visits)] for IPs only in last period
+        changed  [(ip, before, after, delta)] for IPs whose count moved
+        totals   visitor and visit totals for both periods plus the unchanged count
+    Each list is sorted with the biggest movers first.
+    """
+    last = tally(last_ips, last_counts)
+    this = tally(this_ips, this_counts)
+    new = []
+    changed = []
+    unchanged = 0
+    for ip, after in this.items():
+        before = last.get(ip)
+        if before is None:
+            new.append((ip, after))
+        elif before != after:
+            changed.append((ip, before, after, after - before))
+        else:
+            unchanged += 1
+    gone = [(ip, before) for ip, before in last.items() if ip not in this]
+
+    new.sort(key=lambda item: (-item[1], item[0]))
+    gone.sort(key=lambda item: (-item[1], item[0]))
+    changed.sort(key=lambda item: (-abs(item[3]), item[0]))
+    totals = {
+        "visitors_before": len(last),
+        "visitors_after": len(this),
+        "visits_before": sum(last.values()),
+        "visits_after": sum(this.values()),
+        "new_visitors": len(new),
+        "gone_visitors": len(gone),
+        "changed_visitors": len(changed),
+        "unchanged_visitors": unchanged,
+    }
+    return {"new": new, "gone": gone, "changed": changed, "totals": totals}
+
+
+def format_totals(totals: dict) -> str:
+    return (f"Unique visitors: {totals['visitors_before']} -> {totals['visitors_after']}\n"
+            f"Total visits: {totals['visits_before']} -> {totals['visits_after']} "
+            f"({totals['visits_after'] - totals['visits_before']:+d})\n"
+            f"New visitors: {totals['new_visitors']}, gone: {totals['gone_visitors']}, "
+            f"changed: {totals['changed_visitors']}, unchanged: {totals['unchanged_visitors']}")
+
+
+def _limited(items, limit, line) -> str:
+    #Formats the first limit items with line() and says how many were left out.
+    #The list is cut down before anything is formatted, so a top 50 of a million visitors only formats 50 lines.
+    shown = items if limit is None else items[:limit]
+    lines = [line(item) for item in shown]
+    if len(shown) < len(items):
+        lines.append(f"... and {len(items) - len(shown)} more")
+    return '\n'.join(lines)
+
+
+def diff_sections(diff: dict, limit: int = None, label: str = "IP") -> list:
+    """Text for each part of the diff as a list of (section name, text).
+
+    limit keeps only the biggest movers in each list. label is what the
+    first column is called, e.g. "Subnet" when the diff has been grouped.
+    """
+    sections = [("totals", format_totals(diff["totals"]))]
+    if diff["new"]:
+        lines = _limited(diff["new"], limit, lambda item: f"{item[0]}, {item[1]}")
+        sections.append(("new", f"New visitors ({label}, visits):\n" + lines))
+    if diff["changed"]:
+        lines = _limited(diff["changed"], limit, lambda item: f"{item[0]}, {item[1]}, {item[2]}, {item[3]:+d}")
+        sections.append(("changed", f"Changed visit counts ({label}, before, after, change):\n" + lines))
+    if diff["gone"]:
+        lines = _limited(diff["gone"], limit, lambda item: f"{item[0]}, {item[1]}")
+        sections.append(("gone", f"Visitors no longer in the results ({label}, visits last time):\n" + lines))
+    return sections
+
+
+def format_diff(diff: dict, limit: int = None) -> str:
+    #Plain text version of the diff for the prompt and the email.
+    return '\n\n'.join(text for _, text in diff_sections(diff, limit))
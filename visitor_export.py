@@ -0,0 +1,577 @@
+import os
+import re
+import json
+import math
+import base64
+import hashlib
+import datetime
+import logging
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from snapshot_format import (SNAPSHOT_EXTENSION, encode_snapshot, encode_header, encode_row_batch, encode_footer,
+                             iter_row_groups, parse_text_snapshot)
+from blob_compression import codec_for, compress_block, download_chunks
+from snapshot_catalog import record_snapshot
+
+#This file holds the helpers dbqueryandsave uses to move rows out of SQL and into blob storage.
+#Instead of fetchall() and one giant upload_blob, the rows are pulled in fixed-size batches with fetchmany()
+#and each batch is staged as its own block. Nothing is visible in the container until commit_block_list runs at the very end,
+#so memory only ever holds one batch no matter how big the ResumeVisitors table gets.
+#Every block is staged with validate_content=True so the service checks each one against its MD5 as it arrives,
+#which means checking the upload afterwards (verify_upload) is one properties call instead of downloading the whole export again.
+#The MD5 of everything staged is also worked out on the way past and saved as the blob's Content-MD5 for later readers.
+#Text exports are gzipped block by block on the way out (see blob_compression.py), so the sizes and MD5s here are of the
+#compressed bytes that are actually stored.
+
+#How many rows to pull from the cursor per round trip. Each batch becomes one staged block.
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '5000'))
+#'full' re-exports the whole table every run. 'incremental' only exports rows changed since the last run (see export_incremental).
+#'aggregate' has SQL add the visits up and only exports one row of totals per visitor (see visitor_summary.py).
+EXPORT_MODE = os.getenv('EXPORT_MODE', 'full')
+#The column that tells me a row has changed. Has to only ever go up, e.g. a last visited timestamp or an identity key.
+EXPORT_WATERMARK_COLUMN = os.getenv('EXPORT_WATERMARK_COLUMN', 'LastVisited')
+#After this many deltas have piled up they get folded back into a full visitors{date}.txt snapshot.
+EXPORT_COMPACT_EVERY = int(os.getenv('EXPORT_COMPACT_EVERY', '7'))
+#'vsnap' writes full snapshots in the compact columnar format from snapshot_format.py, 'txt' keeps the old repr-of-Row text.
+#Incremental deltas are always text since they get merged line by line.
+SNAPSHOT_FORMAT = os.getenv('SNAPSHOT_FORMAT', 'vsnap')
+#'size' checks an upload's stored size (the blocks were already MD5 checked as they were staged). 'deep' also downloads it and hashes
+#every byte, which costs a full re-download.
+EXPORT_VERIFY_MODE = os.getenv('EXPORT_VERIFY_MODE', 'size')
+#Full exports are ordered by this column so the output is the same every time. It has to be unique, e.g. the primary key.
+EXPORT_KEY_COLUMN = os.getenv('EXPORT_KEY_COLUMN', 'IPAddress')
+#More than 1 splits a full export into this many key ranges that are read and uploaded in parallel (see export_parallel).
+EXPORT_PARTITIONS = int(os.getenv('EXPORT_PARTITIONS', '1'))
+#How many partitions are read at the same time, each on its own (pooled) SQL connection.
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '4'))
+#The most rows in one partition. A big table gets split into more partitions than EXPORT_PARTITIONS rather than bigger ones,
+#since a partition's blocks are held until the ones before it have been hashed (see export_parallel).
+EXPORT_PARTITION_ROWS = int(os.getenv('EXPORT_PARTITION_ROWS', '100000'))
+
+RESULTS_CONTAINER = "results"
+WATERMARK_BLOB = "watermark.json"
+
+
+def check_column(name: str, setting: str) -> str:
+    #Column names go straight into the SQL so they have to be plain identifiers. Values always go in as parameters.
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name):
+        raise ValueError(f"{setting} '{name}' is not a valid column name")
+    return name
+
+
+def make_block_id(index: int) -> str:
+    #Block IDs have to be base64 and all the same length within a blob, so I zero pad the counter before encoding it.
+    #12 digits leaves room for the parallel export's partition numbers in the high bits, see partition_block_id.
+    return base64.b64encode(f"{index:012d}".encode('utf-8')).decode('utf-8')
+
+
+#Each partition of the parallel export numbers its blocks from partition << PARTITION_BLOCK_BITS, so a partition that
+#ends up with more batches than planned can never run into the next one's IDs (or the footer's).
+PARTITION_BLOCK_BITS = 20
+
+
+def partition_block_id(partition: int, sequence: int) -> str:
+    if sequence >= 1 << PARTITION_BLOCK_BITS:
+        raise ValueError(f"Partition {partition} has more than {1 << PARTITION_BLOCK_BITS} blocks")
+    return make_block_id(partition << PARTITION_BLOCK_BITS | sequence)
+
+
+def encode_rows(rows, first_batch: bool) -> bytes:
+    #Same text the old version produced, str(row) per line. Every batch after the first starts with a newline
+    #so that gluing the blocks back together gives exactly the old '\n'.join() output.
+    chunk = '\n'.join(str(row) for row in rows)
+    if not first_batch:
+        chunk = '\n' + chunk
+    return chunk.encode('utf-8')
+
+
+def stage_batches(blob_client, batches, commit_empty: bool = True):
+    """Stage every chunk of bytes yielded by batches as a block and commit them in order.
+
+    Returns (bytes written, MD5 digest of those bytes). The digest is stored
+    as the blob's Content-MD5 for verify_upload. The commit fails if the blob
+    already exists, same as the old non-overwriting upload_blob. With
+    commit_empty set to False nothing is committed when batches yields
+    nothing, and (0, None) is returned. If the blob already exists with the
+    same Content-MD5 (a retry re-uploading the same export) that counts as
+    success, so the upload is safe to repeat. Text blobs have every block
+    compressed as it's staged and the blob's Content-Encoding set to match.
+    """
+    codec = codec_for(blob_client.blob_name)
+    block_ids = []
+    byte_count = 0
+    md5 = hashlib.md5()
+    for data in batches:
+        if codec:
+            data = compress_block(data, codec)
+        block_id = make_block_id(len(block_ids))
+        blob_client.stage_block(block_id=block_id, data=data, validate_content=True)
+        block_ids.append(block_id)
+        byte_count += len(data)
+        md5.update(data)
+    if not block_ids and not commit_empty:
+        return 0, None
+    commit_blocks(blob_client, block_ids, md5.digest(), codec)
+    return byte_count, md5.digest()
+
+
+def commit_blocks(blob_client, block_ids: list, content_md5: bytes, content_encoding: str = None) -> None:
+    """Commit the staged blocks in the given order with content_md5 as the blob's Content-MD5.
+
+    content_encoding is what the blocks were compressed with (None if they weren't).
+    """
+    # Only needed once there's something to upload, and azure.storage.blob is slow to import. See benchmarks/import_time.py
+    from azure.storage.blob import ContentSettings
+    # If this file already exists, the commit will fail. This is intentional and matches the old upload_blob behaviour.
+    # Blob storage doesn't work out an MD5 for a block list by itself, so I hand it the one I calculated.
+    try:
+        blob_client.commit_block_list(block_ids, content_settings=ContentSettings(content_md5=content_md5,
+                                                                                   content_encoding=content_encoding),
+                                      match_condition=MatchConditions.IfMissing)
+    except ResourceExistsError:
+        existing_md5 = blob_client.get_blob_properties().content_settings.content_md5
+        if existing_md5 is None or bytes(existing_md5) != content_md5:
+            raise
+        logging.warning(f'{blob_client.blob_name} was already uploaded with the same content, keeping it')
+
+
+def verify_upload(blob_client, byte_count: int, content_md5: bytes, mode: str = EXPORT_VERIFY_MODE):
+    """Check the blob holds what was staged. Returns (ok, bytes downloaded, what was checked).
+
+    By default this is a single get_blob_properties call whatever the size, and
+    the stored size is the only thing it can really check. The blob's
+    Content-MD5 is the value commit_blocks handed over itself, so comparing it
+    would always pass. The bytes are checked on the way in instead: every block
+    is staged with validate_content=True, so the service rejects a block that
+    doesn't match its own MD5. In 'deep' mode the blob is also downloaded chunk
+    by chunk and hashed against content_md5.
+    """
+    properties = blob_client.get_blob_properties()
+    if properties.size != byte_count:
+        return False, 0, f"size is {properties.size} bytes, expected {byte_count}"
+    if mode != 'deep':
+        return True, 0, f"size matches ({byte_count} bytes, every block was MD5 checked when it was staged)"
+    #Deep check: hash what actually comes back, one chunk at a time so the export is never held in memory twice.
+    #decompress=False so it's the stored (compressed) bytes that get hashed, same as what was staged.
+    md5 = hashlib.md5()
+    downloaded = 0
+    for chunk in blob_client.download_blob(decompress=False).chunks():
+        md5.update(chunk)
+        downloaded += len(chunk)
+    if md5.digest() != content_md5:
+        return False, downloaded, "downloaded content does not match what was staged"
+    return True, downloaded, f"downloaded {downloaded} bytes and the MD5 matches"
+
+
+def iter_export_groups(blob_service_client, filename: str, batch_size: int = EXPORT_BATCH_SIZE):
+    """Read an export back as (ips, counts) groups without ever holding more than one group.
+
+    This is how the visit index gets its rows after the export, straight off the
+    blob. .vsnap files come back one row group at a time, .txt and .delta.txt
+    files (compressed or not) batch_size lines at a time.
+    """
+    blob_client = blob_service_client.get_blob_client(RESULTS_CONTAINER, filename)
+    if filename.endswith(SNAPSHOT_EXTENSION):
+        yield from iter_row_groups(download_chunks(blob_client))
+        return
+    lines = []
+    for line in iter_blob_lines(blob_client):
+        if line.strip():
+            lines.append(line)
+        if len(lines) == batch_size:
+            yield parse_text_snapshot('\n'.join(lines))
+            lines = []
+    if lines:
+        yield parse_text_snapshot('\n'.join(lines))
+
+
+def stream_rows_to_blob(cur, blob_client, batch_size: int = EXPORT_BATCH_SIZE, on_batch=None, commit_empty: bool = True,
+                        snapshot_format: str = 'txt'):
+    """Stream the result set on cur into blob_client as staged blocks.
+
+    on_batch is called with every batch of rows before it is encoded, which is
+    how the incremental export keeps track of its watermark. snapshot_format
+    is 'txt' for repr-of-Row lines or 'vsnap' for snapshot_format.py. Returns a
+    tuple of (rows written, bytes written, MD5 of the bytes written).
+    """
+    row_count = 0
+
+    def row_batches():
+        nonlocal row_count
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            if on_batch:
+                on_batch(rows)
+            row_count += len(rows)
+            logging.info(f'Staging batch of {len(rows)} rows')
+            yield rows
+
+    def text_batches():
+        first_batch = True
+        for rows in row_batches():
+            yield encode_rows(rows, first_batch)
+            first_batch = False
+
+    if snapshot_format == 'vsnap':
+        batches = encode_snapshot(row_batches())
+    else:
+        batches = text_batches()
+    byte_count, content_md5 = stage_batches(blob_client, batches, commit_empty)
+    return row_count, byte_count, content_md5
+
+
+def snapshot_filename(today: str, snapshot_format: str = SNAPSHOT_FORMAT) -> str:
+    extension = SNAPSHOT_EXTENSION if snapshot_format == 'vsnap' else ".txt"
+    return f"visitors{today}{extension}"
+
+
+def export_full(cur, blob_service_client, today: str, on_batch=None):
+    """Export the whole ResumeVisitors table to today's snapshot. Returns (filename, rows, bytes, MD5).
+
+    on_batch gets every batch of rows as it goes past, see stream_rows_to_blob.
+    """
+    #Ordered by the key so a re-run (or the parallel export) writes exactly the same bytes.
+    key = check_column(EXPORT_KEY_COLUMN, 'EXPORT_KEY_COLUMN')
+    cur.execute(f"SELECT * FROM ResumeVisitors ORDER BY {key}")
+    filename = snapshot_filename(today)
+    blob_client = blob_service_client.get_blob_client(RESULTS_CONTAINER, filename)
+    row_count, byte_count, content_md5 = stream_rows_to_blob(cur, blob_client, on_batch=on_batch,
+                                                             snapshot_format=SNAPSHOT_FORMAT)
+    return filename, row_count, byte_count, content_md5
+
+
+def partition_bounds(cur, key: str, partitions: int, batch_size: int = EXPORT_BATCH_SIZE,
+                     max_rows: int = EXPORT_PARTITION_ROWS):
+    """Split the table into key ranges. Returns (first key of each range, batches per range, total rows).
+
+    There are partitions ranges, or more if that would put over max_rows rows
+    (rounded down to whole batches, at least one) in a range. Every range is a
+    whole number of batches long, so reading each one with fetchmany(batch_size)
+    gives exactly the same batches a single cursor would have, which is what
+    keeps the parallel output byte-identical.
+    """
+    cur.execute("SELECT COUNT(*) FROM ResumeVisitors")
+    total = cur.fetchone()[0]
+    batches_per_partition = max(min(math.ceil(total / max(partitions, 1) / batch_size), max_rows // batch_size), 1)
+    #Numbering the rows in key order and keeping every step'th one gives the first key of each range in one query.
+    cur.execute(f"SELECT {key} FROM (SELECT {key}, ROW_NUMBER() OVER (ORDER BY {key}) AS row_position FROM ResumeVisitors) numbered "
+                f"WHERE (row_position - 1) % ? = 0 ORDER BY {key}", batches_per_partition * batch_size)
+    return [row[0] for row in cur.fetchall()], batches_per_partition, total
+
+
+def export_parallel(cur, connect, blob_service_client, today: str, on_batch=None, on_restart=None,
+                    partitions: int = EXPORT_PARTITIONS, workers: int = EXPORT_WORKERS):
+    """Full export with the table split into key ranges that are read and staged in parallel. Returns (filename, rows, bytes, MD5).
+
+    connect opens a new SQL connection, each range is read on its own one in
+    a thread pool. Block IDs sort in key order (see partition_block_id), so the
+    blocks can be staged in any order and the committed blob comes out the
+    same as export_full's.
+    The ranges are read on separate connections, so they can't all see one
+    snapshot of the table. Instead every range's row count is checked against
+    the plan. If rows were added or removed while it ran the batches no longer
+    line up with a serial read, so nothing is committed and it falls back to
+    export_full on cur.
+    on_batch gets every batch of rows, from the worker threads and in no
+    particular order. If it falls back, on_restart is called first so whatever
+    on_batch collected can be thrown away before export_full sends every row again.
+    """
+    key = check_column(EXPORT_KEY_COLUMN, 'EXPORT_KEY_COLUMN')
+    bounds, batches_per_partition, total = partition_bounds(cur, key, partitions)
+    if not bounds:
+        return export_full(cur, blob_service_client, today, on_batch)
+    filename = snapshot_filename(today)
+    blob_client = blob_service_client.get_blob_client(RESULTS_CONTAINER, filename)
+    vsnap = SNAPSHOT_FORMAT == 'vsnap'
+    #Each block is compressed on its own by the worker that read it, which gives the same bytes as stage_batches would.
+    codec = codec_for(filename)
+    #A .vsnap starts with a header block and ends with a footer block, the row groups go in between.
+    #The header is block 0 and the ranges are partitions 1 to len(bounds), so the footer is the partition after the last.
+    partition_rows = batches_per_partition * EXPORT_BATCH_SIZE
+    logging.warning(f'Exporting {len(bounds)} key ranges of up to {batches_per_partition * EXPORT_BATCH_SIZE} rows on {workers} threads')
+
+    def read_partition(number: int):
+        #The first range has no lower bound and the last no upper bound, so a key added outside the planned ones still lands in one.
+        conditions, params = [], []
+        if number > 0:
+            conditions.append(f"{key} >= ?")
+            params.append(bounds[number])
+        if number + 1 < len(bounds):
+            conditions.append(f"{key} < ?")
+            params.append(bounds[number + 1])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        query = f"SELECT * FROM ResumeVisitors{where} ORDER BY {key}"
+        conn = connect()
+        try:
+            partition_cur = conn.cursor()
+            partition_cur.execute(query, *params)
+            staged = []
+            while True:
+                rows = partition_cur.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                if on_batch:
+                    on_batch(rows)
+                if vsnap:
+                    data = encode_row_batch(rows)
+                else:
+                    data = encode_rows(rows, first_batch=number == 0 and not staged)
+                if codec:
+                    data = compress_block(data, codec)
+                block_id = partition_block_id(number + 1, len(staged))
+                blob_client.stage_block(block_id=block_id, data=data, validate_content=True)
+                #The rows are done with once they're encoded. Only the staged bytes are kept, for the MD5.
+                staged.append((block_id, len(rows), data))
+            return staged
+        finally:
+            conn.close()
+
+    block_ids = []
+    row_count = 0
+    byte_count = 0
+    md5 = hashlib.md5()
+
+    def add_block(block_id: str, data: bytes):
+        nonlocal byte_count
+        block_ids.append(block_id)
+        byte_count += len(data)
+        md5.update(data)
+
+    if vsnap:
+        header = encode_header()
+        blob_client.stage_block(block_id=make_block_id(0), data=header, validate_content=True)
+        add_block(make_block_id(0), header)
+    #The MD5 needs the blocks in order, so the results are taken in partition order. Only a few partitions are
+    #let ahead of the one being waited on, so memory holds the staged bytes of at most about 2 x workers partitions of up to
+    #EXPORT_PARTITION_ROWS rows each, no matter how big the table is.
+    changed = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        next_partition = 0
+        while next_partition < len(bounds) or pending:
+            while next_partition < len(bounds) and len(pending) < workers * 2:
+                pending.append(pool.submit(read_partition, next_partition))
+                next_partition += 1
+            number = next_partition - len(pending)
+            staged = pending.popleft().result()
+            read = sum(rows for _, rows, _ in staged)
+            expected = partition_rows if number + 1 < len(bounds) else total - number * partition_rows
+            if read != expected:
+                changed = f"key range {number + 1} of {len(bounds)} had {read} rows, expected {expected}"
+                for future in pending:
+                    future.cancel()
+                break
+            for block_id, rows, data in staged:
+                add_block(block_id, data)
+                row_count += rows
+    if changed:
+        #Whatever got staged is never committed, export_full's blocks replace it.
+        logging.warning(f'The table changed during the parallel export ({changed}), exporting it serially instead')
+        #The pool has finished with every range by now, so nothing else reaches on_batch from the parallel read.
+        if on_restart:
+            on_restart()
+        return export_full(cur, blob_service_client, today, on_batch)
+    if vsnap:
+        footer = encode_footer()
+        footer_id = partition_block_id(len(bounds) + 1, 0)
+        blob_client.stage_block(block_id=footer_id, data=footer, validate_content=True)
+        add_block(footer_id, footer)
+    commit_blocks(blob_client, block_ids, md5.digest(), codec)
+    return filename, row_count, byte_count, md5.digest()
+
+
+#The watermark lives in the results container next to the snapshots. It remembers the highest value of the watermark column
+#I've exported so far, the rows exported with exactly that value, which full snapshot the deltas build on, and the deltas
+#written since then.
+#export_incremental only works out the new state. dbqueryandsave saves it once the export is checkpointed, so a retry
+#after a failure in between asks for the same rows again instead of finding nothing new and losing that delta.
+def load_watermark(blob_service_client):
+    blob_client = blob_service_client.get_blob_client(RESULTS_CONTAINER, WATERMARK_BLOB)
+    try:
+        state = json.loads(blob_client.download_blob().readall().decode('utf-8'))
+    except ResourceNotFoundError:
+        return None
+    if state.get("type") == "datetime":
+        state["value"] = datetime.datetime.fromisoformat(state["value"])
+    return state
+
+
+def watermark_state(value, base: str, deltas: list, at_watermark: dict) -> dict:
+    """The watermark as plain JSON, ready for save_watermark (or a checkpoint)."""
+    #datetimes don't survive json on their own so I store the type next to the value.
+    if isinstance(value, datetime.datetime):
+        stored_type, stored_value = "datetime", value.isoformat()
+    elif isinstance(value, int):
+        stored_type, stored_value = "int", value
+    else:
+        stored_type, stored_value = "str", None if value is None else str(value)
+    return {
+        "column": EXPORT_WATERMARK_COLUMN,
+        "type": stored_type,
+        "value": stored_value,
+        "at_watermark": at_watermark,
+        "base": base,
+        "deltas": deltas,
+    }
+
+
+def save_watermark(blob_service_client, state: dict) -> None:
+    blob_client = blob_service_client.get_blob_client(RESULTS_CONTAINER, WATERMARK_BLOB)
+    blob_client.upload_blob(json.dumps(state), overwrite=True)
+
+
+def row_key(line: str) -> str:
+    #Lines look like ('1.2.3.4', 5, ...). Everything up to the first comma is the visitor's IP, which is what I merge on.
+    return line.split(',', 1)[0]
+
+
+def iter_blob_lines(blob_client):
+    #Walks a text blob line by line without downloading the whole thing first, decompressing as it goes.
+    leftover = b''
+    for chunk in download_chunks(blob_client):
+        leftover += chunk
+        *lines, leftover = leftover.split(b'\n')
+        for line in lines:
+            yield line.decode('utf-8')
+    if leftover:
+        yield leftover.decode('utf-8')
+
+
+def compact_snapshot(blob_service_client, base: str, deltas: list, filename: str):
+    """Fold the deltas into the base snapshot and write the result to filename. Returns (rows, bytes, MD5).
+
+    Only the deltas are held in memory. The base is streamed through and any
+    line whose IP shows up in a delta is swapped for the newest version of it.
+    """
+    changed = {}
+    for delta in deltas:
+        for line in iter_blob_lines(blob_service_client.get_blob_client(RESULTS_CONTAINER, delta)):
+            if line:
+                changed[row_key(line)] = line
+    row_count = 0
+
+    def lines():
+        batch = []
+        for line in iter_blob_lines(blob_service_client.get_blob_client(RESULTS_CONTAINER, base)):
+            if not line:
+                continue
+            batch.append(changed.pop(row_key(line), line))
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                yield batch
+                batch = []
+        #Whatever is left in changed are visitors that weren't in the base snapshot at all.
+        batch.extend(changed.values())
+        if batch:
+            yield batch
+
+    def batches():
+        nonlocal row_count
+        first_batch = True
+        for batch in lines():
+            row_count += len(batch)
+            yield encode_rows(batch, first_batch)
+            first_batch = False
+
+    byte_count, content_md5 = stage_batches(blob_service_client.get_blob_client(RESULTS_CONTAINER, filename), batches())
+    return row_count, byte_count, content_md5
+
+
+class _SkipExported:
+    #Cursor wrapper for export_incremental. The query asks for rows at or after the watermark, so a row written later with
+    #exactly the watermark's value isn't missed. The rows that were already exported at that value (same key, same row)
+    #get dropped here on the way past so they don't go out again.
+    def __init__(self, cur, key_index: int, exported: dict):
+        self._cur = cur
+        self._key_index = key_index
+        self._exported = exported
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def fetchmany(self, size: int):
+        while True:
+            rows = self._cur.fetchmany(size)
+            if not rows:
+                return rows
+            rows = [row for row in rows if self._exported.get(str(row[self._key_index])) != str(row)]
+            if rows:
+                return rows
+
+
+def export_incremental(cur, blob_service_client, today: str, on_batch=None):
+    """Export only the rows changed since the last run. Returns (filename, rows, bytes, MD5, new watermark state).
+
+    The first run (no watermark yet) and every EXPORT_COMPACT_EVERY'th run
+    produce a full visitors{today}.txt snapshot. Every other run writes the
+    changed rows to visitors{today}.delta.txt. on_batch gets every batch of
+    exported rows as it goes past. The watermark isn't saved here, the caller
+    passes the state to save_watermark once the export has been recorded (it's
+    None if there's nothing to save).
+    """
+    check_column(EXPORT_WATERMARK_COLUMN, 'EXPORT_WATERMARK_COLUMN')
+    key = check_column(EXPORT_KEY_COLUMN, 'EXPORT_KEY_COLUMN')
+    state = load_watermark(blob_service_client)
+
+    if state is None or state.get("column") != EXPORT_WATERMARK_COLUMN:
+        cur.execute(f"SELECT * FROM ResumeVisitors ORDER BY {EXPORT_WATERMARK_COLUMN}")
+        filename = f"visitors{today}.txt"
+        previous_value, base, deltas, at_watermark = None, filename, [], {}
+    else:
+        cur.execute(f"SELECT * FROM ResumeVisitors WHERE {EXPORT_WATERMARK_COLUMN} >= ? ORDER BY {EXPORT_WATERMARK_COLUMN}",
+                    state["value"])
+        filename = f"visitors{today}.delta.txt"
+        previous_value, base, deltas = state["value"], state["base"], list(state["deltas"])
+        at_watermark = dict(state.get("at_watermark", {}))
+
+    #Find which position the watermark and key columns are in so I can pick the highest value out of each batch as it streams past.
+    columns = [column[0].lower() for column in cur.description]
+    watermark_index = columns.index(EXPORT_WATERMARK_COLUMN.lower())
+    key_index = columns.index(key.lower())
+    rows_in = _SkipExported(cur, key_index, dict(at_watermark))
+    high_water = previous_value
+
+    def track_watermark(rows):
+        nonlocal high_water, at_watermark
+        #Rows come back ordered by the watermark column, so the last row in the batch has the highest value.
+        #Every row with exactly that value is remembered so the next run's >= doesn't export it again.
+        last = rows[-1][watermark_index]
+        if last != high_water:
+            high_water, at_watermark = last, {}
+        for row in reversed(rows):
+            if row[watermark_index] != last:
+                break
+            at_watermark[str(row[key_index])] = str(row)
+        if on_batch:
+            on_batch(rows)
+
+    #A quiet day with no changes doesn't leave an empty delta blob behind.
+    is_delta = filename.endswith(".delta.txt")
+    row_count, byte_count, content_md5 = stream_rows_to_blob(
+        rows_in, blob_service_client.get_blob_client(RESULTS_CONTAINER, filename),
+        on_batch=track_watermark, commit_empty=not is_delta)
+    if is_delta:
+        if not row_count:
+            logging.warning('No rows changed since the last export, nothing to write')
+            return None, 0, 0, None, None
+        deltas.append(filename)
+
+    #Enough deltas have built up, fold them into a fresh full snapshot so readers only ever need one file.
+    if len(deltas) >= EXPORT_COMPACT_EVERY:
+        snapshot = f"visitors{today}.txt"
+        snapshot_rows, snapshot_bytes, snapshot_md5 = compact_snapshot(blob_service_client, base, deltas, snapshot)
+        logging.warning(f'Compacted {len(deltas)} deltas into {snapshot} ({snapshot_rows} rows, {snapshot_bytes} bytes)')
+        #dbqueryandsave only catalogs the delta it was handed back, so the new full snapshot gets its entry here.
+        record_snapshot(blob_service_client, snapshot, snapshot_bytes, snapshot_rows, snapshot_md5, RESULTS_CONTAINER)
+        base, deltas = snapshot, []
+
+    #An empty table on the first run leaves nothing to measure from. Saving None would make every later run ask for rows
+    #'> NULL' and never export anything again, so the watermark is only saved once there's a real value and the next run does a full export.
+    if high_water is None:
+        logging.warning('No rows to take a watermark from yet, the next run will do a full export again')
+        return filename, row_count, byte_count, content_md5, None
+    return filename, row_count, byte_count, content_md5, watermark_state(high_water, base, deltas, at_watermark)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from azure.core.exceptions import ResourceNotFoundError
+from completion_cache import LRUCache
+from visit_index import VISIT_INDEX_BLOB, empty_index, decode_index, last_days
+from visitor_diff import diff_snapshots
+
+#This file answers the visitor stats HTTP endpoints in function_app.py (top visitors, one IP's history, the diff between two periods).
+#Everything comes out of the visit index (visit_index.py), which dbqueryandsave updates after every export.
+#
+#Each worker keeps the index it last loaded plus an LRU of the JSON it has already built, keyed by the index's blob ETag and the request.
+#A repeat request is a dict lookup, no blob or SQL call. At most once every STATS_REFRESH_SECONDS a request also checks the
+#index blob's properties, and if the ETag changed (a new snapshot landed) it reloads the index and throws the old answers away.
+#dbqueryandsave calls invalidate() after it updates the index, so a worker that ran the export doesn't wait for the refresh either.
+#Every response has an ETag, and a request with a matching If-None-Match gets a 304 with no body.
+
+#How often a worker checks whether the index blob has changed.
+STATS_REFRESH_SECONDS = int(os.getenv('STATS_REFRESH_SECONDS', '60'))
+#Caps for the cached responses.
+STATS_CACHE_MAX_ENTRIES = int(os.getenv('STATS_CACHE_MAX_ENTRIES', '256'))
+STATS_CACHE_MAX_BYTES = int(os.getenv('STATS_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+#The most rows any list in a response will have.
+STATS_MAX_LIMIT = 1000
+
+
+def top_visitors(index: dict, limit: int = 10, days: int = None) -> dict:
+    """The IPs with the most visits, either all time (the latest period) or over the last days days."""
+    import numpy as np
+    if days:
+        ips, visits = last_days(index, days)
+    elif index["periods"]:
+        ips, visits = index["ips"], index["counts"][:, -1]
+    else:
+        ips, visits = [], np.zeros(0)
+    visits = np.asarray(visits, dtype=np.int64)
+    limit = min(limit, len(ips))
+    #argpartition finds the top limit without sorting everyone, then only those get sorted.
+    top = np.argpartition(-visits, limit - 1)[:limit] if limit else np.zeros(0, dtype=np.int64)
+    top = sorted(top, key=lambda row: (-visits[row], ips[row]))
+    return {
+        "period": index["periods"][-1] if index["periods"] else None,
+        "days": days,
+        "visitors": [{"ip": ips[row], "visits": int(visits[row])} for row in top if visits[row] > 0],
+    }
+
+
+def ip_history(index: dict, row_of: dict, ip: str) -> dict:
+    """Visit count for one IP in every period of the index. Raises KeyError if the index has never seen it."""
+    row = row_of[ip]
+    return {
+        "ip": ip,
+        "history": [{"period": period, "visits": int(count)} for period, count in zip(index["periods"], index["counts"][row])],
+    }
+
+
+def period_column(index: dict, day: str) -> int:
+    #The latest period on or before day.
+    columns = [i for i, period in enumerate(index["periods"]) if period <= day]
+    if not columns:
+        raise ValueError(f"The visit index has no period on or before {day}")
+    return columns[-1]
+
+
+def period_diff(index: dict, start: str = None, end: str = None, limit: int = 50) -> dict:
+    """New, gone and changed visitors between two periods, by default the last two. Same shape as visitor_diff.py."""
+    if len(index["periods"]) < 2 and not (start and end):
+        raise ValueError("The visit index needs at least two periods to compare")
+    end_column = period_column(index, end) if end else len(index["periods"]) - 1
+    if start:
+        start_column = period_column(index, start)
+    elif end_column == 0:
+        #Column -1 would quietly be the latest period and give the diff backwards.
+        raise ValueError(f"The visit index has no period before {index['periods'][0]} to compare it with")
+    else:
+        start_column = end_column - 1
+
+    def snapshot(column):
+        #A 0 in the index means the IP wasn't in that period's snapshot.
+        counts = index["counts"][:, column]
+        rows = counts.nonzero()[0]
+        return [index["ips"][row] for row in rows], counts[rows]
+
+    diff = diff_snapshots(*snapshot(start_column), *snapshot(end_column))
+    return {
+        "from": index["periods"][start_column],
+        "to": index["periods"][end_column],
+        "totals": diff["totals"],
+        "new": [{"ip": ip, "visits": int(visits)} for ip, visits in diff["new"][:limit]],
+        "gone": [{"ip": ip, "visits": int(visits)} for ip, visits in diff["gone"][:limit]],
+        "changed": [{"ip": ip, "before": int(before), "after": int(after), "delta": int(delta)}
+                    for ip, before, after, delta in diff["changed"][:limit]],
+    }
+
+
+class StatsCache:
+    """The visit index this worker last loaded, plus the JSON answers already built from it."""
+
+    def __init__(self, refresh_seconds: int = STATS_REFRESH_SECONDS, container: str = "results"):
+        self.refresh_seconds = refresh_seconds
+        self.container = container
+        #The HTTP functions are sync, so more than one request can be in here at a time on different threads.
+        self._lock = threading.Lock()
+        #Answers stay valid until the index changes, so the TTL is effectively off.
+        self._responses = LRUCache(max_entries=STATS_CACHE_MAX_ENTRIES, max_bytes=STATS_CACHE_MAX_BYTES,
+                                   ttl_seconds=365 * 24 * 60 * 60)
+        self._index = None
+        self._row_of = {}
+        self._version = None
+        self._checked = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self) -> None:
+        #Makes the next request check the index blob straight away instead of waiting for refresh_seconds.
+        with self._lock:
+            self._checked = 0.0
+
+    def _refresh(self, blob_service_client) -> None:
+        #Called with the lock held. One properties call, plus a download only if the index actually changed.
+        blob_client = blob_service_client.get_blob_client(self.container, VISIT_INDEX_BLOB)
+        try:
+            version = blob_client.get_blob_properties().etag
+        except ResourceNotFoundError:
+            version = "missing"
+        if version != self._version:
+            self._index = empty_index() if version == "missing" else decode_index(blob_client.download_blob().readall())
+            self._row_of = {ip: row for row, ip in enumerate(self._index["ips"])}
+            self._version = version
+            self._responses.clear()
+            logging.warning(f'Loaded the visit index for stats: {len(self._index["ips"])} IPs over {len(self._index["periods"])} periods')
+        self._checked = time.monotonic()
+
+    def respond(self, blob_service_client, endpoint: str, params: dict, build, if_none_match: str = None):
+        """Returns (status code, JSON body or None, ETag).
+
+        build is called as build(index, row_of) -> dict, only when this
+        endpoint and params haven't been answered since the index last changed.
+        """
+        with self._lock:
+            if self._version is None or time.monotonic() - self._checked > self.refresh_seconds:
+                self._refresh(blob_service_client)
+            key = f"{self._version}|{endpoint}|{json.dumps(params, sort_keys=True)}"
+            etag = '"' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32] + '"'
+            if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+                self.hits += 1
+                return 304, None, etag
+            body = self._responses.get(key)
+            if body is not None:
+                self.hits += 1
+                return 200, body, etag
+            index, row_of = self._index, self._row_of
+            self.misses += 1
+        #Built outside the lock so a slow diff doesn't hold up other requests. The index is replaced, never changed in place.
+        body = json.dumps(build(index, row_of))
+        with self._lock:
+            self._responses.put(key, body)
+        return 200, body, etag
+
+
+#One per worker process.
+stats_cache = StatsCache()
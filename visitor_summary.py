@@ -0,0 +1,129 @@
+import os
+import json
+import datetime
+import logging
+from visitor_export import (EXPORT_KEY_COLUMN, EXPORT_WATERMARK_COLUMN, RESULTS_CONTAINER, SNAPSHOT_FORMAT, check_column,
+                            snapshot_filename, stream_rows_to_blob)
+from blob_compression import upload_compressed
+
+#This file is the 'aggregate' export mode (EXPORT_MODE=aggregate). Instead of dbqueryandsave pulling every row out of
+#ResumeVisitors and leaving the adding up to string dumps and the LLM, SQL does the aggregating and only the answers come back:
+#   - VisitorDaily holds one row per day per IP: visits that day, first and last seen. It's kept up to date incrementally,
+#     the ingest endpoint adds to it as visits are flushed (see visit_ingest.py) and every export catches it up with whatever
+#     reached ResumeVisitors some other way since the last run (refresh_summary)
+#   - per IP totals with first and last seen come out of VisitorDaily grouped by IP, and become today's snapshot like any other export
+#   - per day totals for the last SUMMARY_DAYS days go into dailytotals{date}.json next to it
+#So what comes back from SQL is one row per distinct visitor plus one per day, however many visits there were.
+#Every query is a fixed string with ? parameters, so SQL Server caches one plan for each and pyodbc keeps the statement
+#prepared while the same cursor runs it again. Table and column names come from settings and go through check_column.
+
+#The per day summary table. refresh_summary creates it if it isn't there yet.
+SUMMARY_TABLE = os.getenv('SUMMARY_TABLE', 'VisitorDaily')
+#How many days of per day totals go into dailytotals{date}.json.
+SUMMARY_DAYS = int(os.getenv('SUMMARY_DAYS', '35'))
+#The visitors table and its columns. The same ones dbqueryandsave exports from and the ingest endpoint writes to.
+SUMMARY_SOURCE_TABLE = os.getenv('SUMMARY_SOURCE_TABLE', 'ResumeVisitors')
+SUMMARY_COUNT_COLUMN = os.getenv('SUMMARY_COUNT_COLUMN', 'VisitCount')
+
+
+def summary_table_statement() -> str:
+    table = check_column(SUMMARY_TABLE, 'SUMMARY_TABLE')
+    return (f"IF OBJECT_ID(N'{table}', N'U') IS NULL CREATE TABLE {table} (VisitDate DATE NOT NULL, IPAddress NVARCHAR(45) NOT NULL, "
+            f"Visits INT NOT NULL, FirstSeen DATETIME2 NOT NULL, LastSeen DATETIME2 NOT NULL, PRIMARY KEY (VisitDate, IPAddress))")
+
+
+def refresh_statements() -> list:
+    """The T-SQL that catches the summary table up with the visitors table. Only the second one takes a parameter."""
+    table = check_column(SUMMARY_TABLE, 'SUMMARY_TABLE')
+    source = check_column(SUMMARY_SOURCE_TABLE, 'SUMMARY_SOURCE_TABLE')
+    ip = check_column(EXPORT_KEY_COLUMN, 'EXPORT_KEY_COLUMN')
+    count = check_column(SUMMARY_COUNT_COLUMN, 'SUMMARY_COUNT_COLUMN')
+    last_visited = check_column(EXPORT_WATERMARK_COLUMN, 'EXPORT_WATERMARK_COLUMN')
+    return [
+        "CREATE TABLE #SummaryCatchup (VisitDate DATE NOT NULL, IPAddress NVARCHAR(45) NOT NULL, Visits INT NOT NULL, "
+        "LastSeen DATETIME2 NOT NULL, PRIMARY KEY (VisitDate, IPAddress))",
+        #Only visitors seen since the summary's own newest row can have visits it doesn't know about. For those, anything in
+        #their total that the summary hasn't counted yet goes on the day they were last seen. It's a difference rather than a
+        #running count, so running it twice adds nothing and a visit it misses gets picked up the next time that IP shows up.
+        f"INSERT INTO #SummaryCatchup (VisitDate, IPAddress, Visits, LastSeen) "
+        f"SELECT CAST(v.{last_visited} AS DATE), v.{ip}, v.{count} - COALESCE(s.Visits, 0), v.{last_visited} "
+        f"FROM {source} v LEFT JOIN (SELECT IPAddress, SUM(Visits) AS Visits FROM {table} GROUP BY IPAddress) s ON s.IPAddress = v.{ip} "
+        f"WHERE v.{last_visited} > COALESCE((SELECT MAX(LastSeen) FROM {table}), ?) AND v.{count} > COALESCE(s.Visits, 0)",
+        f"UPDATE {table} SET Visits = {table}.Visits + c.Visits, "
+        f"LastSeen = CASE WHEN c.LastSeen > {table}.LastSeen THEN c.LastSeen ELSE {table}.LastSeen END "
+        f"FROM #SummaryCatchup AS c WHERE {table}.VisitDate = c.VisitDate AND {table}.IPAddress = c.IPAddress",
+        f"INSERT INTO {table} (VisitDate, IPAddress, Visits, FirstSeen, LastSeen) "
+        f"SELECT c.VisitDate, c.IPAddress, c.Visits, c.LastSeen, c.LastSeen FROM #SummaryCatchup AS c "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {table} d WHERE d.VisitDate = c.VisitDate AND d.IPAddress = c.IPAddress)",
+        "DROP TABLE #SummaryCatchup",
+    ]
+
+
+def refresh_summary(conn) -> int:
+    """Create the summary table if needed and add whatever it's missing from the visitors table. Returns the rows caught up.
+
+    The first run puts everyone's whole count on the day they were last seen,
+    the table can't know any better than that. After that it's only the visits
+    since the last run, and none at all for visits the ingest endpoint wrote.
+    """
+    create, insert, update, add, drop = refresh_statements()
+    cur = conn.cursor()
+    cur.execute(summary_table_statement())
+    cur.execute(create)
+    #Before anything's in the summary every visitor counts as new.
+    cur.execute(insert, datetime.datetime(1900, 1, 1))
+    cur.execute("SELECT COUNT(*) FROM #SummaryCatchup")
+    caught_up = cur.fetchone()[0]
+    if caught_up:
+        cur.execute(update)
+        cur.execute(add)
+    cur.execute(drop)
+    conn.commit()
+    return caught_up
+
+
+def visitor_totals_query() -> str:
+    #One row per distinct visitor: IP, total visits, first seen, last seen. Ordered by IP so a re-run writes the same bytes.
+    table = check_column(SUMMARY_TABLE, 'SUMMARY_TABLE')
+    return (f"SELECT IPAddress, SUM(Visits) AS Visits, MIN(FirstSeen) AS FirstSeen, MAX(LastSeen) AS LastSeen "
+            f"FROM {table} GROUP BY IPAddress ORDER BY IPAddress")
+
+
+def daily_totals_query() -> str:
+    #One row per day from the first parameter onwards: distinct visitors and total visits.
+    table = check_column(SUMMARY_TABLE, 'SUMMARY_TABLE')
+    return (f"SELECT VisitDate, COUNT(*) AS Visitors, SUM(Visits) AS Visits, MIN(FirstSeen) AS FirstSeen, MAX(LastSeen) AS LastSeen "
+            f"FROM {table} WHERE VisitDate >= ? GROUP BY VisitDate ORDER BY VisitDate")
+
+
+def daily_totals(cur, since: datetime.date) -> list:
+    cur.execute(daily_totals_query(), since)
+    return [{"date": str(row[0])[:10], "visitors": int(row[1]), "visits": int(row[2]),
+             "first_seen": str(row[3]), "last_seen": str(row[4])} for row in cur.fetchall()]
+
+
+def daily_totals_filename(today: str) -> str:
+    return f"dailytotals{today}.json"
+
+
+def export_aggregate(conn, cur, blob_service_client, today: str, on_batch=None, days: int = SUMMARY_DAYS):
+    """Refresh the summary table, then export per IP totals as today's snapshot. Returns (filename, rows, bytes, MD5).
+
+    The per day totals for the last days days are saved as
+    dailytotals{today}.json. on_batch gets every batch of (IP, visits, first
+    seen, last seen) rows as it goes past, see stream_rows_to_blob.
+    """
+    caught_up = refresh_summary(conn)
+    logging.warning(f'Caught {SUMMARY_TABLE} up with {caught_up} visitor days from {SUMMARY_SOURCE_TABLE}')
+    cur.execute(visitor_totals_query())
+    filename = snapshot_filename(today)
+    blob_client = blob_service_client.get_blob_client(RESULTS_CONTAINER, filename)
+    row_count, byte_count, content_md5 = stream_rows_to_blob(cur, blob_client, on_batch=on_batch,
+                                                             snapshot_format=SNAPSHOT_FORMAT)
+    since = datetime.datetime.strptime(today, "%Y%m%d").date() - datetime.timedelta(days=days)
+    totals = daily_totals(cur, since)
+    upload_compressed(blob_service_client.get_blob_client(RESULTS_CONTAINER, daily_totals_filename(today)),
+                      json.dumps({"date": today, "since": since.isoformat(), "days": totals}), overwrite=True,
+                      content_type="application/json")
+    logging.warning(f'Saved totals for {len(totals)} days to {daily_totals_filename(today)}')
+    return filename, row_count, byte_count, content_md5